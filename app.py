@@ -1,11 +1,13 @@
+import threading
 from datetime import datetime
-from collections import defaultdict
+from functools import wraps
+from collections import OrderedDict
 
-from flask import Flask, request, render_template, redirect, url_for
+from flask import Flask, request, render_template, redirect, url_for, jsonify
 from bson.objectid import ObjectId
 
 import db
-from scrapper import parse_snowball
+import jobs
 from utils import mean_or_zero
 from etftag import ETFTag
 
@@ -16,41 +18,129 @@ VERSION = 1.10
 INTEREST = 2.25
 
 
-@app.route('/stocks')
-@app.route('/stocks/<status>')
-@app.route('/stocks/<status>/<alt>')
-@app.route('/')
-def stocks(status=None, alt=None):
-    find = None
-    stat = {}
+STAT_STATUSES = ['owned', 'starred', 'starredorowned']
+
+RESPONSE_CACHE_ENTRIES = 128
+RESPONSE_CACHE_BYTES = 32 * 1024 * 1024
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int=RESPONSE_CACHE_ENTRIES, max_bytes: int=RESPONSE_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        data = entry[0]
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[0])
+            self.entries[key] = entry
+            self.size += len(data)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[0])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+response_cache = ResponseCache()
+indexes_lock = threading.Lock()
+indexes_ready = False
+
+
+@app.before_request
+def ensure_indexes():
+    global indexes_ready
+    if indexes_ready:
+        return
+    with indexes_lock:
+        if not indexes_ready:
+            db.ensure_indexes()
+            jobs.ensure_indexes()
+            indexes_ready = True
+
+
+def cached_view(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (request.path, tuple(sorted(request.args.items(multi=True))), db.data_version())
+        entry = response_cache.get(key)
+        if entry is None:
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            entry = (response.get_data(), response.mimetype)
+            response_cache.put(key, entry)
+        data, mimetype = entry
+        return app.response_class(data, mimetype=mimetype)
+    return wrapper
+
+
+def status_find(status):
     if status == 'starred':
-        find = {'starred': True}
+        return {'starred': True}
     elif status == 'owned':
-        find = {'owned': True}
+        return {'owned': True}
     elif status == 'starredorowned':
-        find = {'$or': [{'starred': True}, {'owned': True}]}
+        return {'$or': [{'starred': True}, {'owned': True}]}
     elif status == 'doubtful':
-        find = {'doubtful': True}
-    order_by = request.args.get('order_by', 'expected_rate')
-    ordering = request.args.get('ordering', 'desc')
+        return {'doubtful': True}
+    return None
+
+
+def stock_list_args(status):
+    find = status_find(status)
     filter_id = request.args.get('filter_id', None)
+    current_filter = db.filter_by_id(filter_id) if filter_id else None
+    return current_filter, {
+        'order_by': request.args.get('order_by', 'expected_rate'),
+        'ordering': request.args.get('ordering', 'desc'),
+        'find': find,
+        'filter_by_expected_rate': find==None,
+        'filter_bad': status!='bad',
+        'filter_options': (current_filter.filter_options if current_filter else []),
+        'rank_options': (current_filter.rank_options if current_filter else []),
+    }
+
 
+@app.route('/stocks')
+@app.route('/stocks/<status>')
+@app.route('/stocks/<status>/<alt>')
+@app.route('/')
+@cached_view
+def stocks(status=None, alt=None):
+    stat = {}
     filters = db.all_filters()
-    current_filter = None
-    if filter_id:
-        current_filter = db.filter_by_id(filter_id)
-    
-    stocks = db.all_stocks(order_by=order_by, 
-        ordering=ordering, find=find, 
-        filter_by_expected_rate=find==None, 
-        filter_bad=status!='bad', 
-        filter_options=(current_filter.filter_options if current_filter else []),
-        rank_options=(current_filter.rank_options if current_filter else []))
+    current_filter, args = stock_list_args(status)
+    order_by = args['order_by']
+    ordering = args['ordering']
+
+    next_cursor = None
+    if status in STAT_STATUSES:
+        stocks = db.all_stocks(**args)
+        total = len(stocks)
+    else:
+        stocks, next_cursor, total = db.stocks_page(**args)
 
     if current_filter and current_filter.rank_options:
         order_by = None
 
-    if status in ['owned', 'starred', 'starredorowned']:
+    if status in STAT_STATUSES:
         stat['low_pbr'] = len([stock for stock in stocks if stock.pbr <= 1])
         stat['high_expected_rate'] = len([stock for stock in stocks if stock.expected_rate >= 15])
         stat['fscore'] = len([stock for stock in stocks if stock.latest_fscore >= 3])
@@ -66,7 +156,18 @@ def stocks(status=None, alt=None):
     return render_template('stocks.html', VERSION=VERSION, stocks=stocks, order_by=order_by, ordering=ordering, status=status,
         available_filter_options=db.available_filter_options, filters=filters,
         current_filter=current_filter, stat=stat, available_rank_options=db.available_rank_options,
-        alt=alt)
+        alt=alt, next_cursor=next_cursor, total=total)
+
+
+@app.route('/stocks/rows')
+@cached_view
+def stock_rows():
+    status = request.args.get('status') or None
+    alt = request.args.get('alt') or None
+    current_filter, args = stock_list_args(status)
+    stocks, next_cursor, _ = db.stocks_page(cursor=request.args.get('cursor'), **args)
+    rows = render_template('_stock_rows.html', stocks=stocks, current_filter=current_filter, alt=alt)
+    return jsonify(rows=rows, next_cursor=next_cursor)
 
 
 @app.route('/stocks/filter/new')
@@ -172,7 +273,8 @@ def stocks_fill_snowball_stats():
 def stock(code):
     stock = db.stock_by_code(code)
     filters = db.all_filters()
-    return render_template('stock_detail.html', VERSION=VERSION, stock=stock, filters=filters)
+    job = jobs.latest_job(code)
+    return render_template('stock_detail.html', VERSION=VERSION, stock=stock, filters=filters, job=job)
 
 
 @app.route('/stock/<code>/records')
@@ -187,7 +289,7 @@ def stock_records(code):
 
 @app.route('/stock/refresh/<code>')
 def stock_refresh(code):
-    parse_snowball(code)
+    jobs.enqueue(code, priority=jobs.USER_PRIORITY)
     return redirect(url_for('stock', code=code))
 
 
@@ -270,10 +372,15 @@ def add_stock():
     if request.method == 'POST':
         code = request.form.get('code', None)
         if code:
-            parse_snowball(code)
+            jobs.enqueue(code, priority=jobs.USER_PRIORITY)
     return redirect('stocks')
 
 
+@app.route('/jobs/stats')
+def job_stats():
+    return jsonify(jobs.queue_stats())
+
+
 @app.route('/stocks/<code>/remove')
 def remove_stock(code):
     db.remove_stock(code)
@@ -281,27 +388,16 @@ def remove_stock(code):
 
 
 @app.route('/etfs/<etf_type>')
+@cached_view
 def etfs(etf_type='domestic'):
-    momentum_base = 'month3' if etf_type == 'domestic' else 'month6'
+    momentum_base = db.ETF_MOMENTUM_BASES.get(etf_type, 'month6')
     momentum_base_kr = '3개월' if etf_type == 'domestic' else '6개월'
     order_by = request.args.get('order_by', momentum_base)
     ordering = request.args.get('ordering', 'desc')
     etfs = db.all_etf(order_by=order_by, ordering=ordering, etf_type=etf_type)
-    bond_etfs = ['148070', '152380']
-    tags = defaultdict(list)
-    for etf in etfs:
-        for tag in etf.get('tags'):
-            tags[tag].append(etf)
-    tags = {k: ETFTag(k, v) for k, v in tags.items()}
-    
-    stat = {}
-    etfs_by_momentum_base = [etf for etf in db.all_etf(order_by=momentum_base, ordering='desc', etf_type=etf_type) if etf[momentum_base] != 0]
-    no_bond_etfs = sorted([etf for etf in etfs_by_momentum_base if etf['code'] not in bond_etfs], key=lambda x: x.get(momentum_base, 0), reverse=True)
-    stat['absolute_momentum_momentum_base_avg'] = mean_or_zero([etf[momentum_base] for etf in no_bond_etfs])
-    stat['absolute_momentum_high'] = no_bond_etfs[0]
-    stat['relative_momentum_etf'] = etfs_by_momentum_base[0]
-    
-    tags = sorted(tags.values(), key=lambda t: getattr(t, momentum_base), reverse=True)
+    stat = db.etf_stats(etf_type) or db.materialize_etf_stats(etf_type)
+    etfs_by_code = {etf['code']: etf for etf in etfs}
+    tags = [ETFTag.from_stats(tag, etfs_by_code) for tag in stat['tags']]
     
     filters = db.all_filters()
     
@@ -0,0 +1,156 @@
+from typing import List, Dict, Tuple, Optional
+from collections import namedtuple
+from statistics import mean
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import os
+
+import numpy as np
+
+import db
+import historical
+import pricestore
+import scrapper
+from db import Stock
+from historical import Record, Event, EventStat, SimulationParams, DEFAULT_PARAMS, event_stat
+
+
+FUTURE = 10
+
+SWEEP_MIN_EXPECTED_RATES = [10.0, 11.5, 13.5, 15.0, 17.0]
+SWEEP_SELL_DROPS = [0.8, 1.2, 1.6, 2.0]
+SWEEP_TAKE_PROFITS = [0.08, 0.13, 0.2, 0.3]
+
+SweepResult = namedtuple('SweepResult', ['params', 'stat'])
+Series = namedtuple('Series', ['code', 'dates', 'prices', 'expected_rates', 'mid_expected_rates', 'bps', 'fROE'])
+
+
+def year_fundamentals(stock: Stock, years: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    BPSs = {b[0]: b[1] for b in stock.year_stat('BPSs', exclude_future=True)}
+    bps = np.zeros(len(years))
+    fROE = np.zeros(len(years))
+    for i, year in enumerate(years.tolist()):
+        ROEs = [roe[1] for roe in stock.four_years_roe(year)]
+        if BPSs.get(year - 1) and ROEs:
+            bps[i] = BPSs[year - 1]
+            fROE[i] = mean(ROEs)
+    return bps, fROE
+
+
+def build_series(stock: Stock, candles: np.ndarray) -> Optional[Series]:
+    if not len(candles):
+        return None
+    candle_years = candles['date'].astype('datetime64[Y]').astype(int) + 1970
+    years, starts, year_index = np.unique(candle_years, return_index=True, return_inverse=True)
+    year_bps, year_fROE = year_fundamentals(stock, years)
+    bps = year_bps[year_index]
+    fROE = year_fROE[year_index]
+
+    prices = candles['close'].astype(float)
+    price = np.where(prices != 0, prices, stock.current_price)
+    future_bps = np.trunc(bps * (1 + fROE / 100) ** FUTURE)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected_rates = np.where((bps != 0) & (future_bps >= 0), ((future_bps / price) ** (1.0 / FUTURE) - 1) * 100, 0)
+    expected_rates = np.nan_to_num(expected_rates)
+
+    mids = (np.maximum.reduceat(expected_rates, starts) + np.minimum.reduceat(expected_rates, starts)) / 2
+    return Series(code=stock['code'], dates=np.array(candles['date']), prices=prices, expected_rates=expected_rates,
+        mid_expected_rates=mids[year_index], bps=bps, fROE=fROE)
+
+
+def load_series(find=None, sync: bool=True, workers: int=scrapper.DEFAULT_WORKERS) -> List[Series]:
+    stocks = [Stock(stock) for stock in db.db.stocks.find(find or {})]
+    if sync:
+        scrapper.crawl([stock['code'] for stock in stocks], historical.sync_prices, workers=workers)
+    series = []
+    skipped = 0
+    for stock in stocks:
+        built = build_series(stock, pricestore.load(stock['code']))
+        if built:
+            series.append(built)
+        else:
+            skipped += 1
+    if skipped:
+        print('가격 데이터가 없어 {} 종목 제외'.format(skipped))
+    return series
+
+
+def record_at(series: Series, i: int) -> Record:
+    return Record(date=series.dates[i].item(), price=series.prices[i].item(), expected_rate=series.expected_rates[i].item(),
+        bps=series.bps[i].item(), fROE=series.fROE[i].item())
+
+
+def trade_indexes(series: Series, params: SimulationParams=DEFAULT_PARAMS) -> List[Tuple[int, Optional[int]]]:
+    rates = series.expected_rates
+    prices = series.prices
+    buys = np.flatnonzero(rates >= np.maximum(series.mid_expected_rates, params.min_expected_rate))
+    trades = []
+    start = 0
+    while True:
+        at = np.searchsorted(buys, start)
+        if at == len(buys):
+            return trades
+        buy = buys[at]
+        sells = (rates[buy] - rates[buy:] >= params.sell_drop) | (prices[buy] * params.take_profit + prices[buy] <= prices[buy:])
+        if not sells.any():
+            trades.append((buy, None))
+            return trades
+        sell = buy + int(np.argmax(sells))
+        trades.append((buy, sell))
+        start = sell + 1
+
+
+def simulate_series(series: Series, params: SimulationParams=DEFAULT_PARAMS) -> List[Event]:
+    events = []
+    for buy, sell in trade_indexes(series, params):
+        events.append(Event(date=series.dates[buy].item(), record=record_at(series, buy), buy=True))
+        if sell is not None:
+            events.append(Event(date=series.dates[sell].item(), record=record_at(series, sell), buy=False))
+    return events
+
+
+def trade_stat(series: Series, params: SimulationParams=DEFAULT_PARAMS) -> EventStat:
+    trades = trade_indexes(series, params)
+    closed = [(buy, sell) for buy, sell in trades if sell is not None and series.prices[buy]]
+    profit = sum((series.prices[sell] / series.prices[buy] - 1) * 100 for buy, sell in closed)
+    return EventStat(buy_count=len(trades), sell_count=len([sell for _, sell in trades if sell is not None]), profit=float(profit))
+
+
+def combine(stats: List[EventStat]) -> EventStat:
+    return EventStat(buy_count=sum(s.buy_count for s in stats), sell_count=sum(s.sell_count for s in stats),
+        profit=sum(s.profit for s in stats))
+
+
+def run(series: List[Series], params: SimulationParams=DEFAULT_PARAMS) -> Tuple[Dict[str, List[Event]], EventStat]:
+    events = {s.code: simulate_series(s, params) for s in series}
+    return events, combine([event_stat(e) for e in events.values()])
+
+
+def param_grid(min_expected_rates: List[float]=SWEEP_MIN_EXPECTED_RATES, sell_drops: List[float]=SWEEP_SELL_DROPS,
+        take_profits: List[float]=SWEEP_TAKE_PROFITS) -> List[SimulationParams]:
+    return [SimulationParams(*values) for values in itertools.product(min_expected_rates, sell_drops, take_profits)]
+
+
+def sweep_chunk(series: List[Series], grid: List[SimulationParams]) -> List[EventStat]:
+    return [combine([trade_stat(s, params) for s in series]) for params in grid]
+
+
+def sweep(series: List[Series], grid: List[SimulationParams]=None, workers: int=None) -> List[SweepResult]:
+    grid = grid or param_grid()
+    workers = workers or os.cpu_count() or 1
+    chunks = [series[i::workers] for i in range(workers) if series[i::workers]]
+    if len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            stats = list(executor.map(sweep_chunk, chunks, itertools.repeat(grid)))
+    else:
+        stats = [sweep_chunk(chunk, grid) for chunk in chunks]
+    results = [SweepResult(params=params, stat=combine([s[i] for s in stats])) for i, params in enumerate(grid)]
+    return sorted(results, key=lambda r: (r.stat.profit, -r.stat.buy_count), reverse=True)
+
+
+def print_sweep(results: List[SweepResult], top: int=20):
+    print('{:>8} {:>8} {:>8} {:>8} {:>8} {:>12}'.format('기준수익률', '하락폭', '목표수익', '매수', '매도', '수익률합계'))
+    for result in results[:top]:
+        params, stat = result
+        print('{:>8.2f} {:>8.2f} {:>8.2f} {:>8} {:>8} {:>12.2f}'.format(params.min_expected_rate, params.sell_drop,
+            params.take_profit, stat.buy_count, stat.sell_count, stat.profit))
@@ -1,16 +1,23 @@
 from typing import Tuple, List, Optional, Dict
 from types import FunctionType
 
+import json
+import base64
+import heapq
+import time
+import threading
 from datetime import datetime
-from functools import partial
+from functools import partial, wraps, cmp_to_key
 from itertools import repeat
 from statistics import mean, StatisticsError
-from collections import UserDict, namedtuple
+from bisect import bisect_left, bisect_right
+from collections import UserDict, namedtuple, defaultdict
 
-from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo import MongoClient, UpdateOne, ASCENDING, DESCENDING
 from bson.objectid import ObjectId
 
-from utils import attr_or_key_getter, first_or_none
+from utils import attr_or_key_getter, mean_or_zero, first_or_none
+from etftag import ETFTag
 
 
 FScore = namedtuple('FScore', ['total_issued_stock', 'profitable', 'cfo'])
@@ -18,6 +25,7 @@ YearStat = namedtuple('YearStat', ['year', 'value', 'calculated'])
 Quarter = namedtuple('Quarter', ['year', 'number', 'estimated'])
 FilterOption = namedtuple('Filter', ['key', 'title', 'morethan', 'value', 'is_boolean'])
 RankOption = namedtuple('Rank', ['key', 'title', 'asc', 'is_rankoption'])
+RankSpec = namedtuple('RankSpec', ['key', 'rank_key', 'reverse'])
 
 
 YEAR_STAT = Tuple[int, int]
@@ -33,6 +41,12 @@ FUTURE = 10
 TARGET_RATE = 15
 THIS_YEAR = datetime.now().year
 LAST_YEAR = THIS_YEAR - 1
+BULK_BATCH_SIZE = 100
+PAGE_SIZE = 50
+ETF_MOMENTUM_BASES = {'domestic': 'month3', 'international': 'month6'}
+BOND_ETFS = ['148070', '152380']
+DERIVED_VERSION = 1
+META_MAX_AGE = 1.0
 
 
 available_rank_options = [
@@ -50,6 +64,97 @@ available_rank_options = [
 ]
 
 
+rank_specs = [
+    RankSpec(key='last_year_gpa', rank_key='rank_last_year_gpa', reverse=True),
+    RankSpec(key='agg_value', rank_key='agg_rank', reverse=True),
+    RankSpec(key='pbr', rank_key='rank_pbr', reverse=False),
+    RankSpec(key='per', rank_key='rank_per', reverse=False),
+    RankSpec(key='dividend_rate', rank_key='rank_dividend', reverse=True),
+    RankSpec(key='beta', rank_key='rank_beta', reverse=False),
+    RankSpec(key='floating_rate', rank_key='rank_floating_rate', reverse=True),
+    RankSpec(key='foreigner_weight', rank_key='rank_foreigner_weight', reverse=True),
+    RankSpec(key='month1', rank_key='rank_month1', reverse=True),
+    RankSpec(key='month3', rank_key='rank_month3', reverse=True),
+    RankSpec(key='month6', rank_key='rank_month6', reverse=True),
+    RankSpec(key='month12', rank_key='rank_month12', reverse=True),
+    RankSpec(key='relative_earning_rate', rank_key='rank_relative_earning_rate', reverse=True),
+    RankSpec(key='NCAV_ratio', rank_key='rank_ncav', reverse=True),
+    RankSpec(key='mean_ROIC', rank_key='rank_roic', reverse=True),
+    RankSpec(key='current_ratio_last_year', rank_key='rank_current_ratio', reverse=True),
+    RankSpec(key='last_year_pcr', rank_key='rank_last_year_pcr', reverse=False),
+    RankSpec(key='last_year_psr', rank_key='rank_last_year_psr', reverse=False),
+    RankSpec(key='last_year_pfr', rank_key='rank_last_year_pfr', reverse=False),
+]
+
+
+derived_keys = [
+    'expected_rate',
+    'expected_rate_by_current_pbr',
+    'expected_rate_by_low_pbr',
+    'future_roe',
+    'low_pbr',
+    'latest_fscore',
+    'NCAV_ratio',
+    'last_year_gpa',
+    'last_year_pcr',
+    'last_year_psr',
+    'mean_ROIC',
+    'current_ratio_last_year',
+    'countable_last_four_years_roes_count',
+    'roe_max_diff',
+    'last_four_years_roe_max_diff',
+    'calculable_pbr_count',
+    'FCF_surplus_years',
+    'is_closing_month_march',
+    'is_five_years_record_low',
+    'has_consensus',
+    'is_positive_consensus_roe',
+]
+
+
+stored_keys = [
+    'title',
+    'current_price',
+    'agg_value',
+    'per',
+    'pbr',
+    'dividend_rate',
+    'beta',
+    'foreigner_weight',
+    'floating_rate',
+    'month1',
+    'month3',
+    'month6',
+    'month12',
+    'relative_earning_rate',
+] + [spec.rank_key for spec in rank_specs]
+
+
+stored_defaults = {
+    'per': 0,
+    'pbr': 0,
+    'dividend_rate': 0,
+    'beta': 0,
+    'foreigner_weight': 0,
+    'floating_rate': 0,
+    'month1': 0,
+    'month3': 0,
+    'month6': 0,
+    'month12': 0,
+    'relative_earning_rate': -100,
+}
+
+
+field_aliases = {
+    'is_starred': 'starred',
+    'is_owned': 'owned',
+}
+
+
+indexed_keys = ['code', 'derived_version', 'title', 'expected_rate', 'future_roe', 
+    'expected_rate_by_current_pbr', 'expected_rate_by_low_pbr', 'last_year_gpa', 'updated_at']
+
+
 available_filter_options = [
     FilterOption(key='expected_rate', title='기대수익률', morethan=None, value=None, is_boolean=False),
     FilterOption(key='latest_fscore', title='FScore', morethan=None, value=None, is_boolean=False),
@@ -119,7 +224,62 @@ class ETF(UserDict):
         return ', '.join(self.get('tags'))
 
 
+class YearSeries(list):
+    def __init__(self, pairs=()):
+        super().__init__(pairs)
+        self.by_year = {}
+        for year, value in reversed(self):
+            self.by_year[year] = value
+        self.years = [pair[0] for pair in self]
+        self.ordered = all(a < b for a, b in zip(self.years, self.years[1:]))
+
+    def get(self, year: int, default=None):
+        return self.by_year.get(year, default)
+
+    def has(self, year: int) -> bool:
+        return year in self.by_year
+
+    def between(self, start: int, end: int) -> 'YearSeries':
+        if not self.ordered:
+            return YearSeries(pair for pair in self if start <= pair[0] < end)
+        return YearSeries(self[bisect_left(self.years, start):bisect_left(self.years, end)])
+
+    def past(self, last_year: int=LAST_YEAR) -> 'YearSeries':
+        if not self.ordered:
+            return YearSeries(pair for pair in self if pair[0] <= last_year)
+        return YearSeries(self[:bisect_right(self.years, last_year)])
+
+    def future(self, last_year: int=LAST_YEAR) -> 'YearSeries':
+        if not self.ordered:
+            return YearSeries(pair for pair in self if pair[0] > last_year)
+        return YearSeries(self[bisect_right(self.years, last_year):])
+
+
+def memoized(func):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        try:
+            return self._memo[key]
+        except KeyError:
+            value = self._memo[key] = func(self, *args, **kwargs)
+            return value
+    return wrapper
+
+
 class Stock(UserDict):
+    def __init__(self, *args, **kwargs):
+        self._memo = {}
+        super().__init__(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._memo = {}
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._memo = {}
+
     def __hash__(self):
         return hash(frozenset(self.items()))
 
@@ -186,6 +346,7 @@ class Stock(UserDict):
         return self.year_stat('EPSs')
 
     @property
+    @memoized
     def countable_roes(self) -> List[Tuple[int, Optional[float]]]:
         return [roe for roe in self.get('ROEs', []) if roe]
 
@@ -194,6 +355,7 @@ class Stock(UserDict):
         return len(self.last_four_years_roe)
 
     @property
+    @memoized
     def low_pbr(self) -> float:
         try:
             return min([year_pbr[1] for year_pbr in self.year_stat('PBRs', exclude_future=True) if year_pbr[1] > 0])
@@ -201,6 +363,7 @@ class Stock(UserDict):
             return 0
 
     @property
+    @memoized
     def high_pbr(self) -> float:
         try: 
             return max([year_pbr[1] for year_pbr in self.year_stat('PBRs', exclude_future=True) if year_pbr[1] > 0])
@@ -212,6 +375,7 @@ class Stock(UserDict):
         return (self.low_pbr + self.get('pbr')) / 2
     
     @property
+    @memoized
     def adjusted_eps(self) -> int:
         past_eps = [eps[1] for eps in self.year_stat('EPSs', exclude_future=True)]
         if len(past_eps) < 3:
@@ -219,11 +383,13 @@ class Stock(UserDict):
         return int(((past_eps[-1] * 3) + (past_eps[-2] * 2) + past_eps[-3]) / 6)
 
     @property
+    @memoized
     def mid_roe(self) -> float:
         ROEs = self.countable_roes
         return mean([mean(ROEs), min(ROEs)]) if len(ROEs) > 2 else 0    
 
     @property
+    @memoized
     def eps_growth(self) -> float:
         EPSs = self.get('EPSs', [0, 0])
         try:
@@ -252,15 +418,15 @@ class Stock(UserDict):
         return len(self.get('note', '')) > 0
 
     @property
+    @memoized
     def latest_fscore(self) -> int:
-        last_year_fscore = [f for f in self.fscores if f[0] == LAST_YEAR]
-        if not last_year_fscore:
+        if not self.year_stat('NPs').has(LAST_YEAR):
             return -1
-        else:
-            fscore = last_year_fscore[0][1]
-            return sum([fscore.total_issued_stock + fscore.profitable + fscore.cfo])
+        fscore = self.fscore(LAST_YEAR)
+        return sum([fscore.total_issued_stock + fscore.profitable + fscore.cfo])
 
     @property
+    @memoized
     def fscores(self) -> List[Tuple[int, FScore]]:
         NPs = self.year_stat('NPs')
         return [(np[0], self.fscore(np[0])) for np in NPs]
@@ -275,29 +441,35 @@ class Stock(UserDict):
         return self.get('dividend_rate', 0) * (DIVIDEND_TAX_RATE / 100)
 
     @property
+    @memoized
     def last_four_years_roe(self) -> List[int]:
         return [roe[1] for roe in self.four_years_roe(THIS_YEAR)]
 
+    @memoized
     def four_years_roe(self, year) -> List[Tuple[int, float]]:
-        return [roe for roe in self.year_stat('ROEs') if roe[1] and roe[0] >= (year - 4) and roe[0] < year]
+        return [roe for roe in self.year_stat('ROEs').between(year - 4, year) if roe[1]]
 
     @property
     def calculated_roe_count(self) -> int:
         return len(self.last_four_years_roe)
 
     @property
+    @memoized
     def calculable_pbr_count(self) -> int:
         return len([pbr for pbr in self.year_stat('PBRs', exclude_future=True) if pbr[1] > 0])
 
     @property
+    @memoized
     def mean_roe(self) -> float:
         return mean(self.last_four_years_roe) if self.last_four_years_roe else 0
 
     @property
+    @memoized
     def future_roe(self) -> float:
         return self.mean_roe - self.dividend_tax_adjust     
 
     @property
+    @memoized
     def expected_rate(self) -> float:
         return self.calc_expected_rate(self.calc_future_bps, FUTURE)
 
@@ -307,18 +479,22 @@ class Stock(UserDict):
         return int(future_bps / ((1 + (1 * TARGET_RATE / 100)) ** FUTURE))
 
     @property
+    @memoized
     def expected_rate_by_current_pbr(self) -> float:
         return self.calc_expected_rate(self.calc_future_price_current_pbr, FUTURE)
 
     @property
+    @memoized
     def expected_rate_by_low_pbr(self) -> float:
         return self.calc_expected_rate(self.calc_future_price_low_pbr, FUTURE)
 
     @property
+    @memoized
     def expected_rate_by_mid_pbr(self) -> float:
         return self.calc_expected_rate(self.calc_future_price_low_current_mid_pbr, FUTURE)
 
     @property
+    @memoized
     def expected_rate_by_adjusted_future_pbr(self) -> float:
         return self.calc_expected_rate(self.calc_future_price_adjusted_future_pbr, FUTURE)
 
@@ -363,6 +539,7 @@ class Stock(UserDict):
         return zip(self.QROEs, self.QBPSs)
 
     @property
+    @memoized
     def calculable(self) -> bool:
         return self.get('bps', 0) > 0 and (self.get('adjusted_future_roe', 0) or self.future_roe) > 0
 
@@ -404,7 +581,7 @@ class Stock(UserDict):
 
     @property
     def FCF_surplus_years(self):
-        return len([v for v in self.year_stat('FCFs', exclude_future=True) if v[1] > 0])
+        return len([v for v in self.series('FCFs').past() if v[1] > 0])
 
     @property
     def is_five_years_record_low(self):
@@ -415,10 +592,12 @@ class Stock(UserDict):
         return len(self.consensus_roes) > 0
 
     @property
+    @memoized
     def consensus_roes(self):
-        return [pair for pair in self.roes if pair[0] > LAST_YEAR]
+        return self.roes.future()
 
     @property
+    @memoized
     def mean_consensus_roe(self):
         try:
             return mean([pair[1] for pair in self.consensus_roes if pair[1]])
@@ -460,23 +639,22 @@ class Stock(UserDict):
         return self.get('total_liability', [])
 
     @property
+    @memoized
     def current_ratio(self):
         return [(c[0][0], (c[0][1] / c[1][1] if c[1][1] != 0 else 0) * 100) for c in zip(self.current_assets, self.current_liability)]
 
     @property
     def current_ratio_last_year(self):
-        if not self.current_ratio:
-            return 0
-        last_year = [c[1] for c in self.current_ratio if c[0] == LAST_YEAR]
-        return last_year[0] if last_year else 0
+        return self.series('current_ratio').get(LAST_YEAR, 0)
 
     @property
+    @memoized
     def NCAV(self):
-        asset = [c[1] for c in self.current_assets if c[0] == LAST_YEAR]
-        liability = [c[1] for c in self.total_liability if c[0] == LAST_YEAR]
-        if not asset or not liability: 
+        asset = self.series('current_assets').get(LAST_YEAR)
+        liability = self.series('total_liability').get(LAST_YEAR)
+        if asset is None or liability is None: 
             return 0
-        return asset[0] - liability[0]
+        return asset - liability
 
     @property
     def NCAV_ratio(self):
@@ -485,15 +663,13 @@ class Stock(UserDict):
     def calc_gpa(self, gp):
         if not gp[1]:
             return None
-        TA = [TA for TA in self.TAs if TA[0] == gp[0]]
+        TA = self.TAs.get(gp[0])
         if not TA:
             return None
-        TA = TA[0]
-        if not TA[1]:
-            return None
-        return gp[1] / TA[1]
+        return gp[1] / TA
 
     @property
+    @memoized
     def GPAs(self):
         return [(gp[0], self.calc_gpa(gp)) for gp in self.get('GPs', [])]
 
@@ -502,25 +678,17 @@ class Stock(UserDict):
         return zip(self.TAs, [v for v in self.get('GPs', []) if v[1]], [v for v in self.GPAs if v[1]])
 
     @property
+    @memoized
     def last_year_gpa(self):
-        v = [gpa[1] for gpa in self.GPAs if gpa[0] == LAST_YEAR]
-        if not v or not v[0]:
-            return 0
-        return v[0]
+        return self.series('GPAs').get(LAST_YEAR) or 0
 
     @property
     def last_year_pcr(self):
-        v = [pcr[1] for pcr in self.get('PCRs', []) if pcr[0] == LAST_YEAR]
-        if not v or not v[0]:
-            return 0
-        return v[0]
+        return self.series('PCRs').get(LAST_YEAR) or 0
 
     @property
     def last_year_psr(self):
-        v = [psr[1] for psr in self.get('PSRs', []) if psr[0] == LAST_YEAR]
-        if not v or not v[0]:
-            return 0
-        return v[0]
+        return self.series('PSRs').get(LAST_YEAR) or 0
 
     @property
     def agg_rank(self):
@@ -559,14 +727,14 @@ class Stock(UserDict):
         return [(s[0], c[1] / s[1] * 100) for c, s in zip(self.get('SGAs', []), self.get('sales', []))]
 
     @property
+    @memoized
     def mean_ROIC(self):
         values = [v[1] for v in self.get('ROICs', []) if v[1] > 0]
         return mean(values) if values else 0
 
     @property
     def last_year_fcf(self):
-        fcf = [fcf[1] for fcf in self.FCFs if fcf[0] == LAST_YEAR]
-        return fcf[0] if fcf else 0
+        return self.series('FCFs').get(LAST_YEAR, 0)
 
     @property
     def last_year_pfr(self):
@@ -575,18 +743,28 @@ class Stock(UserDict):
             return 0
         return self.get('agg_value', 1) / fcf
 
+    @memoized
+    def series(self, key) -> YearSeries:
+        values = attr_or_key_getter(key, self, [])
+        if isinstance(values, YearSeries):
+            return values
+        if values and not isinstance(values[0], (list, tuple)):
+            return self.year_stat(key)
+        return YearSeries(values)
+
     def value_by_year(self, key, year):
-        return first_or_none([v[1]for v in attr_or_key_getter(key, self, []) if v[0] == year])
+        return self.series(key).get(year)
 
     def total_asset_turnover_by(self, year):
-        return first_or_none([v[1]for v in self.get('total_asset_turnover', []) if v[0] == year])
+        return self.series('total_asset_turnover').get(year)
 
     def net_working_capital_by(self, year):
-        return first_or_none([v[1]for v in self.get('net_working_capital', []) if v[0] == year])
+        return self.series('net_working_capital').get(year)
         
     def expected_rate_by_price(self, price: int) -> float:
         return self.calc_expected_rate(self.calc_future_bps, FUTURE, price=price)
 
+    @memoized
     def calc_future_bps(self, future: int) -> int:
         if not self.calculable:
             return 0
@@ -628,6 +806,7 @@ class Stock(UserDict):
             prices.append((i, price))
         return prices
     
+    @memoized
     def fscore(self, year) -> FScore:
         total_issued_stock = 0
         profitable = 0
@@ -636,84 +815,148 @@ class Stock(UserDict):
         TIs = self.get('TIs', [])
         if len(TIs) > 2 and len(set(TIs)) <= 1:
             total_issued_stock = 1
-        NPs = self.year_stat('NPs')
-        year_profit = [p[1] for p in NPs if p[0] == year]
-        if len(year_profit) > 0 and year_profit[0] > 0:
+        year_profit = self.year_stat('NPs').get(year)
+        if year_profit is not None and year_profit > 0:
             profitable = 1
-        CFOs = self.CFOs
-        if len(CFOs) > 0:
-            if type(CFOs[0]) is int:
-                CFOs = self.year_stat('CFOs')
-            year_cfo = [c[1] for c in CFOs if c[0] == year]
-            if len(year_cfo) > 0 and year_cfo[0] > 0:
-                cfo = 1
+        year_cfo = self.series('CFOs').get(year)
+        if year_cfo is not None and year_cfo > 0:
+            cfo = 1
         
         return FScore(total_issued_stock=total_issued_stock, profitable=profitable, cfo=cfo)
 
-    def year_stat(self, stat, exclude_future=False) -> List[Tuple[int, Optional[float]]]:
+    @memoized
+    def year_stat(self, stat, exclude_future=False) -> YearSeries:
         stats = self.get(stat)
         if not stats:
-            return [(0, 0)]
+            return YearSeries([(0, 0)])
+        if exclude_future:
+            return self.year_stat(stat).past()
         
         last_year_index = self.get('last_year_index')
         assert(last_year_index is not None)
         if len(stats) < last_year_index:
-            year = lambda idx: LAST_YEAR - len(stats) + idx + 1
-            return [(year(idx), value) for idx, value in enumerate(stats) 
-                if not exclude_future or year(idx) <= LAST_YEAR]
+            first_year = LAST_YEAR - len(stats) + 1
         else:
-            year = lambda idx: LAST_YEAR - (last_year_index - idx)
-            return [(year(idx), value) for idx, value in enumerate(stats) 
-                if not exclude_future or year(idx) <= LAST_YEAR]
+            first_year = LAST_YEAR - last_year_index
+        return YearSeries((first_year + idx, value) for idx, value in enumerate(stats))
 
     def __str__(self) -> str:
         return '{} : {}'.format(self['title'], self['code'])
 
 
+def is_pushable(key: str, materialized: bool) -> bool:
+    return key in field_aliases or key in stored_keys or (materialized and key in derived_keys)
+
+
+def filter_option_predicate(filter_option: FilterOption) -> dict:
+    key = field_aliases.get(filter_option.key, filter_option.key)
+    if filter_option.is_boolean:
+        return {key: True}
+    condition = {'$gte' if filter_option.morethan else '$lte': filter_option.value}
+    default = stored_defaults.get(key)
+    if default is not None and (default >= filter_option.value if filter_option.morethan else default <= filter_option.value):
+        return {'$or': [{key: condition}, {key: None}]}
+    return {key: condition}
+
+
+def plan_filter_options(filter_options: List[FilterOption], materialized: bool) -> Tuple[List[dict], List[FilterOption]]:
+    predicates = [filter_option_predicate(o) for o in filter_options if is_pushable(o.key, materialized)]
+    remaining = [o for o in filter_options if not is_pushable(o.key, materialized)]
+    return predicates, remaining
+
+
+def universe_columns() -> set:
+    import universe
+    return universe.COLUMNS
+
+
+def universe_predicate(filter_options: List[FilterOption], filter_by_expected_rate: bool, filter_bad: bool) -> dict:
+    import universe
+    columns = universe.current()
+    mask = columns.mask(filter_options)
+    if filter_by_expected_rate:
+        mask &= columns.sign_mask('expected_rate', filter_bad)
+    return {'code': {'$in': columns.codes_where(mask)}}
+
+
 def make_filter_option_func(filter_option):
     def filter_option_func(s):
-        v = getattr(Stock(s), filter_option.key)
+        v = getattr(s if isinstance(s, Stock) else Stock(s), filter_option.key)
         if filter_option.is_boolean:
             return v
         return v >= filter_option.value if filter_option.morethan else v <= filter_option.value
     return filter_option_func
 
 
-def update_rank_by(stocks: List[Stock], key: str, rank_key: str, reverse: bool):
-    countable = [s for s in stocks if attr_or_key_getter(key, s, default_value=None) and attr_or_key_getter(key, s, default_value=None) > 0]
-    for idx, stock in enumerate(sorted(countable, key=partial(attr_or_key_getter, key), reverse=reverse)):
-        stock[rank_key] = idx + 1
-        save_stock(stock)
-    uncountable = [s for s in stocks if not attr_or_key_getter(key, s, default_value=None) or attr_or_key_getter(key, s, default_value=None) < 0]
-    for stock in uncountable:
-        stock[rank_key] = len(stocks)
-        save_stock(stock)
-    
+def rank_values(values: List, reverse: bool) -> List[int]:
+    countable = [i for i, v in enumerate(values) if v and v > 0]
+    ranks = [len(values)] * len(values)
+    for rank, i in enumerate(sorted(countable, key=values.__getitem__, reverse=reverse)):
+        ranks[i] = rank + 1
+    return ranks
+
 
 def update_ranks():
-    stocks = [Stock(s) for s in db.stocks.find()]
-    update_rank_by(stocks, 'last_year_gpa', 'rank_last_year_gpa', reverse=True)
-    update_rank_by(stocks, 'agg_value', 'agg_rank', reverse=True)
-    update_rank_by(stocks, 'pbr', 'rank_pbr', reverse=False)
-    update_rank_by(stocks, 'per', 'rank_per', reverse=False)
-    update_rank_by(stocks, 'dividend_rate', 'rank_dividend', reverse=True)
-    update_rank_by(stocks, 'beta', 'rank_beta', reverse=False)
-    update_rank_by(stocks, 'floating_rate', 'rank_floating_rate', reverse=True)
-    update_rank_by(stocks, 'foreigner_weight', 'rank_foreigner_weight', reverse=True)
-    update_rank_by(stocks, 'month1', 'rank_month1', reverse=True)
-    update_rank_by(stocks, 'month3', 'rank_month3', reverse=True)
-    update_rank_by(stocks, 'month6', 'rank_month3', reverse=True)
-    update_rank_by(stocks, 'month12', 'rank_month3', reverse=True)
-    update_rank_by(stocks, 'relative_earning_rate', 'rank_relative_earning_rate', reverse=True)
-    update_rank_by(stocks, 'NCAV_ratio', 'rank_ncav', reverse=True)
-    update_rank_by(stocks, 'mean_ROIC', 'rank_roic', reverse=True)
-    update_rank_by(stocks, 'current_ratio_last_year', 'rank_current_ratio', reverse=True)
-    update_rank_by(stocks, 'last_year_pcr', 'rank_last_year_pcr', reverse=False)
-    update_rank_by(stocks, 'last_year_psr', 'rank_last_year_psr', reverse=False)
-    update_rank_by(stocks, 'last_year_pfr', 'rank_last_year_pfr', reverse=False)
-
-def all_stocks(order_by='title', ordering='asc', find=None, filter_by_expected_rate=True, filter_bad=True, filter_options=[], rank_options=[]) -> List[Stock]:
-    stocks = [Stock(dict) for dict in (db.stocks.find(find) if find else db.stocks.find())]
+    import universe
+    documents = list(db.stocks.find())
+    if not documents:
+        return
+    stocks = [Stock(d) for d in documents]
+    columns = universe.StockUniverse(documents)
+    ranks = [{} for _ in stocks]
+    for spec in rank_specs:
+        if spec.key in universe.COLUMNS:
+            spec_ranks = columns.rank(spec.key, spec.reverse).tolist()
+        else:
+            spec_ranks = rank_values([attr_or_key_getter(spec.key, s, default_value=None) for s in stocks], spec.reverse)
+        for stock_ranks, rank in zip(ranks, spec_ranks):
+            stock_ranks[spec.rank_key] = rank
+    operations = [UpdateOne({'code': s['code']}, {'$set': {**derived_values(s), **r}}) for s, r in zip(stocks, ranks)]
+    db.stocks.bulk_write(operations, ordered=False)
+    bump_data_version(materialized=True)
+    ensure_indexes()
+
+
+def derived_values(stock: Stock) -> dict:
+    values = {'derived_version': DERIVED_VERSION}
+    for key in derived_keys:
+        try:
+            values[key] = getattr(stock, key)
+        except (ArithmeticError, LookupError, TypeError, ValueError, AssertionError):
+            values[key] = None
+    return values
+
+
+def materialize_stocks(find=None):
+    operations = [UpdateOne({'code': s['code']}, {'$set': derived_values(Stock(s))}) for s in db.stocks.find(find or {})]
+    if operations:
+        db.stocks.bulk_write(operations, ordered=False)
+        bump_data_version(materialized=True if find is None else None)
+
+
+def is_materialized() -> bool:
+    meta = recent_meta()
+    if 'derived_version' in meta:
+        return meta['derived_version'] == DERIVED_VERSION
+    materialized = db.stocks.find_one({'derived_version': {'$ne': DERIVED_VERSION}}, projection={'_id': 1}) is None
+    if materialized:
+        db.meta.update_one({'_id': 'data_version'}, {'$set': {'derived_version': DERIVED_VERSION}}, upsert=True)
+        meta_snapshot.clear()
+    return materialized
+
+
+def ensure_indexes():
+    filter_keys = [field_aliases.get(o.key, o.key) for o in available_filter_options if is_pushable(o.key, True)]
+    for key in indexed_keys + [k for k in filter_keys if k not in indexed_keys]:
+        db.stocks.create_index(key)
+    db.etf.create_index('code')
+    db.etf.create_index('type')
+    db.etf_stats.create_index('type', unique=True)
+
+
+def stock_query(find=None, filter_by_expected_rate=True, filter_bad=True, filter_options=[], rank_options=[]) -> Tuple[dict, List[FunctionType], bool]:
+    materialized = is_materialized()
+    predicates = [find] if find else []
 
     filter_funcs = []
 
@@ -721,41 +964,233 @@ def all_stocks(order_by='title', ordering='asc', find=None, filter_by_expected_r
         filter_by_expected_rate = False
         filter_bad = False
 
-    if filter_by_expected_rate:
-        filter_by_expected_rate_func = lambda s: (s.expected_rate > 0 and filter_bad) or (s.expected_rate < 0 and not filter_bad)
-        filter_funcs.append(filter_by_expected_rate_func)
+    if filter_by_expected_rate and materialized:
+        predicates.append({'expected_rate': {'$gt': 0} if filter_bad else {'$lt': 0}})
     
+    pushed, filter_options = plan_filter_options(filter_options, materialized)
+    predicates += pushed
+    if not materialized:
+        columnar = [o for o in filter_options if o.key in universe_columns()]
+        filter_options = [o for o in filter_options if o.key not in universe_columns()]
+        if columnar or filter_by_expected_rate:
+            predicates.append(universe_predicate(columnar, filter_by_expected_rate, filter_bad))
     for filter_option in filter_options:
         filter_funcs.append(make_filter_option_func(filter_option))
 
-    stocks = sorted([s for s in stocks if all(list(map(FunctionType.__call__, filter_funcs, repeat(s))))],
-        key=partial(attr_or_key_getter, order_by), reverse=(ordering != 'asc'))
+    query = {'$and': predicates} if predicates else {}
+    return query, filter_funcs, materialized
+
+
+def is_sortable(order_by: str, materialized: bool) -> bool:
+    return materialized and (order_by in derived_keys or order_by in stored_keys)
+
+
+def descending(a, b) -> int:
+    return (a < b) - (a > b)
+
+
+def order_key(order_by: str, reverse: bool):
+    getter = partial(attr_or_key_getter, order_by)
+    if not reverse:
+        return getter
+    inverse = cmp_to_key(descending)
+    return lambda stock: inverse(getter(stock))
+
+
+def top_ranked(query: dict, filter_funcs: List[FunctionType], rank_options: List[RankOption], limit: int,
+        order_by: str, reverse: bool, materialized: bool) -> Tuple[List[Stock], int]:
+    import ranking
+    engine = ranking.synced_engine()
+    total_rank = lambda s: engine.combined(s['code'], rank_options)
+    if is_sortable(order_by, materialized):
+        sort = [(order_by, DESCENDING if reverse else ASCENDING)]
+        projection = None if filter_funcs else ['code']
+        candidates = map(Stock, db.stocks.find(query, projection=projection, sort=sort))
+        rank = total_rank
+    else:
+        projection = None
+        candidates = map(Stock, db.stocks.find(query))
+        tie = order_key(order_by, reverse)
+        rank = lambda s: (total_rank(s), tie(s))
+    matched = 0
+
+    def counted(stocks):
+        nonlocal matched
+        for stock in stocks:
+            matched += 1
+            yield stock
+
+    candidates = (s for s in candidates if all(list(map(FunctionType.__call__, filter_funcs, repeat(s)))))
+    top = heapq.nsmallest(limit, counted(candidates), key=rank)
+
+    if projection:
+        codes = [s['code'] for s in top]
+        docs = {d['code']: d for d in db.stocks.find({'code': {'$in': codes}})}
+        top = [Stock(docs[code]) for code in codes if code in docs]
+    for stock in top:
+        stock.update(engine.ranks(stock['code']))
+        stock['total_rank'] = total_rank(stock)
+    return top, matched
+
+
+def all_stocks(order_by='title', ordering='asc', find=None, filter_by_expected_rate=True, filter_bad=True, filter_options=[], rank_options=[], limit: int=None) -> List[Stock]:
+    query, filter_funcs, materialized = stock_query(find, filter_by_expected_rate, filter_bad, filter_options, rank_options)
+    reverse = ordering != 'asc'
+    if rank_options and limit:
+        return top_ranked(query, filter_funcs, rank_options, limit, order_by, reverse, materialized)[0]
+    if is_sortable(order_by, materialized):
+        cursor = db.stocks.find(query, sort=[(order_by, DESCENDING if reverse else ASCENDING)])
+        stocks = [s for s in map(Stock, cursor) if all(list(map(FunctionType.__call__, filter_funcs, repeat(s))))]
+    else:
+        stocks = [Stock(dict) for dict in db.stocks.find(query)]
+        stocks = sorted([s for s in stocks if all(list(map(FunctionType.__call__, filter_funcs, repeat(s))))],
+            key=partial(attr_or_key_getter, order_by), reverse=reverse)
 
     if rank_options:
+        import ranking
+        engine = ranking.synced_engine()
         for stock in stocks:
-            stock['total_rank'] = sum([stock.get(r.key) for r in rank_options])
+            stock.update(engine.ranks(stock['code']))
+            stock['total_rank'] = engine.combined(stock['code'], rank_options)
         return sorted(stocks, key=partial(attr_or_key_getter, 'total_rank'), reverse=False)
 
     return stocks
 
 
+def encode_cursor(position: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError):
+        return {}
+
+
+def keyset_predicate(order_by: str, reverse: bool, value, code: str) -> dict:
+    same = {order_by: value, 'code': {'$gt': code}}
+    if value is None:
+        return same if reverse else {'$or': [same, {order_by: {'$ne': None}}]}
+    if reverse:
+        return {'$or': [{order_by: {'$lt': value}}, same, {order_by: None}]}
+    return {'$or': [{order_by: {'$gt': value}}, same]}
+
+
+def stocks_page(cursor: str=None, limit: int=PAGE_SIZE, order_by='title', ordering='asc', find=None,
+        filter_by_expected_rate=True, filter_bad=True, filter_options=[], rank_options=[]) -> Tuple[List[Stock], Optional[str], int]:
+    position = decode_cursor(cursor) if cursor else {}
+    query, filter_funcs, materialized = stock_query(find, filter_by_expected_rate, filter_bad, filter_options, rank_options)
+    reverse = ordering != 'asc'
+
+    if is_sortable(order_by, materialized) and not filter_funcs and not rank_options:
+        total = db.stocks.count_documents(query)
+        if 'code' in position:
+            query = {'$and': [query, keyset_predicate(order_by, reverse, position.get('value'), position['code'])]}
+        sort = [(order_by, DESCENDING if reverse else ASCENDING), ('code', ASCENDING)]
+        stocks = [Stock(s) for s in db.stocks.find(query, sort=sort, limit=limit + 1)]
+        if len(stocks) <= limit:
+            return stocks, None, total
+        last = stocks[limit - 1]
+        return stocks[:limit], encode_cursor({'value': last.get(order_by), 'code': last['code']}), total
+
+    offset = position.get('offset', 0)
+    if rank_options:
+        stocks, total = top_ranked(query, filter_funcs, rank_options, offset + limit + 1, order_by, reverse, materialized)
+    else:
+        stocks = all_stocks(order_by=order_by, ordering=ordering, find=find, filter_by_expected_rate=filter_by_expected_rate,
+            filter_bad=filter_bad, filter_options=filter_options)
+        total = len(stocks)
+    next_cursor = encode_cursor({'offset': offset + limit}) if len(stocks) > offset + limit else None
+    return stocks[offset:offset + limit], next_cursor, total
+
+
 def stock_by_code(code) -> Stock:
     return Stock(db.stocks.find_one({'code': code}))
 
 
-def save_stock(stock) -> Stock:
-    exist = db.stocks.find_one({'code': stock['code']})
-    if exist:
-        print("update:" ,stock)
-        db.stocks.update_one({'code': exist['code']}, {'$set': stock})
-    else:
-        db.stocks.insert_one(stock)
-    return stock_by_code(stock['code'])
+meta_snapshot = {}
+
+
+def read_meta() -> dict:
+    meta = db.meta.find_one({'_id': 'data_version'}) or {}
+    meta_snapshot.update(at=time.monotonic(), meta=meta)
+    return meta
+
+
+def recent_meta() -> dict:
+    if time.monotonic() - meta_snapshot.get('at', float('-inf')) < META_MAX_AGE:
+        return meta_snapshot['meta']
+    return read_meta()
+
+
+def data_version() -> int:
+    return read_meta().get('version', 0)
+
+
+def bump_data_version(materialized: bool=None):
+    update = {'$inc': {'version': 1}, '$currentDate': {'updated_at': True}}
+    if materialized:
+        update['$set'] = {'derived_version': DERIVED_VERSION}
+    elif materialized is False:
+        update['$unset'] = {'derived_version': 1}
+    db.meta.update_one({'_id': 'data_version'}, update, upsert=True)
+    meta_snapshot.clear()
+
+
+def stamped(values: dict) -> dict:
+    return {'$set': values, '$currentDate': {'updated_at': True}}
+
+
+def save_stock(stock, read_back=True) -> Stock:
+    print("update:" ,stock)
+    db.stocks.update_one({'code': stock['code']}, stamped({k: v for k, v in stock.items() if k != 'updated_at'}), upsert=True)
+    materialize_stocks({'code': stock['code']})
+    return stock_by_code(stock['code']) if read_back else None
+
+
+class StockWriter:
+    def __init__(self, batch_size: int=BULK_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.pending = {}
+        self.committed = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def save(self, stock):
+        with self.lock:
+            merged = self.pending.setdefault(stock['code'], {})
+            merged.update({k: v for k, v in stock.items() if k not in ('_id', 'updated_at')})
+
+    def commit(self, code: str):
+        with self.lock:
+            if code in self.pending and code not in self.committed:
+                self.committed.append(code)
+            if len(self.committed) >= self.batch_size:
+                self.write(self.committed)
+
+    def flush(self):
+        with self.lock:
+            self.write(list(self.pending.keys()))
+
+    def write(self, codes: List[str]):
+        operations = [UpdateOne({'code': code}, stamped(self.pending.pop(code)), upsert=True) for code in codes]
+        self.committed = [code for code in self.committed if code in self.pending]
+        if operations:
+            print('{} 종목 저장'.format(len(operations)))
+            db.stocks.bulk_write(operations, ordered=False)
+            materialize_stocks({'code': {'$in': codes}})
 
 
 def unset_keys(keys_to_unsets):
     for key in keys_to_unsets:
-        db.stocks.update({}, {'$unset':{key: 1}}, multi=True)
+        db.stocks.update_many({}, {'$unset':{key: 1}})
+    bump_data_version()
 
 
 def all_filters():
@@ -770,17 +1205,23 @@ def filter_by_id(filter_id) -> Filter:
 def save_filter(filter):
     filter_id = filter.get('_id', None)
     if filter_id:
-        return db.filters.update_one({'_id': ObjectId(filter_id)}, {'$set': filter}).upserted_id
+        saved = db.filters.update_one({'_id': ObjectId(filter_id)}, {'$set': filter}).upserted_id
     else:
-        return db.filters.insert_one(filter).inserted_id
+        saved = db.filters.insert_one(filter).inserted_id
+    bump_data_version()
+    return saved
 
 
 def remove_filter(filter_id):
     db.filters.delete_one({'_id': ObjectId(filter_id)})
+    bump_data_version()
 
 
 def remove_stock(code):
-    db.stocks.remove({'code': code})
+    import ranking
+    db.stocks.delete_one({'code': code})
+    ranking.shared.remove(code)
+    bump_data_version()
 
 
 def save_prices(prices):
@@ -796,15 +1237,42 @@ def get_prices(code):
 
 
 def save_etf(etf) -> ETF:
-    exist = db.etf.find_one({'code': etf['code']})
-    if exist:
-        print("update:" ,etf)
-        db.etf.update_one({'code': exist['code']}, {'$set': etf})
-    else:
-        db.etf.insert_one(etf)
+    print("update:" ,etf)
+    db.etf.update_one({'code': etf['code']}, {'$set': etf}, upsert=True)
+    bump_data_version()
     return etf_by_code(etf['code'])
 
 
+class ETFWriter:
+    def __init__(self, batch_size: int=BULK_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def save(self, etf):
+        with self.lock:
+            self.pending.append(UpdateOne({'code': etf['code']}, {'$set': etf}, upsert=True))
+            if len(self.pending) >= self.batch_size:
+                self.write()
+
+    def flush(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        operations, self.pending = self.pending, []
+        if operations:
+            print('{} ETF 저장'.format(len(operations)))
+            db.etf.bulk_write(operations, ordered=False)
+            bump_data_version()
+
+
 def etf_by_code(code) -> ETF:
     return ETF(db.etf.find_one({'code': code}))
 
@@ -812,4 +1280,37 @@ def etf_by_code(code) -> ETF:
 def all_etf(order_by='title', ordering='asc', etf_type='domestic'):
     ETFs = [ETF(dict) for dict in db.etf.find({'type': etf_type})]
     ETFs = sorted(ETFs, key=partial(attr_or_key_getter, order_by), reverse=(ordering != 'asc'))
-    return ETFs
\ No newline at end of file
+    return ETFs
+
+
+def etf_tags(etfs: List[ETF]) -> List[ETFTag]:
+    tags = defaultdict(list)
+    for etf in etfs:
+        for tag in etf.get('tags'):
+            tags[tag].append(etf)
+    return [ETFTag(k, v) for k, v in tags.items()]
+
+
+def materialize_etf_stats(etf_type: str) -> dict:
+    momentum_base = ETF_MOMENTUM_BASES.get(etf_type, 'month6')
+    etfs = [ETF(d) for d in db.etf.find({'type': etf_type})]
+    etfs_by_momentum_base = sorted([etf for etf in etfs if etf[momentum_base] != 0], key=lambda x: x[momentum_base], reverse=True)
+    no_bond_etfs = [etf for etf in etfs_by_momentum_base if etf['code'] not in BOND_ETFS]
+    tags = sorted(etf_tags(etfs), key=lambda t: getattr(t, momentum_base), reverse=True)
+
+    stats = {
+        'type': etf_type,
+        'momentum_base': momentum_base,
+        'tags': [tag.to_stats() for tag in tags],
+        'absolute_momentum_momentum_base_avg': mean_or_zero([etf[momentum_base] for etf in no_bond_etfs]),
+        'absolute_momentum_high': first_or_none(no_bond_etfs),
+        'relative_momentum_etf': first_or_none(etfs_by_momentum_base),
+        'updated_at': datetime.now(),
+    }
+    db.etf_stats.replace_one({'type': etf_type}, {k: v.data if isinstance(v, ETF) else v for k, v in stats.items()}, upsert=True)
+    bump_data_version()
+    return stats
+
+
+def etf_stats(etf_type: str) -> Optional[dict]:
+    return db.etf_stats.find_one({'type': etf_type})
\ No newline at end of file
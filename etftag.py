@@ -1,23 +1,30 @@
 from utils import mean_or_zero
 
 
+MOMENTUM_KEYS = ['month1', 'month3', 'month6', 'month12']
+
+
 class ETFTag:
-    def __init__(self, tag, etfs=[]):
+    def __init__(self, tag, etfs=[], averages=None):
         self.tag = tag
         self.etfs = sorted(etfs, key=lambda e: e.get('month3', 0), reverse=True)
+        averages = averages or {key: mean_or_zero([etf[key] for etf in self.etfs]) for key in MOMENTUM_KEYS}
+        self.month1 = averages['month1']
+        self.month3 = averages['month3']
+        self.month6 = averages['month6']
+        self.month12 = averages['month12']
 
-    @property
-    def month1(self):
-        return mean_or_zero([etf['month1'] for etf in self.etfs])
-
-    @property
-    def month3(self):
-        return mean_or_zero([etf['month3'] for etf in self.etfs])
-    
-    @property
-    def month6(self):
-        return mean_or_zero([etf['month6'] for etf in self.etfs])
+    @classmethod
+    def from_stats(cls, stats: dict, etfs_by_code: dict) -> 'ETFTag':
+        etfs = [etfs_by_code[code] for code in stats['codes'] if code in etfs_by_code]
+        return cls(stats['tag'], etfs, averages=stats)
 
-    @property
-    def month12(self):
-        return mean_or_zero([etf['month12'] for etf in self.etfs])
\ No newline at end of file
+    def to_stats(self) -> dict:
+        return {
+            'tag': self.tag,
+            'month1': self.month1,
+            'month3': self.month3,
+            'month6': self.month6,
+            'month12': self.month12,
+            'codes': [etf['code'] for etf in self.etfs],
+        }
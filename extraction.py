@@ -0,0 +1,57 @@
+from typing import Callable, Dict, List, Optional
+from collections import namedtuple
+
+from lxml import etree
+
+from utils import first_or_none
+
+
+Field = namedtuple('Field', ['path', 'convert'])
+
+
+def identity(value):
+    return value
+
+
+def first(convert: Callable=identity) -> Callable:
+    return lambda values: convert(first_or_none(values))
+
+
+def optional(convert: Callable) -> Callable:
+    return lambda value: None if value is None else convert(value)
+
+
+def first_text(convert: Callable=identity) -> Callable:
+    return lambda elements: convert(elements[0].text) if elements else None
+
+
+def each(convert: Callable=identity) -> Callable:
+    return lambda values: [convert(v) for v in values]
+
+
+class Spec:
+    def __init__(self, anchor: str, fields: Dict[str, Field], required: bool=False):
+        self.anchor = etree.XPath(anchor)
+        self.fields = [(key, etree.XPath(field.path), field.convert) for key, field in fields.items()]
+        self.required = required
+
+    def locate(self, tree):
+        return first_or_none(self.anchor(tree))
+
+    def extract(self, tree) -> Optional[dict]:
+        anchor = self.locate(tree)
+        if anchor is None:
+            if self.required:
+                return None
+            return {key: convert([]) for key, _, convert in self.fields}
+        return {key: convert(path(anchor)) for key, path, convert in self.fields}
+
+
+def extract_all(tree, specs: List[Spec]) -> Optional[dict]:
+    values = {}
+    for spec in specs:
+        extracted = spec.extract(tree)
+        if extracted is None:
+            return None
+        values.update(extracted)
+    return values
@@ -0,0 +1,216 @@
+import os
+import time
+import json
+import gzip
+import hashlib
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+TIMEOUT = (5, 30)
+POOL_SIZE = 16
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = [500, 502, 503, 504]
+HEADERS = {
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+}
+
+CACHE_DIR = os.path.join('.cache', 'http')
+CACHE_OFF = 'off'
+CACHE_ON = 'on'
+CACHE_REPLAY = 'replay'
+DEFAULT_CACHE_TTL = 60 * 60
+CACHE_TTLS = {
+    'finance-service.daum.net': 10 * 60,
+    'finance.naver.com': 10 * 60,
+    'comp.fnguide.com': 6 * 60 * 60,
+    'companyinfo.stock.naver.com': 24 * 60 * 60,
+    'stock.kakao.com': 6 * 60 * 60,
+}
+
+DEFAULT_MIN_INTERVAL = 0.5
+HOST_MIN_INTERVALS = {
+    'finance-service.daum.net': 0.3,
+    'comp.fnguide.com': 0.2,
+    'companyinfo.stock.naver.com': 0.3,
+    'finance.naver.com': 0.3,
+}
+
+
+class RateLimiter:
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self.next_at = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_at)
+            self.next_at = at + self.min_interval
+        if at > now:
+            time.sleep(at - now)
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def host_of(url: str) -> str:
+    return urlparse(url).netloc
+
+
+def limiter_for(host: str) -> RateLimiter:
+    with limiters_lock:
+        if host not in limiters:
+            limiters[host] = RateLimiter(HOST_MIN_INTERVALS.get(host, DEFAULT_MIN_INTERVAL))
+        return limiters[host]
+
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def make_session() -> requests.Session:
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def session_for(host: str) -> requests.Session:
+    with sessions_lock:
+        if host not in sessions:
+            sessions[host] = make_session()
+        return sessions[host]
+
+
+class CacheMiss(Exception):
+    pass
+
+
+cache_mode = CACHE_OFF
+
+
+def configure_cache(mode: str):
+    global cache_mode
+    assert(mode in [CACHE_OFF, CACHE_ON, CACHE_REPLAY])
+    cache_mode = mode
+
+
+def sha1(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def meta_path(url: str) -> str:
+    key = sha1(url.encode())
+    return os.path.join(CACHE_DIR, 'meta', key[:2], key + '.json')
+
+
+def body_path(digest: str) -> str:
+    return os.path.join(CACHE_DIR, 'body', digest[:2], digest + '.gz')
+
+
+def write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def load_entry(url: str) -> dict:
+    try:
+        with open(meta_path(url), 'rb') as f:
+            return json.loads(f.read().decode())
+    except (OSError, ValueError):
+        return None
+
+
+def load_body(entry: dict) -> bytes:
+    try:
+        with open(body_path(entry['body']), 'rb') as f:
+            return gzip.decompress(f.read())
+    except OSError:
+        return None
+
+
+def store_entry(url: str, entry: dict):
+    write_atomic(meta_path(url), json.dumps(entry).encode())
+
+
+def store(url: str, response: requests.Response):
+    digest = sha1(response.content)
+    if not os.path.exists(body_path(digest)):
+        write_atomic(body_path(digest), gzip.compress(response.content))
+    store_entry(url, {
+        'url': url,
+        'body': digest,
+        'fetched_at': time.time(),
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    })
+
+
+def is_fresh(entry: dict, host: str) -> bool:
+    return time.time() - entry['fetched_at'] < CACHE_TTLS.get(host, DEFAULT_CACHE_TTL)
+
+
+def revalidation_headers(entry: dict) -> dict:
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def backoff(attempt: int):
+    time.sleep(BACKOFF_FACTOR * (2 ** attempt))
+
+
+def request(url: str, headers: dict=None) -> requests.Response:
+    host = host_of(url)
+    for attempt in range(RETRIES + 1):
+        limiter_for(host).wait()
+        try:
+            response = session_for(host).get(url, headers=headers, timeout=TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == RETRIES:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == RETRIES:
+                response.raise_for_status()
+                return response
+        backoff(attempt)
+
+
+def get(url: str) -> bytes:
+    if cache_mode == CACHE_OFF:
+        return request(url).content
+
+    entry = load_entry(url)
+    body = load_body(entry) if entry else None
+    if body is not None and (cache_mode == CACHE_REPLAY or is_fresh(entry, host_of(url))):
+        return body
+    if cache_mode == CACHE_REPLAY:
+        raise CacheMiss(url)
+
+    response = request(url, headers=revalidation_headers(entry) if body is not None else None)
+    if response.status_code == 304:
+        entry['fetched_at'] = time.time()
+        store_entry(url, entry)
+        return body
+    store(url, response)
+    return response.content
+
+
+def get_json(url: str):
+    return json.loads(get(url).decode())
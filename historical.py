@@ -1,64 +1,86 @@
 from typing import List, Optional, Tuple
 from datetime import datetime, timedelta
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from statistics import mean
 import itertools
-
-import urllib.request
+import threading
+import hashlib
 import json
 
+import numpy as np
+
 from db import Stock
 import db
+import fetcher
+import pricestore
 
 
 KAKAO_DAY_CANDLES = "http://stock.kakao.com/api/securities/KOREA-A%s/day_candles.json?limit=%d&to=%s"
+MAX_CANDLES = 90000
+RECORDS_CACHE_SIZE = 32
+FUNDAMENTAL_KEYS = ['BPSs', 'ROEs', 'last_year_index']
 
 
-now = datetime.now()
-THIS_YEAR = now.year
-TODAY = now.strftime('%Y-%m-%d')
-YESTERDAY = (now - timedelta(days=1)).strftime('%Y-%m-%d')
-TWO_YEARS_AGO = now.replace(year=now.year-2, month=1, day=1).strftime('%Y-%m-%d')
+synced_on = {}
+records_cache = OrderedDict()
+records_cache_lock = threading.Lock()
 
 
 Record = namedtuple('Record', ['date', 'price', 'expected_rate', 'bps', 'fROE'])
 YearStat = namedtuple('YearStat', ['year', 'high_price', 'low_price', 'high_expected_rate', 'low_expected_rate', 'bps', 'fROE'])
 Event = namedtuple('Event', ['date', 'record', 'buy'])
 EventStat = namedtuple('EventStat', ['buy_count', 'sell_count', 'profit'])
+CachedRecords = namedtuple('CachedRecords', ['version', 'last_date', 'by_year', 'result'])
+SimulationParams = namedtuple('SimulationParams', ['min_expected_rate', 'sell_drop', 'take_profit'])
+
+DEFAULT_PARAMS = SimulationParams(min_expected_rate=13.5, sell_drop=1.2, take_profit=0.13)
 
 
 def parse_date(date_str: str) -> datetime:
     return datetime.strptime(date_str.split('T')[0], '%Y-%m-%d')
 
 
-def load_kakao_json(code: str, date: str=YESTERDAY) -> List[dict]:
-    url = KAKAO_DAY_CANDLES % (code, 90000, date)
+def yesterday_of(now: datetime) -> str:
+    return (now - timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def load_kakao_json(code: str, date: str=None, limit: int=MAX_CANDLES) -> List[dict]:
+    date = date or yesterday_of(datetime.now())
+    url = KAKAO_DAY_CANDLES % (code, limit, date)
     print(url)
-    urlopen = urllib.request.urlopen(url)
-    data = json.loads(urlopen.read().decode())
+    data = fetcher.get_json(url)
     if 'dayCandles' not in data:
-        return
+        return []
 
     return data['dayCandles']
 
 
-def parse_day_candles(code: str, date: str=YESTERDAY):
-    data = load_kakao_json(code, date)
-    prices = [{'code': code, 'price': d['tradePrice'], 'date': parse_date(d['date'])} for d in data]
+def candles_from(data: List[dict]) -> np.ndarray:
+    return pricestore.to_candles([parse_date(d['date']).date() for d in data], [d['tradePrice'] for d in data])
+
 
-    first_date = prices[-1]['date']
+def parse_day_candles(code: str, date: str=None):
+    date = date or yesterday_of(datetime.now())
+    last = pricestore.last_date(code)
+    if last is None:
+        pricestore.backfill(code, db.get_prices(code))
+        last = pricestore.last_date(code)
+
+    if last is not None:
+        limit = (parse_date(date).date() - last).days
+        if limit > 0:
+            pricestore.append(code, candles_from(load_kakao_json(code, date, limit=limit)))
+        return
+
+    candles = candles_from(load_kakao_json(code, date))
+    if not len(candles):
+        return
+    first_date = candles['date'][0].item()
     if first_date.month != 1 and first_date.day != 1:
         yesterday_of_first = first_date - timedelta(days=1)
-        data = load_kakao_json(code, date=yesterday_of_first.strftime('%Y-%m-%d'))
-        old = [{'code': code, 'price': d['tradePrice'], 'date': parse_date(d['date'])} for d in data]
-        prices = old + prices
-
-    latest = db.get_latest_price(code)
-    if latest:
-        prices = [p for p in prices if p['date'] > latest['date']]
-    
-    if prices:
-        db.save_prices(prices)
+        old = candles_from(load_kakao_json(code, date=yesterday_of_first.strftime('%Y-%m-%d')))
+        candles = np.concatenate([old, candles])
+    pricestore.append(code, candles)
 
 
 def make_record(date, price, bps, stock) -> Record:
@@ -75,22 +97,24 @@ def make_record(date, price, bps, stock) -> Record:
     return Record(date=date, price=price, expected_rate=expected_rate, bps=bps, fROE=future_roe)    
 
 
-def build_records(stock: Stock) -> List[Record]:
-    prices = db.get_prices(stock['code'])
-    if not prices:
-        parse_day_candles(stock['code'])
-        prices = db.get_prices(stock['code'])
-    else:
-        last_date = prices[-1]['date']
-        if last_date.strftime('%Y-%m-%d') != YESTERDAY:
-            prices = db.get_prices(stock['code'])
-    
-    if not prices:
-        return
-    
+def sync_prices(code: str, now: datetime=None):
+    now = now or datetime.now()
+    today = now.strftime('%Y-%m-%d')
+    yesterday = yesterday_of(now)
+    with pricestore.lock_for(code):
+        last = pricestore.last_date(code)
+        if synced_on.get(code) == today or (last and last.strftime('%Y-%m-%d') >= yesterday):
+            return
+        parse_day_candles(code, yesterday)
+        synced_on[code] = today
+
+
+def records_from(stock: Stock, candles: np.ndarray) -> List[Record]:
     BPSs = {b[0]: b[1] for b in stock.year_stat('BPSs', exclude_future=True)}
 
-    return [make_record(p['date'], p['price'], BPSs.get(p['date'].year-1), stock) for p in prices]
+    dates = candles['date'].tolist()
+    prices = candles['close'].tolist()
+    return [make_record(date, price, BPSs.get(date.year-1), stock) for date, price in zip(dates, prices)]
 
 
 def make_year_stat(year: int, records: List[Record]) -> YearStat:
@@ -105,27 +129,88 @@ def make_year_stat(year: int, records: List[Record]) -> YearStat:
     return stat
 
 
-def records_by_year(stock: Stock) -> List[Tuple[YearStat, List[Record]]]:
-    records = build_records(stock)
+def group_by_year(records: List[Record]) -> List[Tuple[YearStat, List[Record]]]:
     by_year = [(k, list(list(g))) for k, g in itertools.groupby(records, lambda r: r.date.year)]
-    by_year = [(make_year_stat(year, records), records) for year, records in by_year]
+    return [(make_year_stat(year, records), records) for year, records in by_year]
+
+
+def extend_by_year(by_year: List[Tuple[YearStat, List[Record]]], records: List[Record]) -> List[Tuple[YearStat, List[Record]]]:
+    if by_year and records and by_year[-1][0].year == records[0].date.year:
+        *by_year, (_, last_records) = by_year
+        records = last_records + records
+    return by_year + group_by_year(records)
+
+
+def fundamentals_version(stock: Stock) -> str:
+    return hashlib.sha1(json.dumps([stock.get(key) for key in FUNDAMENTAL_KEYS], default=str).encode()).hexdigest()
+
+
+def cached_records(code: str, version: str) -> Optional[CachedRecords]:
+    with records_cache_lock:
+        cached = records_cache.get((code, version))
+        if cached:
+            records_cache.move_to_end((code, version))
+        return cached
+
+
+def cache_records(code: str, cached: CachedRecords) -> CachedRecords:
+    with records_cache_lock:
+        for key in [key for key in records_cache if key[0] == code]:
+            del records_cache[key]
+        records_cache[(code, cached.version)] = cached
+        records_cache.move_to_end((code, cached.version))
+        while len(records_cache) > RECORDS_CACHE_SIZE:
+            records_cache.popitem(last=False)
+    return cached
+
+
+def cached_by_year(stock: Stock) -> Optional[CachedRecords]:
+    code = stock['code']
+    sync_prices(code)
+    last = pricestore.last_date(code)
+    if last is None:
+        return None
+    version = fundamentals_version(stock)
+
+    cached = cached_records(code, version)
+    if cached and cached.last_date == last:
+        return cached
+    if cached and cached.last_date < last:
+        candles = pricestore.read_range(code, start=cached.last_date + timedelta(days=1))
+        by_year = extend_by_year(cached.by_year, records_from(stock, candles))
+    else:
+        by_year = group_by_year(records_from(stock, pricestore.read_range(code)))
+
     events = simulate(by_year)
-    return [(year_stat, records, [e for e in events if e.date.year == year_stat.year]) for year_stat, records in by_year]
+    result = [(year_stat, records, [e for e in events if e.date.year == year_stat.year]) for year_stat, records in by_year]
+    return cache_records(code, CachedRecords(version=version, last_date=last, by_year=by_year, result=result))
 
 
-def simulate(by_year: List[Tuple[YearStat, List[Record]]]) -> List[Event]:
+def records_by_year(stock: Stock) -> List[Tuple[YearStat, List[Record], List[Event]]]:
+    cached = cached_by_year(stock)
+    return cached.result if cached else []
+
+
+def simulate(by_year: List[Tuple[YearStat, List[Record]]], params: SimulationParams=DEFAULT_PARAMS) -> List[Event]:
     events = []
     last_buy_event = None
     for year_stat, records in by_year:
         mid_expected_rate = mean([year_stat.high_expected_rate, year_stat.low_expected_rate])
-        if mid_expected_rate < 13.5:
-            mid_expected_rate = 13.5
+        if mid_expected_rate < params.min_expected_rate:
+            mid_expected_rate = params.min_expected_rate
         for r in records:
             if not last_buy_event and r.expected_rate >= mid_expected_rate:
                 last_buy_event = Event(date=r.date, record=r, buy=True)
                 events.append(last_buy_event)
-            if last_buy_event and ((last_buy_event.record.expected_rate - r.expected_rate) >= 1.2
-                or (last_buy_event.record.price * 0.13 + last_buy_event.record.price) <= r.price):
+            if last_buy_event and ((last_buy_event.record.expected_rate - r.expected_rate) >= params.sell_drop
+                or (last_buy_event.record.price * params.take_profit + last_buy_event.record.price) <= r.price):
                 events.append(Event(date=r.date, record=r, buy=False))
                 last_buy_event = None
     return events
+
+
+def event_stat(events: List[Event]) -> EventStat:
+    buys = [e for e in events if e.buy]
+    sells = [e for e in events if not e.buy]
+    profit = sum((sell.record.price / buy.record.price - 1) * 100 for buy, sell in zip(buys, sells) if buy.record.price)
+    return EventStat(buy_count=len(buys), sell_count=len(sells), profit=profit)
@@ -0,0 +1,150 @@
+import time
+from datetime import datetime, timedelta
+from typing import List, Set, Optional
+
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import db
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SNOWBALL = 'snowball'
+REFRESH = 'refresh'
+
+USER_PRIORITY = 100
+
+POLL_INTERVAL = 1.0
+STALE_AFTER = timedelta(minutes=10)
+FAILED_BACKOFF = timedelta(hours=6)
+FINISHED_TTL = timedelta(days=7)
+
+jobs = db.db.jobs
+
+
+def ensure_indexes():
+    jobs.create_index([('code', ASCENDING), ('kind', ASCENDING)], unique=True,
+        partialFilterExpression={'status': QUEUED}, name='queued_once')
+    jobs.create_index([('status', ASCENDING), ('priority', DESCENDING), ('created_at', ASCENDING)])
+    jobs.create_index('finished_at', expireAfterSeconds=int(FINISHED_TTL.total_seconds()))
+
+
+def enqueue(code: str, kind: str=SNOWBALL, priority: int=0, sections: List[str]=None) -> bool:
+    if kind == SNOWBALL:
+        superseded = jobs.find_one_and_delete({'code': code, 'kind': REFRESH, 'status': QUEUED})
+        if superseded:
+            priority = max(priority, superseded.get('priority', 0))
+    elif jobs.find_one({'code': code, 'kind': SNOWBALL, 'status': {'$in': [QUEUED, RUNNING]}}, projection=['_id']):
+        return False
+    now = datetime.utcnow()
+    update = {
+        '$setOnInsert': {'created_at': now, 'attempts': 0},
+        '$max': {'priority': priority},
+    }
+    if sections is not None:
+        update['$addToSet'] = {'sections': {'$each': sections}}
+    query = {'code': code, 'kind': kind, 'status': QUEUED}
+    try:
+        result = jobs.update_one(query, update, upsert=True)
+    except DuplicateKeyError:
+        jobs.update_one(query, update)
+        return False
+    return result.upserted_id is not None
+
+
+def claim() -> Optional[dict]:
+    return jobs.find_one_and_update({'status': QUEUED},
+        {'$set': {'status': RUNNING, 'started_at': datetime.utcnow()}, '$inc': {'attempts': 1}},
+        sort=[('priority', DESCENDING), ('created_at', ASCENDING)], return_document=ReturnDocument.AFTER)
+
+
+def finish(job: dict, error: str=None):
+    jobs.update_one({'_id': job['_id']}, {'$set': {
+        'status': FAILED if error else DONE,
+        'finished_at': datetime.utcnow(),
+        'error': error,
+    }})
+
+
+def requeue_stale(now: datetime=None) -> int:
+    now = now or datetime.utcnow()
+    stale = jobs.find({'status': RUNNING, 'started_at': {'$lt': now - STALE_AFTER}})
+    requeued = 0
+    for job in stale:
+        if enqueue(job['code'], job['kind'], job.get('priority', 0), job.get('sections')):
+            requeued += 1
+        finish(job, error='timeout')
+    return requeued
+
+
+def pending_codes(kind: str=None) -> Set[str]:
+    find = {'status': {'$in': [QUEUED, RUNNING]}}
+    if kind:
+        find['kind'] = kind
+    return {job['code'] for job in jobs.find(find, projection=['code'])}
+
+
+def failed_codes(now: datetime=None) -> Set[str]:
+    now = now or datetime.utcnow()
+    find = {'status': FAILED, 'finished_at': {'$gte': now - FAILED_BACKOFF}}
+    return {job['code'] for job in jobs.find(find, projection=['code'])}
+
+
+def queue_stats(now: datetime=None) -> dict:
+    now = now or datetime.utcnow()
+    queued = jobs.aggregate([
+        {'$match': {'status': QUEUED}},
+        {'$group': {'_id': '$priority', 'depth': {'$sum': 1}, 'oldest': {'$min': '$created_at'}}},
+        {'$sort': {'_id': DESCENDING}},
+    ])
+    by_priority = [{'priority': q['_id'], 'depth': q['depth'], 'lag': (now - q['oldest']).total_seconds()} for q in queued]
+    return {
+        'depth': sum(q['depth'] for q in by_priority),
+        'running': jobs.count_documents({'status': RUNNING}),
+        'lag': max([q['lag'] for q in by_priority], default=0),
+        'by_priority': by_priority,
+    }
+
+
+def latest_job(code: str, kind: str=SNOWBALL) -> Optional[dict]:
+    return jobs.find_one({'code': code, 'kind': kind}, sort=[('created_at', DESCENDING)])
+
+
+def run_job(job: dict):
+    import scrapper
+    if job['kind'] == SNOWBALL:
+        result = scrapper.parse_snowball(job['code'])
+    elif job['kind'] == REFRESH:
+        result = scrapper.parse_snowball(job['code'], stock=db.stock_by_code(job['code']), sections=job.get('sections'))
+    else:
+        raise ValueError('unknown job kind: {}'.format(job['kind']))
+    if result is False:
+        raise RuntimeError('수집 실패')
+
+
+def work_one() -> bool:
+    job = claim()
+    if not job:
+        return False
+    print('작업 {kind} {code} 시작'.format(kind=job['kind'], code=job['code']))
+    try:
+        run_job(job)
+    except Exception as e:
+        print('작업 {} 실패: {!r}'.format(job['code'], e))
+        finish(job, error=repr(e))
+    else:
+        finish(job)
+    return True
+
+
+def run_worker(poll_interval: float=POLL_INTERVAL):
+    ensure_indexes()
+    requeue_stale()
+    print('작업 대기 중...')
+    while True:
+        if not work_one():
+            time.sleep(poll_interval)
@@ -0,0 +1,200 @@
+import os
+import json
+import queue
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from typing import List, Tuple, Dict, Callable, Optional
+
+from lxml import html
+
+import db
+import fetcher
+import scrapper
+from scrapper import CrawlFailure, SECTIONS, SectionWriter
+
+
+QUEUE_SIZE = 32
+PARSE_WORKERS = os.cpu_count() or 2
+CHECKPOINT_DIR = os.path.join('.cache', 'checkpoints')
+
+EXTRACTORS = {
+    'basic': scrapper.extract_basic,
+    'fnguide': scrapper.extract_fnguide,
+    'financial_statements': scrapper.extract_fnguide_financial_statements,
+    'financial_ratio': scrapper.extract_fnguide_financial_ratio,
+    'invest_guide': scrapper.extract_fnguide_invest_guide,
+    'naver_company': scrapper.extract_naver_company,
+}
+
+DONE = object()
+
+
+class Checkpoint:
+    def __init__(self, path: str):
+        self.path = path
+        self.done = set(self.load())
+
+    def load(self) -> List[str]:
+        try:
+            with open(self.path, 'rb') as f:
+                return json.loads(f.read().decode())
+        except (OSError, ValueError):
+            return []
+
+    def mark(self, codes: List[str]):
+        self.done.update(codes)
+        fetcher.write_atomic(self.path, json.dumps(sorted(self.done)).encode())
+
+    def clear(self):
+        self.done = set()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def checkpoint_for(filename: str) -> Checkpoint:
+    return Checkpoint(os.path.join(CHECKPOINT_DIR, os.path.basename(filename) + '.json'))
+
+
+def fetch_pages(code: str, fetch: Callable[[str], bytes]=fetcher.get) -> Optional[Dict[str, bytes]]:
+    pages = {'basic': fetch(scrapper.page_url('basic', code))}
+    if not extract_section('basic', code, pages['basic']):
+        return None
+    for section in SECTIONS[1:]:
+        pages[section] = fetch(scrapper.page_url(section, code))
+    return pages
+
+
+def extract_section(kind: str, code: str, content: bytes) -> Optional[dict]:
+    return EXTRACTORS[kind](html.fromstring(content), code)
+
+
+def extract_pages(code: str, pages: Dict[str, bytes]) -> Optional[List[Tuple[str, dict]]]:
+    basic = extract_section('basic', code, pages['basic'])
+    if not basic:
+        return None
+    results = [('basic', basic)]
+
+    fnguide = extract_section('fnguide', code, pages['fnguide'])
+    if not fnguide:
+        return results
+    results.append(('fnguide', fnguide))
+
+    for section in SECTIONS[2:]:
+        stock = extract_section(section, code, pages[section])
+        if stock:
+            results.append((section, stock))
+    return results
+
+
+def failed_sections(results: List[Tuple[str, dict]]) -> List[str]:
+    saved = dict(results)
+    attempted = SECTIONS if saved.get('fnguide', {}).get('use_fnguide') else SECTIONS[:2]
+    return [section for section in attempted if section not in saved]
+
+
+def parse_pages(code: str, pages: Dict[str, bytes], pool: Executor=None,
+        fetch: Callable[[str], bytes]=fetcher.get) -> Optional[List[Tuple[str, dict]]]:
+    run = (lambda f, *args: pool.submit(f, *args).result()) if pool else (lambda f, *args: f(*args))
+
+    results = run(extract_pages, code, pages)
+    if results is None or any(section == 'fnguide' for section, _ in results):
+        return results
+
+    print('FnGuide 수집실패')
+    naver = run(extract_section, 'naver_company', code, fetch(scrapper.NAVER_COMPANY + code))
+    return results + [('fnguide', naver)] if naver else results
+
+
+def start_stage(inbox: queue.Queue, outbox: queue.Queue, work: Callable, failures: List[CrawlFailure], workers: int) -> List[threading.Thread]:
+    def loop():
+        while True:
+            item = inbox.get()
+            if item is DONE:
+                inbox.put(DONE)
+                return
+            code, payload = item
+            try:
+                result = work(code, payload)
+            except Exception as e:
+                failures.append(CrawlFailure(code=code, reason=repr(e)))
+                continue
+            if result is None:
+                failures.append(CrawlFailure(code=code, reason='수집 실패'))
+                continue
+            outbox.put((code, result))
+
+    threads = [threading.Thread(target=loop, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def close_after(threads: List[threading.Thread], outbox: queue.Queue):
+    def wait():
+        for thread in threads:
+            thread.join()
+        outbox.put(DONE)
+    threading.Thread(target=wait, daemon=True).start()
+
+
+def read_codes(filename: str, checkpoint: Checkpoint, outbox: queue.Queue):
+    skipped = 0
+    for code in scrapper.iter_codes_from_csv(filename):
+        if code in checkpoint.done:
+            skipped += 1
+            continue
+        outbox.put((code, None))
+    if skipped:
+        print('{} 종목은 이전 수집에서 완료되어 건너뜀'.format(skipped))
+    outbox.put(DONE)
+
+
+def write_results(inbox: queue.Queue, checkpoint: Checkpoint, batch_size: int) -> int:
+    written = 0
+    pending = []
+    with db.StockWriter(batch_size=batch_size) as writer:
+        while True:
+            item = inbox.get()
+            if item is DONE:
+                break
+            code, results = item
+            for section, stock in results:
+                SectionWriter(writer, section).save(stock)
+            for section in failed_sections(results):
+                SectionWriter(writer, section).fail(code)
+            pending.append(code)
+            if len(pending) >= batch_size:
+                writer.flush()
+                checkpoint.mark(pending)
+                written += len(pending)
+                pending = []
+    if pending:
+        checkpoint.mark(pending)
+    return written + len(pending)
+
+
+def fill_company(filename: str='company.csv', workers: int=scrapper.DEFAULT_WORKERS,
+        batch_size: int=db.BULK_BATCH_SIZE, resume: bool=True) -> List[CrawlFailure]:
+    checkpoint = checkpoint_for(filename)
+    if not resume:
+        checkpoint.clear()
+
+    codes = queue.Queue(maxsize=QUEUE_SIZE)
+    pages = queue.Queue(maxsize=QUEUE_SIZE)
+    parsed = queue.Queue(maxsize=QUEUE_SIZE)
+    failures = []
+
+    threading.Thread(target=read_codes, args=(filename, checkpoint, codes), daemon=True).start()
+    close_after(start_stage(codes, pages, lambda code, _: fetch_pages(code), failures, workers), pages)
+    with ProcessPoolExecutor(max_workers=PARSE_WORKERS) as pool:
+        close_after(start_stage(pages, parsed, partial(parse_pages, pool=pool), failures, PARSE_WORKERS), parsed)
+        written = write_results(parsed, checkpoint, batch_size)
+
+    print('{} 종목 수집 완료'.format(written))
+    scrapper.report_failures(failures)
+    checkpoint.clear()
+    db.update_ranks()
+    return failures
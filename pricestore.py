@@ -0,0 +1,77 @@
+import os
+import threading
+from typing import List, Optional
+from datetime import date
+
+import numpy as np
+
+
+PRICE_DIR = os.path.join('data', 'prices')
+
+CANDLE = np.dtype([('date', 'datetime64[D]'), ('close', '<f8')])
+EMPTY = np.zeros(0, dtype=CANDLE)
+
+locks = {}
+locks_lock = threading.Lock()
+
+
+def lock_for(code: str) -> threading.RLock:
+    with locks_lock:
+        if code not in locks:
+            locks[code] = threading.RLock()
+        return locks[code]
+
+
+def path_for(code: str) -> str:
+    return os.path.join(PRICE_DIR, code + '.bin')
+
+
+def load(code: str) -> np.ndarray:
+    path = path_for(code)
+    if not os.path.exists(path) or os.path.getsize(path) < CANDLE.itemsize:
+        return EMPTY
+    count = os.path.getsize(path) // CANDLE.itemsize
+    return np.memmap(path, dtype=CANDLE, mode='r', shape=(count,))
+
+
+def last_date(code: str) -> Optional[date]:
+    candles = load(code)
+    if not len(candles):
+        return None
+    return candles['date'][-1].item()
+
+
+def to_candles(dates: List[date], closes: List[float]) -> np.ndarray:
+    candles = np.zeros(len(dates), dtype=CANDLE)
+    candles['date'] = np.array(dates, dtype='datetime64[D]')
+    candles['close'] = closes
+    return np.sort(candles, order='date')
+
+
+def append(code: str, candles: np.ndarray) -> int:
+    with lock_for(code):
+        last = last_date(code)
+        if last is not None:
+            candles = candles[candles['date'] > np.datetime64(last, 'D')]
+        if not len(candles):
+            return 0
+        _, first = np.unique(candles['date'], return_index=True)
+        candles = candles[first]
+        os.makedirs(PRICE_DIR, exist_ok=True)
+        with open(path_for(code), 'ab') as f:
+            f.write(candles.tobytes())
+        return len(candles)
+
+
+def read_range(code: str, start: date=None, end: date=None) -> np.ndarray:
+    candles = load(code)
+    dates = candles['date']
+    lo = np.searchsorted(dates, np.datetime64(start, 'D')) if start else 0
+    hi = np.searchsorted(dates, np.datetime64(end, 'D'), side='right') if end else len(candles)
+    return candles[lo:hi]
+
+
+def backfill(code: str, prices: List[dict]) -> int:
+    if not prices:
+        return 0
+    return append(code, to_candles([p['date'].date() for p in prices], [p['price'] for p in prices]))
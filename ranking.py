@@ -0,0 +1,120 @@
+import threading
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import db
+import universe
+from db import Stock, RankSpec, RankOption, rank_specs
+from utils import attr_or_key_getter
+
+
+SYNC_OVERLAP = timedelta(seconds=5)
+EPOCH = datetime(1970, 1, 1)
+
+
+class FactorRank:
+    def __init__(self, spec: RankSpec):
+        self.spec = spec
+        self.keys = {}
+        self.order = []
+
+    def sort_key(self, value):
+        return -value if self.spec.reverse else value
+
+    def remove(self, code: str):
+        key = self.keys.pop(code, None)
+        if key is not None:
+            del self.order[bisect_left(self.order, (key, code))]
+
+    def update(self, code: str, value):
+        self.remove(code)
+        if value and value > 0:
+            key = self.sort_key(value)
+            self.keys[code] = key
+            insort(self.order, (key, code))
+
+    def load(self, codes: List[str], values: list):
+        self.keys = {code: self.sort_key(value) for code, value in zip(codes, values) if value and value > 0}
+        self.order = sorted((key, code) for code, key in self.keys.items())
+
+    def rank(self, code: str, total: int) -> int:
+        key = self.keys.get(code)
+        if key is None:
+            return total
+        return bisect_left(self.order, (key, code)) + 1
+
+
+class RankEngine:
+    def __init__(self, specs: List[RankSpec]=rank_specs):
+        self.factors = {spec.rank_key: FactorRank(spec) for spec in specs}
+        self.codes = set()
+        self.synced_at = None
+        self.lock = threading.RLock()
+
+    def update(self, stock: Stock):
+        code = stock['code']
+        with self.lock:
+            self.codes.add(code)
+            for factor in self.factors.values():
+                factor.update(code, attr_or_key_getter(factor.spec.key, stock, default_value=None))
+
+    def load(self, documents: List[dict]):
+        columns = universe.StockUniverse(documents)
+        codes = columns.codes.tolist()
+        stocks = None
+        loaded = {}
+        for rank_key, factor in self.factors.items():
+            if factor.spec.key in universe.COLUMNS:
+                loaded[rank_key] = columns.column(factor.spec.key).tolist()
+            else:
+                stocks = stocks or [Stock(d) for d in documents]
+                loaded[rank_key] = [attr_or_key_getter(factor.spec.key, s, default_value=None) for s in stocks]
+        with self.lock:
+            self.codes = set(codes)
+            for rank_key, values in loaded.items():
+                self.factors[rank_key].load(codes, values)
+
+    def remove(self, code: str):
+        with self.lock:
+            self.codes.discard(code)
+            for factor in self.factors.values():
+                factor.remove(code)
+
+    def sync(self) -> int:
+        with self.lock:
+            if self.synced_at is None:
+                latest = db.read_meta().get('updated_at', EPOCH)
+                documents = list(db.db.stocks.find({}))
+                self.load(documents)
+                self.synced_at = max([latest] + [d['updated_at'] for d in documents if d.get('updated_at')])
+                return len(documents)
+            find = {'updated_at': {'$gte': self.synced_at - SYNC_OVERLAP}}
+            latest = self.synced_at
+            count = 0
+            for stock in db.db.stocks.find(find):
+                self.update(Stock(stock))
+                latest = max(latest, stock.get('updated_at') or latest)
+                count += 1
+            self.synced_at = latest
+            return count
+
+    def rank(self, code: str, rank_key: str) -> int:
+        with self.lock:
+            return self.factors[rank_key].rank(code, len(self.codes))
+
+    def ranks(self, code: str) -> Dict[str, int]:
+        with self.lock:
+            return {rank_key: self.rank(code, rank_key) for rank_key in self.factors}
+
+    def combined(self, code: str, rank_options: List[RankOption]) -> int:
+        with self.lock:
+            return sum(self.rank(code, r.key) for r in rank_options)
+
+
+shared = RankEngine()
+
+
+def synced_engine() -> RankEngine:
+    shared.sync()
+    return shared
@@ -0,0 +1,83 @@
+import time
+import threading
+from datetime import datetime
+from collections import namedtuple
+from typing import List, Tuple
+
+import jobs
+import scrapper
+from scrapper import max_age, plan_sections
+
+
+TICK_INTERVAL = 5 * 60
+PAGES_PER_HOUR = 3000
+
+Tier = namedtuple('Tier', ['name', 'find', 'priority', 'policies', 'reserve'])
+
+TIERS = [
+    Tier(name='owned', find={'owned': True}, priority=30,
+        policies={'basic': max_age(hours=1), 'fnguide': max_age(hours=1)}, reserve=0),
+    Tier(name='starred', find={'starred': True}, priority=20,
+        policies={'basic': max_age(hours=4), 'fnguide': max_age(hours=4)}, reserve=0.1),
+    Tier(name='universe', find=None, priority=10, policies={}, reserve=0.3),
+]
+
+
+class RequestBudget:
+    def __init__(self, pages_per_hour: int=PAGES_PER_HOUR):
+        self.rate = pages_per_hour / 3600.0
+        self.capacity = pages_per_hour
+        self.tokens = float(pages_per_hour)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self, pages: int, reserve: float=0) -> bool:
+        with self.lock:
+            self.refill()
+            if self.tokens - pages < self.capacity * reserve:
+                return False
+            self.tokens -= pages
+            return True
+
+
+def last_fetched(stock: dict) -> datetime:
+    return max((stamp['at'] for stamp in stock.get('fetched', {}).values()), default=datetime.min)
+
+
+def due_stocks(tier: Tier, now: datetime, skip: set) -> List[Tuple[str, List[str]]]:
+    stocks = scrapper.snowball_targets(find=tier.find, filter_by_expected_rate=False)
+    stocks = sorted((stock for code, stock in stocks.items() if code not in skip), key=last_fetched)
+    due = [(stock['code'], plan_sections(stock, now, tier.policies)) for stock in stocks]
+    return [(code, sections) for code, sections in due if sections]
+
+
+def schedule(budget: RequestBudget, now: datetime=None) -> dict:
+    now = now or datetime.now()
+    skip = jobs.pending_codes() | jobs.failed_codes()
+    scheduled = {}
+    for tier in TIERS:
+        scheduled[tier.name] = 0
+        for code, sections in due_stocks(tier, now, skip):
+            if not budget.take(len(sections), tier.reserve):
+                break
+            jobs.enqueue(code, kind=jobs.REFRESH, priority=tier.priority, sections=sections)
+            skip.add(code)
+            scheduled[tier.name] += 1
+    return scheduled
+
+
+def run_scheduler(pages_per_hour: int=PAGES_PER_HOUR, tick: float=TICK_INTERVAL):
+    jobs.ensure_indexes()
+    budget = RequestBudget(pages_per_hour)
+    while True:
+        scheduled = schedule(budget)
+        stats = jobs.queue_stats()
+        print('예약: {} / 대기 {} 실행 {} 지연 {:.0f}초'.format(
+            ', '.join('{} {}'.format(name, count) for name, count in scheduled.items()),
+            stats['depth'], stats['running'], stats['lag']))
+        time.sleep(tick)
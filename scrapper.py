@@ -1,19 +1,20 @@
-from typing import List
+from typing import List, Dict, Iterable, Iterator, Callable, Optional
 import csv
-import time
-import random
-from datetime import datetime
-from statistics import mean
-import urllib.request
 import json
+import hashlib
+from datetime import datetime, timedelta
+from statistics import mean
 import codecs
 from functools import partial
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import requests
-from lxml import html
+from lxml import html, etree
 
 import db
+import fetcher
 from db import Quarter
+from extraction import Spec, Field, first, first_text, each, optional, extract_all
 from utils import parse_float, parse_int, first_or_none, float_or_none
 
 
@@ -31,9 +32,139 @@ FNGUIDE_INVEST_GUIDE = 'http://comp.fnguide.com/SVO2/asp/SVD_Invest.asp?pGB=1&gi
 
 LAST_YEAR = str(datetime.now().year - 1)
 
+DEFAULT_WORKERS = 8
+STARRED_OWNED = {'$or': [{'starred': True}, {'owned': True}]}
+
+
+CrawlFailure = namedtuple('CrawlFailure', ['code', 'reason'])
+
+
+def max_age(**kwargs) -> Callable[[datetime, datetime], bool]:
+    age = timedelta(**kwargs)
+    return lambda fetched_at, now: now - fetched_at >= age
+
+
+FILING_DEADLINES = [(3, 31), (5, 15), (8, 14), (11, 14)]
+
+
+def last_filing_deadline(now: datetime) -> datetime:
+    deadlines = [datetime(now.year, month, day) for month, day in FILING_DEADLINES]
+    passed = [d for d in deadlines if d <= now]
+    return passed[-1] if passed else datetime(now.year - 1, *FILING_DEADLINES[-1])
+
+
+def after_filing_season(fetched_at: datetime, now: datetime) -> bool:
+    return fetched_at < last_filing_deadline(now)
+
+
+SECTIONS = ['basic', 'fnguide', 'financial_statements', 'financial_ratio', 'invest_guide']
+FNGUIDE_SECTIONS = ['financial_statements', 'financial_ratio', 'invest_guide']
+FAILURE_BACKOFF = timedelta(hours=6)
+MAX_FAILURE_BACKOFF = timedelta(days=7)
+SECTION_URLS = {
+    'basic': DAUM_BASIC + '{}',
+    'fnguide': FNGUIDE + '{}',
+    'financial_statements': FNGUIDE_FINANCIAL_STMT % '{}',
+    'financial_ratio': FNGUIDE_FINANCIAL_RATIO % '{}',
+    'invest_guide': FNGUIDE_INVEST_GUIDE % '{}',
+}
+SECTION_POLICIES = {
+    'basic': max_age(hours=20),
+    'fnguide': max_age(hours=20),
+    'financial_statements': after_filing_season,
+    'financial_ratio': after_filing_season,
+    'invest_guide': after_filing_season,
+}
+
+
+def failure_backoff(failures: int) -> timedelta:
+    return min(FAILURE_BACKOFF * 2 ** (failures - 1), MAX_FAILURE_BACKOFF)
+
+
+def plan_sections(stock: dict, now: datetime=None, policies: dict=None) -> List[str]:
+    now = now or datetime.now()
+    policies = {**SECTION_POLICIES, **(policies or {})}
+    fetched = stock.get('fetched', {})
+    sections = SECTIONS
+    if stock.get('use_fnguide', True) is False:
+        sections = [section for section in SECTIONS if section not in FNGUIDE_SECTIONS]
+
+    def is_due(section):
+        if section not in fetched:
+            return True
+        failures = fetched[section].get('failures')
+        if failures:
+            return now - fetched[section]['at'] >= failure_backoff(failures)
+        return policies[section](fetched[section]['at'], now)
+    return [section for section in sections if is_due(section)]
+
 
-def fill_company(filename: str='company.csv'):
-    random.seed()
+def content_hash(stock: dict) -> str:
+    return hashlib.sha1(json.dumps(stock, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class SectionWriter:
+    def __init__(self, writer: db.StockWriter, section: str, previous: dict=None, record_failures: bool=True):
+        self.writer = writer
+        self.section = section
+        self.previous = previous or {}
+        self.record_failures = record_failures
+
+    def save(self, stock):
+        digest = content_hash(stock)
+        if self.previous.get('hash') == digest:
+            stock = {'code': stock['code']}
+        self.writer.save({**stock, 'fetched.' + self.section: {'at': datetime.now(), 'hash': digest}})
+
+    def fail(self, code: str):
+        if not self.record_failures:
+            return
+        self.writer.save({'code': code, 'fetched.' + self.section: {
+            'at': datetime.now(),
+            'hash': self.previous.get('hash'),
+            'failures': self.previous.get('failures', 0) + 1,
+        }})
+
+    def attempt(self, code: str, parse: Callable[[str, 'SectionWriter'], bool], record: bool=True) -> bool:
+        try:
+            if parse(code, self):
+                return True
+        except Exception:
+            self.fail(code)
+            raise
+        if record:
+            self.fail(code)
+        return False
+
+
+def page_url(section: str, code: str) -> str:
+    return SECTION_URLS[section].format(code)
+
+
+def crawl(codes: Iterable[str], job: Callable[[str], bool], workers: int=DEFAULT_WORKERS) -> List[CrawlFailure]:
+    failures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(job, code): code for code in codes}
+        for future in as_completed(futures):
+            code = futures[future]
+            try:
+                if future.result() is False:
+                    failures.append(CrawlFailure(code=code, reason='수집 실패'))
+            except Exception as e:
+                failures.append(CrawlFailure(code=code, reason=repr(e)))
+    report_failures(failures)
+    return failures
+
+
+def report_failures(failures: List[CrawlFailure]):
+    if not failures:
+        return
+    print('*** {} 종목 수집 실패 ***'.format(len(failures)))
+    for failure in sorted(failures):
+        print('{}: {}'.format(failure.code, failure.reason))
+
+
+def iter_codes_from_csv(filename: str) -> Iterator[str]:
     with open(filename, newline='', encoding='UTF8') as csvfile:
         reader = csv.DictReader(csvfile)
         for row in reader:
@@ -42,77 +173,109 @@ def fill_company(filename: str='company.csv'):
                 code = code[4:]
             elif code.startswith('KOSDAQ:'):
                 code = code[7:]
-            parse_snowball(code)
-            time.sleep(random.random())
+            yield code
+
+
+def codes_from_csv(filename: str) -> List[str]:
+    return list(iter_codes_from_csv(filename))
+
+
+def fill_company(filename: str='company.csv', workers: int=DEFAULT_WORKERS) -> List[CrawlFailure]:
+    with db.StockWriter() as writer:
+        failures = crawl(codes_from_csv(filename), partial(parse_snowball, writer=writer), workers=workers)
     db.update_ranks()
+    return failures
 
 
-def parse_snowball_stocks(filter_bad: bool=True, only_starred_owned: bool=False):
-    random.seed()
-    find = {'$or': [{'starred': True}, {'owned': True}]} if only_starred_owned else None
-    stocks =  db.all_stocks(find=find, filter_bad=filter_bad)
+def snowball_targets(find: dict=None, filter_bad: bool=True, filter_by_expected_rate: bool=True) -> Dict[str, db.Stock]:
+    stocks = db.all_stocks(find=find, filter_bad=filter_bad, filter_by_expected_rate=filter_by_expected_rate)
+    return {stock['code']: stock for stock in stocks if stock.get('code', None)}
+
+
+def parse_snowball_stocks(filter_bad: bool=True, only_starred_owned: bool=False, workers: int=DEFAULT_WORKERS, incremental: bool=True) -> List[CrawlFailure]:
+    stocks = snowball_targets(find=STARRED_OWNED if only_starred_owned else None, filter_bad=filter_bad)
     print('{} 종목 수집'.format(len(stocks)))
-    for stock in stocks:
-        if stock.get('code', None):
-            parse_snowball(stock['code'])
-            time.sleep(random.random())
+    if incremental:
+        planned = sum(len(plan_sections(stock)) for stock in stocks.values())
+        print('{} / {} 페이지 수집 예정'.format(planned, len(stocks) * len(SECTIONS)))
+    with db.StockWriter() as writer:
+        job = lambda code: parse_snowball(code, writer=writer, stock=stocks[code], incremental=incremental)
+        failures = crawl(stocks.keys(), job, workers=workers)
     db.update_ranks()
+    return failures
 
 
 def tree_from_url(url: str, decode: str=None):
-    content = requests.get(url).content
+    content = fetcher.get(url)
     if decode:
         content = content.decode(decode)
     return html.fromstring(content)
 
 
-def parse_basic(code):
+def saver(writer: db.StockWriter=None):
+    return writer.save if writer else partial(db.save_stock, read_back=False)
+
+
+def save_extracted(stock: Optional[dict], writer: db.StockWriter=None) -> bool:
+    if not stock:
+        return False
+    saver(writer)(stock)
+    return True
+
+
+def parse_basic(code, writer: db.StockWriter=None) -> bool:
     print('종목 {} 기본...'.format(code))
     url = DAUM_BASIC + code
     print('다음 {}'.format(url))
     
-    tree = tree_from_url(url)
-    if not tree.xpath('//*[@id="topWrap"]/div[1]/h2'):
-        return False
-    
-    title = tree.xpath('//*[@id="topWrap"]/div[1]/h2')[0].text
-    price = parse_float(tree.xpath('//*[@id="topWrap"]/div[1]/ul[2]/li[1]/em')[0].text)
-    diff = tree.xpath('//*[@id="topWrap"]/div[1]/ul[2]/li[2]/span')[0]
-    rate_diff = tree.xpath('//*[@id="topWrap"]/div[1]/ul[2]/li[3]/span')[0].text
-    exchange = tree.xpath('//*[@id="topWrap"]/div[1]/ul[1]/li[2]/a')[0].text
+    return save_extracted(extract_basic(tree_from_url(url), code), writer)
+
+
+def parse_rate_diff(text: str) -> float:
+    return float(text.replace(',', '').replace('+', '').replace('-', '').replace('%', '').replace('％', ''))
+
+
+DAUM_SPECS = [
+    Spec('//*[@id="topWrap"]/div[1][h2]', {
+        'title': Field('h2', first_text()),
+        'current_price': Field('ul[2]/li[1]/em', first_text(parse_float)),
+        'diff': Field('ul[2]/li[2]/span', first()),
+        'rate_diff': Field('ul[2]/li[3]/span', first_text(parse_rate_diff)),
+        'exchange': Field('ul[1]/li[2]/a', first_text()),
+        'trade_volume': Field('ul[2]/li[5]/span[1]', first_text(parse_float)),
+        'trade_value': Field('ul[2]/li[6]/span', first_text(parse_float)),
+    }, required=True),
+    Spec('//*[@id="stockContent"]/ul[2]', {
+        'per': Field('li[3]/dl[2]/dd', first_text(lambda text: parse_float(text.split('/')[-1]))),
+        'pbr': Field('li[4]/dl[2]/dd', first_text(lambda text: parse_float(text.split('/')[-1]))),
+        'agg_value': Field('li[2]/dl[2]/dd', first_text(parse_float)),
+    }),
+]
+
+
+def extract_basic(tree, code: str) -> Optional[dict]:
+    values = extract_all(tree, DAUM_SPECS)
+    if not values:
+        return None
+
+    diff = values.pop('diff')
     price_diff = parse_float(diff.text)
-    rate_diff = float(rate_diff.replace(',', '').replace('+', '').replace('-', '').replace('%', '').replace('％', ''))
+    rate_diff = values['rate_diff']
 
     is_price_down = diff.get('class').endswith('down')
     if is_price_down:
         price_diff = -abs(price_diff)
         rate_diff = -abs(rate_diff)
-    
-    per = parse_float(tree.xpath('//*[@id="stockContent"]/ul[2]/li[3]/dl[2]/dd')[0].text.split('/')[1])
-    pbr = parse_float(tree.xpath('//*[@id="stockContent"]/ul[2]/li[4]/dl[2]/dd')[0].text.split('/')[1])
-    
-    trade_volume = parse_float(tree.xpath('//*[@id="topWrap"]/div[1]/ul[2]/li[5]/span[1]')[0].text)
-    trade_value = parse_float(tree.xpath('//*[@id="topWrap"]/div[1]/ul[2]/li[6]/span')[0].text)
-
-    agg_value = parse_float(tree.xpath('//*[@id="stockContent"]/ul[2]/li[2]/dl[2]/dd')[0].text)
 
-    print('종목명: {title} 현재가: {price}'.format(title=title, price=price))
+    print('종목명: {title} 현재가: {price}'.format(title=values['title'], price=values['current_price']))
 
     stock = {
         'code': code,
-        'title': title,
-        'current_price': price,
+        **values,
         'price_diff': price_diff,
         'rate_diff': rate_diff,
-        'per': per,
-        'pbr': pbr,
-        'trade_volume': trade_volume,
-        'trade_value': trade_value,
-        'exchange': exchange,
-        'agg_value': agg_value,
     }
-    db.save_stock(stock)
-    return True
+    return stock
 
 
 def quarter_from(text: str) -> Quarter:
@@ -124,7 +287,7 @@ def quarter_from(text: str) -> Quarter:
     return Quarter(year=int(comp[0]), number=int(int(comp[1]) / 3), estimated=estimated)
 
 
-def parse_quarterly(code: str):
+def parse_quarterly(code: str, writer: db.StockWriter=None):
     print('분기 {}'.format(code))
     url = NAVER_QUARTERLY % (code)
     tree = tree_from_url(url)
@@ -153,53 +316,74 @@ def parse_quarterly(code: str):
         'QROEs': QROEs,
         'QBPSs': QBPSs,
     }
-    stock = db.save_stock(stock)
+    saver(writer)(stock)
 
 
-def parse_naver_company(code: str):
+def parse_naver_company(code: str, writer: db.StockWriter=None) -> bool:
     url = NAVER_COMPANY + code
     print('네이버 {}'.format(url))
-    tree = tree_from_url(url)
-    
-    element = tree.xpath('//*[@id="pArea"]/div[1]/div/table/tr[3]/td/dl/dt[2]/b')
-    if not element:
+    return save_extracted(extract_naver_company(tree_from_url(url), code), writer)
+
+
+NAVER_COMPANY_SPEC = Spec('//*[@id="pArea"]/div[1]/div/table/tr[3]/td/dl[dt[2]/b][dt[6]/b]', {
+    'bps': Field('dt[2]/b', first_text(parse_int)),
+    'dividend_rate': Field('dt[6]/b', first_text(parse_float)),
+}, required=True)
+
+
+def extract_naver_company(tree, code: str) -> Optional[dict]:
+    values = NAVER_COMPANY_SPEC.extract(tree)
+    if not values:
         print('수집 실패')
-        return False
-    bps = parse_int(element[0].text)
-    print('BPS: {}'.format(bps))
-
-    element = tree.xpath('//*[@id="pArea"]/div[1]/div/table/tr[3]/td/dl/dt[6]/b')
-    if element:
-        dividend_rate = parse_float(element[0].text)
-        print('배당률: {}'.format(dividend_rate))
-    else:
-        dividend_rate = 0
-        print('배당 수집 실패')
-        return False
-    
+        return None
+    print('BPS: {}'.format(values['bps']))
+    print('배당률: {}'.format(values['dividend_rate']))
+
     stock = {
         'code': code,
-        'bps': bps,
-        'dividend_rate': dividend_rate,
+        **values,
         'use_fnguide': False,
     }
-    stock = db.save_stock(stock)
     return stock
 
 
-def parse_snowball(code: str):
-    if not parse_basic(code):
+def parse_snowball(code: str, writer: db.StockWriter=None, stock: dict=None, incremental: bool=False, sections: List[str]=None) -> bool:
+    if writer is None:
+        with db.StockWriter() as writer:
+            return parse_snowball(code, writer, stock, incremental, sections)
+    stock = stock or {}
+    if sections is None:
+        sections = plan_sections(stock) if incremental else SECTIONS
+    try:
+        return parse_snowball_pages(code, writer, stock, sections)
+    finally:
+        writer.commit(code)
+
+
+def parse_snowball_pages(code: str, writer: db.StockWriter, stock: dict, sections: List[str]) -> bool:
+    fetched = stock.get('fetched', {})
+    tracked = lambda section: SectionWriter(writer, section, fetched.get(section), record_failures='code' in stock)
+
+    if 'basic' in sections and not tracked('basic').attempt(code, parse_basic):
         print('수집 실패')
-        return
+        return False
 
-    if parse_fnguide(code):
-        parse_fnguide_financial_statements(code)
-        parse_fnguide_financial_ratio(code)
-        parse_fnguide_invest_guide(code)
-    else:
-        print('FnGuide 수집실패')
-        if not parse_naver_company(code):
-            return
+    use_fnguide = stock.get('use_fnguide', False)
+    if 'fnguide' in sections:
+        fnguide = tracked('fnguide')
+        use_fnguide = fnguide.attempt(code, parse_fnguide, record=False)
+        if not use_fnguide:
+            print('FnGuide 수집실패')
+            if not fnguide.attempt(code, parse_naver_company):
+                return False
+
+    if use_fnguide:
+        if 'financial_statements' in sections:
+            tracked('financial_statements').attempt(code, parse_fnguide_financial_statements)
+        if 'financial_ratio' in sections:
+            tracked('financial_ratio').attempt(code, parse_fnguide_financial_ratio)
+        if 'invest_guide' in sections:
+            tracked('invest_guide').attempt(code, parse_fnguide_invest_guide)
     
     # print('종목 {} 스노우볼...'.format(code))
     
@@ -293,13 +477,13 @@ def parse_snowball(code: str):
 
     #parse_quarterly(code)
     #parse_json(code)
+    return True
 
 
-def parse_json(code: str):
+def parse_json(code: str, writer: db.StockWriter=None):
     print('종목 {} JSON...'.format(code))
     url = NAVER_JSON1 % (code)
-    urlopen = urllib.request.urlopen(url)
-    data = json.loads(urlopen.read().decode())
+    data = fetcher.get_json(url)
     GPs = []
     if data and 'DATA' in data and data['DATA']:
         yyyy = [int(y[:4]) for y in data['YYMM'] if len(y) > 4 and len(y.split('/')) > 2]
@@ -311,8 +495,7 @@ def parse_json(code: str):
                 break
     
     url = NAVER_JSON5 % (code)
-    urlopen = urllib.request.urlopen(url)
-    data = json.loads(urlopen.read().decode())
+    data = fetcher.get_json(url)
     
     CPSs = []
     PCRs = []
@@ -342,10 +525,10 @@ def parse_json(code: str):
         'PSRs': PSRs,
     }
     print('GPs: {}'.format(GPs))
-    stock = db.save_stock(stock)
+    saver(writer)(stock)
 
 
-def parse_etf(code: str, tag: str, etf_type: str):
+def parse_etf(code: str, tag: str, etf_type: str, writer: db.ETFWriter=None) -> bool:
     url = NAVER + code
     print(url)
     tree = tree_from_url(url, 'euc-kr')
@@ -353,7 +536,7 @@ def parse_etf(code: str, tag: str, etf_type: str):
     try:
         title = tree.xpath('//*[@id="middle"]/div[1]/div[1]/h2/a')[0].text
     except:
-        return
+        return False
     month1 = parse_float(tree.xpath('//*[@id="tab_con1"]/div[5]/table/tbody/tr[1]/td/em')[0].text.strip())
     month3 = parse_float(tree.xpath('//*[@id="tab_con1"]/div[5]/table/tbody/tr[2]/td/em')[0].text.strip())
     month6 = parse_float(tree.xpath('//*[@id="tab_con1"]/div[5]/table/tbody/tr[3]/td/em')[0].text.strip())
@@ -364,7 +547,7 @@ def parse_etf(code: str, tag: str, etf_type: str):
 
     tags = tag.split(',')
 
-    db.save_etf({
+    (writer.save if writer else db.save_etf)({
         'code': code,
         'title': title,
         'company': company,
@@ -376,17 +559,30 @@ def parse_etf(code: str, tag: str, etf_type: str):
         'tags': tags,
         'type': etf_type,
     })
+    return True
+
+
+ETF_FILES = [('dual_etf.txt', 'domestic'), ('international_etf.txt', 'international')]
 
 
-def parse_etfs():
-    with codecs.open('dual_etf.txt', 'r', 'utf-8') as f:
-        lines = f.readlines()
-        for line in lines:
-            parse_line(line, 'domestic')
-    with codecs.open('international_etf.txt', 'r', 'utf-8') as f:
-        lines = f.readlines()
-        for line in lines:
-            parse_line(line, 'international')
+def etf_tags_from_file(filename: str) -> Dict[str, str]:
+    tags = {}
+    with codecs.open(filename, 'r', 'utf-8') as f:
+        for line in f.readlines():
+            words = line.strip().split(' ')
+            if words[0]:
+                tags[words[-1]] = words[0]
+    return tags
+
+
+def parse_etfs(workers: int=DEFAULT_WORKERS) -> List[CrawlFailure]:
+    failures = []
+    for filename, etf_type in ETF_FILES:
+        tags = etf_tags_from_file(filename)
+        with db.ETFWriter() as writer:
+            failures += crawl(tags.keys(), lambda code: parse_etf(code, tags[code], etf_type, writer), workers=workers)
+        db.materialize_etf_stats(etf_type)
+    return failures
 
 
 def parse_line(line: str, etf_type: str):
@@ -397,159 +593,142 @@ def parse_line(line: str, etf_type: str):
     parse_etf(words[-1], words[0], etf_type)
 
 
-def parse_fnguide(code: str):
+def parse_fnguide(code: str, writer: db.StockWriter=None) -> bool:
     print('종목 {} FnGuide...'.format(code))
     url = FNGUIDE + code
     print('FnGuide {}'.format(url))
-    tree = tree_from_url(url)
-    
-    title = first_or_none(tree.xpath('//*[@id="giName"]/text()'))
-    if not title:
-        return False
-    
-    groups = first_or_none(tree.xpath('//*[@id="compBody"]/div[1]/div[1]/p/span[1]/text()'))
-    groups = groups.split(' ')
-    group = groups[1] if len(groups) > 1 else None
-    
-    subgroup = first_or_none(tree.xpath('//*[@id="compBody"]/div[1]/div[1]/p/span[4]/text()'))
-    subgroup = subgroup.replace('\xa0', '')
-
-    closing_month = first_or_none(tree.xpath('//*[@id="compBody"]/div[1]/div[1]/p/span[6]/text()'))
-    closing_month = parse_int(closing_month.split(' ')[0][:-1])
+    return save_extracted(extract_fnguide(tree_from_url(url), code), writer)
+
+
+def group_of(text: str) -> str:
+    groups = text.split(' ')
+    return groups[1] if len(groups) > 1 else None
+
+
+FNGUIDE_TITLE = Spec('//*[@id="giName"]', {
+    'title': Field('text()', first()),
+}, required=True)
+
+FNGUIDE_SPECS = [
+    Spec('//*[@id="compBody"]/div[1]/div[1]/p', {
+        'group': Field('span[1]/text()', first(optional(group_of))),
+        'subgroup': Field('span[4]/text()', first(optional(lambda text: text.replace('\xa0', '')))),
+        'closing_month': Field('span[6]/text()', first(optional(lambda text: parse_int(text.split(' ')[0][:-1])))),
+    }),
+    Spec('//*[@id="corp_group2"]', {
+        'forward_per': Field('dl[2]/dd/text()', first(parse_float)),
+        'group_per': Field('dl[3]/dd/text()', first(parse_float)),
+        'dividend_rate': Field('dl[5]/dd/text()', first(parse_float)),
+    }),
+    Spec('//*[@id="svdMainChartTxt13"]', {
+        'relative_earning_rate': Field('text()', first(parse_float)),
+    }),
+    Spec('//*[@id="svdMainGrid1"]/table/tbody', {
+        'momentums': Field('tr[3]/td[1]/span/text()', each(parse_float)),
+        'foreigner_weight': Field('tr[3]/td[2]/text()', first(parse_float)),
+        'beta': Field('tr[4]/td[2]/text()', first(parse_float)),
+        'has_preferred_stock': Field('tr[7]/td[1]/text()', first(optional(lambda text: text.split('/ ')[1] != '0'))),
+        'floating_rate': Field('tr[6]/td[2]/text()', first(parse_float)),
+    }),
+    Spec('//*[@id="svdMainGrid2"]/table/tbody', {
+        'YoY': Field('tr/td[4]/span/text()', first(parse_float)),
+    }),
+    Spec('//*[@id="svdMainGrid9"]/table/tbody', {
+        'consensus_point': Field('tr/td[1]/text()', first(parse_float)),
+        'consensus_price': Field('tr/td[2]/text()', first(parse_int)),
+        'consensus_count': Field('tr/td[5]/text()', first(parse_int)),
+    }),
+    Spec('//*[@id="highlight_D_A"]/table/tbody', {
+        'bps': Field('tr[19]/td[3]/text()', first(parse_int)),
+    }),
+    Spec('//*[@id="highlight_D_Y"]/table', {
+        'years': Field('thead/tr[2]/th/div/text()', each(lambda x: x.split('/')[0])),
+        'NPs': Field('tbody/tr[3]/td/text()', each(parse_float)),
+        'TAs': Field('tbody/tr[6]/td/text()', each(parse_float)),
+        'DEPTs': Field('tbody/tr[7]/td/text()', each(parse_float)),
+        'ROEs': Field('tbody/tr[17]/td/text()', each(parse_float)),
+        'EPSs': Field('tbody/tr[18]/td/text()', each(parse_float)),
+        'BPSs': Field('tbody/tr[19]/td/text()', each(parse_float)),
+        'DPSs': Field('tbody/tr[20]/td/text()', each(parse_float)),
+        'PERs': Field('tbody/tr[21]/td/text()', each(parse_float)),
+        'PBRs': Field('tbody/tr[22]/td/text()', each(parse_float)),
+    }),
+]
+
+
+def extract_fnguide(tree, code: str) -> Optional[dict]:
+    title = FNGUIDE_TITLE.extract(tree)
+    if not title or not title['title']:
+        return None
+    values = extract_all(tree, FNGUIDE_SPECS)
 
-    forward_per = parse_float(first_or_none(tree.xpath('//*[@id="corp_group2"]/dl[2]/dd/text()')))
-    group_per = parse_float(first_or_none(tree.xpath('//*[@id="corp_group2"]/dl[3]/dd/text()')))
-    
-    dividend_rate = parse_float(first_or_none(tree.xpath('//*[@id="corp_group2"]/dl[5]/dd/text()')))
-    
-    relative_earning_rate = parse_float(first_or_none(tree.xpath('//*[@id="svdMainChartTxt13"]/text()')))
-    
-    momentums = tree.xpath('//*[@id="svdMainGrid1"]/table/tbody/tr[3]/td[1]/span/text()')
-    momentums = [parse_float(m) for m in momentums]
+    try:
+        last_year_index = values.pop('years').index(LAST_YEAR)
+    except ValueError:
+        print("** 작년 데이터 없음 **")
+        return None
 
+    momentums = values.pop('momentums')
     month1 = momentums[0] if len(momentums) >= 1 else 0
     month3 = momentums[1] if len(momentums) >= 2 else 0
     month6 = momentums[2] if len(momentums) >= 3 else 0
     month12 = momentums[3] if len(momentums) >= 4 else 0
-    
-    foreigner_weight = parse_float(first_or_none(tree.xpath('//*[@id="svdMainGrid1"]/table/tbody/tr[3]/td[2]/text()')))
-
-    beta = parse_float(first_or_none(tree.xpath('//*[@id="svdMainGrid1"]/table/tbody/tr[4]/td[2]/text()')))
-
-    stocks = first_or_none(tree.xpath('//*[@id="svdMainGrid1"]/table/tbody/tr[7]/td[1]/text()'))
-
-    stocks = stocks.split('/ ')
-    has_preferred_stock = False if stocks[1] == '0' else True
-    
-    floating_rate = parse_float(first_or_none(tree.xpath('//*[@id="svdMainGrid1"]/table/tbody/tr[6]/td[2]/text()')))
-
-    YoY = parse_float(first_or_none(tree.xpath('//*[@id="svdMainGrid2"]/table/tbody/tr/td[4]/span/text()')))
-
-    consensus_point = parse_float(first_or_none(tree.xpath('//*[@id="svdMainGrid9"]/table/tbody/tr/td[1]/text()')))
-    consensus_price = parse_int(first_or_none(tree.xpath('//*[@id="svdMainGrid9"]/table/tbody/tr/td[2]/text()')))
-    consensus_count = parse_int(first_or_none(tree.xpath('//*[@id="svdMainGrid9"]/table/tbody/tr/td[5]/text()')))
-
-    bps = parse_int(first_or_none(tree.xpath('//*[@id="highlight_D_A"]/table/tbody/tr[19]/td[3]/text()')))
-
-    try:
-        years = tree.xpath('//*[@id="highlight_D_Y"]/table/thead/tr[2]/th/div/text()')
-        years = [x.split('/')[0] for x in years]
-        last_year_index = years.index(LAST_YEAR)
-    except ValueError:
-        print("** 작년 데이터 없음 **")
-        return
-
-    NPs = tree.xpath('//*[@id="highlight_D_Y"]/table/tbody/tr[3]/td/text()')
-    NPs = [parse_float(x) for x in NPs]
-
-    TAs = tree.xpath('//*[@id="highlight_D_Y"]/table/tbody/tr[6]/td/text()')
-    TAs = [parse_float(x) for x in TAs]
-
-    ROEs = tree.xpath('//*[@id="highlight_D_Y"]/table/tbody/tr[17]/td/text()')
-    ROEs = [parse_float(x) for x in ROEs]
-
-    EPSs = tree.xpath('//*[@id="highlight_D_Y"]/table/tbody/tr[18]/td/text()')
-    EPSs = [parse_float(x) for x in EPSs]
-
-    BPSs = tree.xpath('//*[@id="highlight_D_Y"]/table/tbody/tr[19]/td/text()')
-    BPSs = [parse_float(x) for x in BPSs]
-
-    DPSs = tree.xpath('//*[@id="highlight_D_Y"]/table/tbody/tr[20]/td/text()')
-    DPSs = [parse_float(x) for x in DPSs]
-
-    PERs = tree.xpath('//*[@id="highlight_D_Y"]/table/tbody/tr[21]/td/text()')
-    PERs = [parse_float(x) for x in PERs]
-
-    PBRs = tree.xpath('//*[@id="highlight_D_Y"]/table/tbody/tr[22]/td/text()')
-    PBRs = [parse_float(x) for x in PBRs]
-
-    DEPTs = tree.xpath('//*[@id="highlight_D_Y"]/table/tbody/tr[7]/td/text()')
-    DEPTs = [parse_float(x) for x in DEPTs]
 
     stock = {
         'code': code,
-        'group': group,
-        'subgroup': subgroup,
-        'closing_month': closing_month,
-        'forward_per': forward_per,
-        'group_per': group_per,
-        'dividend_rate': dividend_rate,
-        'relative_earning_rate': relative_earning_rate,
+        **values,
         'month1': month1,
         'month3': month3,
         'month6': month6,
         'month12': month12,
-        'foreigner_weight': foreigner_weight,
-        'beta': beta,
-        'has_preferred_stock': has_preferred_stock,
-        'floating_rate': floating_rate,
-        'YoY': YoY,
-        'consensus_point': consensus_point,
-        'consensus_price': consensus_price,
-        'consensus_count': consensus_count,
-        'bps': bps,
         'use_fnguide': True,
         'last_year_index': last_year_index,
-        'NPs': NPs,
-        'TAs': TAs,
-        'ROEs': ROEs,
-        'EPSs': EPSs,
-        'BPSs': BPSs,
-        'DPSs': DPSs,
-        'PERs': PERs,
-        'PBRs': PBRs,
-        'DEPTs': DEPTs,
     }
-    db.save_stock(stock)
-    return True
+    return stock
+
+
+TABLE_ROWS = etree.XPath('tbody/tr')
+ROW_CELLS = etree.XPath('td//text()')
+TABLE_YEARS = etree.XPath('thead/tr/th/text()')
+ROW_HEADERS = etree.XPath('tbody/tr/th//text()')
+RATIO_ROW_HEADERS = etree.XPath('tbody/tr/th/text() | tbody/tr/th//a//text() | tbody/tr/th/div/text()')
+
+FINANCIAL_TABLE = etree.XPath('//*[@id="divDaechaY"]/table')
+PROFIT_TABLE = etree.XPath('//*[@id="divSonikY"]/table')
+CASH_FLOW_TABLE = etree.XPath('//*[@id="divCashY"]/table')
+RATIO_TABLE = etree.XPath('//*[@id="compBody"]/div[2]/div[3]/div[2]/table')
+INVEST_TABLE = etree.XPath('//*[@id="compBody"]/div[2]/div[5]/div[2]/table')
 
 
 def row_values_table(table, row_headers: List[str], key: str) -> List[str]:
     try:
         i = row_headers.index(key)
-        return [parse_float(v) for v in table.xpath('tbody/tr')[i].xpath('td//text()')]
+        return [parse_float(v) for v in ROW_CELLS(TABLE_ROWS(table)[i])]
     except ValueError:
         return []
 
 def row_values_table_by_index(table, index: int) -> List[str]:
     try:
-        return [parse_float(v) for v in table.xpath('tbody/tr')[index].xpath('td//text()')]
+        return [parse_float(v) for v in ROW_CELLS(TABLE_ROWS(table)[index])]
     except ValueError:
         return []
     except IndexError:
         return []
 
+def table_row_headers(table, headers=ROW_HEADERS) -> List[str]:
+    row_headers = [h.strip() for h in headers(table) if h.strip()]
+    return [h.replace('\xa0', '') for h in row_headers if h != '계산에 참여한 계정 펼치기']
+
+def table_years(table) -> List[int]:
+    return [int(y.split('/')[0]) for y in TABLE_YEARS(table) if len(y.split('/')) > 1]
+
 def parse_fnguide_financial_table(tree) -> dict:
-    if not tree.xpath('//*[@id="divDaechaY"]'):
+    table = first_or_none(FINANCIAL_TABLE(tree))
+    if table is None:
         return {}
-    years = tree.xpath('//*[@id="divDaechaY"]/table/thead/tr/th/text()')
-    years = [int(y.split('/')[0]) for y in years[1:]]
-
-    row_headers = tree.xpath("//*[@id='divDaechaY']/table/tbody/tr/th//text()")
-    row_headers = [h.strip() for h in row_headers if h.strip()]
-    row_headers = [h.replace('\xa0', '') for h in row_headers if h != '계산에 참여한 계정 펼치기']
+    years = [int(y.split('/')[0]) for y in TABLE_YEARS(table)[1:]]
 
-    row_values = partial(row_values_table, tree.xpath("//*[@id='divDaechaY']/table")[0], row_headers)
+    row_values = partial(row_values_table, table, table_row_headers(table))
     current_assets = row_values('유동자산')
     current_liability = row_values('유동부채')
     total_liability = row_values('부채')
@@ -574,16 +753,12 @@ def parse_fnguide_financial_table(tree) -> dict:
 
 
 def parse_fnguide_profit_table(tree) -> dict:
-    if not tree.xpath('//*[@id="divSonikY"]'):
+    table = first_or_none(PROFIT_TABLE(tree))
+    if table is None:
         return {}
-    years = tree.xpath('//*[@id="divSonikY"]/table/thead/tr/th/text()')
-    years = [int(y.split('/')[0]) for y in years if len(y.split('/')) > 1]
-
-    row_headers = tree.xpath("//*[@id='divSonikY']/table/tbody/tr/th//text()")
-    row_headers = [h.strip() for h in row_headers if h.strip()]
-    row_headers = [h.replace('\xa0', '') for h in row_headers if h != '계산에 참여한 계정 펼치기']
+    years = table_years(table)
 
-    row_values = partial(row_values_table, tree.xpath("//*[@id='divSonikY']/table")[0], row_headers)
+    row_values = partial(row_values_table, table, table_row_headers(table))
     sales = row_values('매출액')[:len(years)]
     GPs = row_values('매출총이익')[:len(years)]
     GPs = list(zip(years, GPs))
@@ -606,16 +781,12 @@ def parse_fnguide_profit_table(tree) -> dict:
     }
 
 def parse_fnguide_profit_flow(tree) -> dict:
-    if not tree.xpath('//*[@id="divCashY"]'):
+    table = first_or_none(CASH_FLOW_TABLE(tree))
+    if table is None:
         return {}
-    years = tree.xpath('//*[@id="divCashY"]/table/thead/tr/th/text()')
-    years = [int(y.split('/')[0]) for y in years if len(y.split('/')) > 1]
+    years = table_years(table)
 
-    row_headers = tree.xpath("//*[@id='divCashY']/table/tbody/tr/th//text()")
-    row_headers = [h.strip() for h in row_headers if h.strip()]
-    row_headers = [h.replace('\xa0', '') for h in row_headers if h != '계산에 참여한 계정 펼치기']
-
-    row_values = partial(row_values_table, tree.xpath("//*[@id='divCashY']/table")[0], row_headers)
+    row_values = partial(row_values_table, table, table_row_headers(table))
     CFOs = list(zip(years, row_values('영업활동으로인한현금흐름')[:len(years)]))
     CFIs = list(zip(years, row_values('투자활동으로인한현금흐름')[:len(years)]))
     CFFs = list(zip(years, row_values('재무활동으로인한현금흐름')[:len(years)]))
@@ -626,38 +797,31 @@ def parse_fnguide_profit_flow(tree) -> dict:
         'CFFs': CFFs,
     }
 
-def parse_fnguide_financial_statements(code: str) -> bool:
+def parse_fnguide_financial_statements(code: str, writer: db.StockWriter=None) -> bool:
     print('종목 {} FnGuide 재무재표 ...'.format(code))
     url = FNGUIDE_FINANCIAL_STMT % (code)
     print('FnGuide 재무재표 {}'.format(url))
-    tree = tree_from_url(url)
-    
-    stock = {'code': code, **parse_fnguide_financial_table(tree), **parse_fnguide_profit_table(tree), **parse_fnguide_profit_flow(tree)}
-    db.save_stock(stock)
-    
-    return True
+    return save_extracted(extract_fnguide_financial_statements(tree_from_url(url), code), writer)
+
 
+def extract_fnguide_financial_statements(tree, code: str) -> Optional[dict]:
+    stock = {'code': code, **parse_fnguide_financial_table(tree), **parse_fnguide_profit_table(tree), **parse_fnguide_profit_flow(tree)}
+    return stock
 
-def parse_fnguide_financial_ratio(code: str) -> bool:
+def parse_fnguide_financial_ratio(code: str, writer: db.StockWriter=None) -> bool:
     print('종목 {} FnGuide 재무비율 ...'.format(code))
     url = FNGUIDE_FINANCIAL_RATIO % (code)
     print('FnGuide 재무비율 {}'.format(url))
-    tree = tree_from_url(url)
+    return save_extracted(extract_fnguide_financial_ratio(tree_from_url(url), code), writer)
 
-    if not tree.xpath('//*[@id="compBody"]/div[2]/div[3]/div[2]/table'):
-        return False
-    
-    years = tree.xpath('//*[@id="compBody"]/div[2]/div[3]/div[2]/table/thead/tr/th/text()')
-    years = [int(y.split('/')[0]) for y in years if len(y.split('/')) > 1]
 
-    header1 = '//*[@id="compBody"]/div[2]/div[3]/div[2]/table/tbody/tr/th/text()'
-    header2 = '//*[@id="compBody"]/div[2]/div[3]/div[2]/table/tbody/tr/th//a//text()' 
-    header3 = '//*[@id="compBody"]/div[2]/div[3]/div[2]/table/tbody/tr/th/div/text()'
-    row_headers = tree.xpath(' | '.join([header1, header2, header3]))
-    row_headers = [h.strip() for h in row_headers if h.strip()]
-    row_headers = [h.replace('\xa0', '') for h in row_headers if h != '계산에 참여한 계정 펼치기']
+def extract_fnguide_financial_ratio(tree, code: str) -> Optional[dict]:
+    table = first_or_none(RATIO_TABLE(tree))
+    if table is None:
+        return None
+    years = table_years(table)
 
-    row_values = partial(row_values_table, tree.xpath('//*[@id="compBody"]/div[2]/div[3]/div[2]/table')[0], row_headers)
+    row_values = partial(row_values_table, table, table_row_headers(table, RATIO_ROW_HEADERS))
     loan_rate =  list(zip(years, row_values('순차입금비율')[:len(years)]))
     net_current_loan =  list(zip(years, row_values('순차입부채')[:len(years)]))
     interest_cost = list(zip(years, row_values('이자비용')[:len(years)]))
@@ -683,29 +847,26 @@ def parse_fnguide_financial_ratio(code: str) -> bool:
         'net_working_capital_turnover': net_working_capital_turnover,
         'net_working_capital': net_working_capital,
     }
-    db.save_stock(stock)
-
-    return True
+    return stock
 
-def parse_fnguide_invest_guide(code: str) -> bool:
+def parse_fnguide_invest_guide(code: str, writer: db.StockWriter=None) -> bool:
     print('종목 {} FnGuide 투자지표 ...'.format(code))
     url = FNGUIDE_INVEST_GUIDE % (code)
     print('FnGuide 투자지표 {}'.format(url))
-    tree = tree_from_url(url)
+    return save_extracted(extract_fnguide_invest_guide(tree_from_url(url), code), writer)
 
-    if not tree.xpath('//*[@id="compBody"]/div[2]/div[5]/div[2]/table'):
-        return False
 
-    years = tree.xpath('//*[@id="compBody"]/div[2]/div[5]/div[2]/table/thead/tr/th/text()')
-    years = [int(y.split('/')[0]) for y in years if len(y.split('/')) > 1]
+def extract_fnguide_invest_guide(tree, code: str) -> Optional[dict]:
+    table = first_or_none(INVEST_TABLE(tree))
+    if table is None:
+        return None
+    years = table_years(table)
 
-    row_values = partial(row_values_table_by_index, tree.xpath('//*[@id="compBody"]/div[2]/div[5]/div[2]/table')[0])
+    row_values = partial(row_values_table_by_index, table)
     FCFs = list(zip(years, row_values(50)))
     
     stock = {
         'code': code,
         'FCFs': FCFs,
     }
-    db.save_stock(stock)
-
-    return True
\ No newline at end of file
+    return stock
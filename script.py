@@ -1,6 +1,11 @@
 import argparse
 
 import scrapper
+import fetcher
+import pipeline
+import backtest
+import jobs
+import scheduler
 
 parser = argparse.ArgumentParser(description='Snowball utility')
 parser.add_argument('--basic', help='입력된 종목코드의 기본 정보를 가지고 온다')
@@ -11,22 +16,50 @@ parser.add_argument('--allminus', action='store_true', help='기대수익률이
 parser.add_argument('--fill', action='store_true', help='company.csv 파일에 있는 종목을 전부 추가한다')
 parser.add_argument('--sample', action='store_true', help='sample.csv 파일에 있는 종목을 추가한다')
 parser.add_argument('--etf', action='store_true', help='ETF 듀얼 모멘텀 정보를 수집한다')
+parser.add_argument('--full', action='store_true', help='--mysnowball/--allsnowball/--allminus에서 변경 여부와 관계없이 모든 페이지를 다시 수집한다')
+parser.add_argument('--materialize', action='store_true', help='저장된 종목의 파생 지표를 다시 계산해 저장한다')
+parser.add_argument('--cache', action='store_true', help='수집한 페이지를 로컬 캐시에 저장하고 유효기간 내에는 재사용한다')
+parser.add_argument('--replay', action='store_true', help='네트워크 없이 로컬 캐시에 있는 페이지만으로 다시 파싱한다')
+parser.add_argument('--pipeline', action='store_true', help='--fill/--sample을 단계별 파이프라인으로 수집하고 중단된 지점부터 이어서 수집한다')
+parser.add_argument('--restart', action='store_true', help='--pipeline 사용 시 저장된 진행 상황을 무시하고 처음부터 수집한다')
+parser.add_argument('--sweep', action='store_true', help='저장된 가격으로 전 종목 매매 시뮬레이션 파라미터를 그리드 탐색한다')
+parser.add_argument('--worker', action='store_true', help='웹에서 요청한 수집 작업을 백그라운드로 처리한다')
+parser.add_argument('--scheduler', action='store_true', help='보유 > 관심 > 전체 종목 순으로 주기적인 수집 작업을 예약한다')
+parser.add_argument('--budget', type=int, default=scheduler.PAGES_PER_HOUR, help='--scheduler가 한 시간에 예약할 최대 페이지 수')
+parser.add_argument('--workers', type=int, default=scrapper.DEFAULT_WORKERS, help='동시에 수집할 종목 수')
 
 if __name__ == '__main__':
     args = parser.parse_args()
+    if args.replay:
+        fetcher.configure_cache(fetcher.CACHE_REPLAY)
+    elif args.cache:
+        fetcher.configure_cache(fetcher.CACHE_ON)
     if args.basic:
         scrapper.parse_basic(args.basic)
     elif args.snowball:
         scrapper.parse_snowball(args.snowball)
     elif args.mysnowball:
-        scrapper.parse_snowball_stocks(filter_bad=True, only_starred_owned=True)
+        scrapper.parse_snowball_stocks(filter_bad=True, only_starred_owned=True, workers=args.workers, incremental=not args.full)
     elif args.allsnowball:
-        scrapper.parse_snowball_stocks(filter_bad=True)
+        scrapper.parse_snowball_stocks(filter_bad=True, workers=args.workers, incremental=not args.full)
     elif args.allminus:
-        scrapper.parse_snowball_stocks(filter_bad=False)
-    elif args.fill:
-        scrapper.fill_company()
-    elif args.sample:
-        scrapper.fill_company(filename='sample.csv')
+        scrapper.parse_snowball_stocks(filter_bad=False, workers=args.workers, incremental=not args.full)
+    elif args.fill or args.sample:
+        filename = 'company.csv' if args.fill else 'sample.csv'
+        if args.pipeline:
+            pipeline.fill_company(filename=filename, workers=args.workers, resume=not args.restart)
+        else:
+            scrapper.fill_company(filename=filename, workers=args.workers)
     elif args.etf:
-        scrapper.parse_etfs()
+        scrapper.parse_etfs(workers=args.workers)
+    elif args.worker:
+        jobs.run_worker()
+    elif args.scheduler:
+        scheduler.run_scheduler(pages_per_hour=args.budget)
+    elif args.sweep:
+        series = backtest.load_series()
+        print('{} 종목 시뮬레이션'.format(len(series)))
+        backtest.print_sweep(backtest.sweep(series))
+    elif args.materialize:
+        scrapper.db.materialize_stocks()
+        scrapper.db.ensure_indexes()
@@ -1,8 +1,28 @@
 import unittest
-from datetime import datetime
+import tempfile
+import threading
+from unittest import mock
+from datetime import datetime, date
 from statistics import mean
 
+from lxml import html
+from pymongo import DESCENDING
+
+import db
 from db import Stock, DIVIDEND_TAX_RATE
+from utils import attr_or_key_getter
+import scrapper
+import fetcher
+import universe
+import pipeline
+import extraction
+import pricestore
+import ranking
+import app
+import historical
+import backtest
+import jobs
+import scheduler
 
 
 LAST_YEAR = datetime.now().year - 1
@@ -312,7 +332,19 @@ class StockYearStatTest(unittest.TestCase):
         self.assertAlmostEqual(0.59, stock.peg_mean_per, places=1)        
 
     def test_fscore(self):
-        pass
+        stock_dict = {
+            'code': '0001',
+            'NPs': [10, -5, 20],
+            'CFOs': [(LAST_YEAR - 1, 3), (LAST_YEAR, -1)],
+            'TIs': [100, 100, 100],
+            'last_year_index': 2,
+        }
+        stock = Stock(stock_dict)
+        self.assertEqual(db.FScore(total_issued_stock=1, profitable=0, cfo=1), stock.fscore(LAST_YEAR - 1))
+        self.assertEqual(db.FScore(total_issued_stock=1, profitable=1, cfo=0), stock.fscore(LAST_YEAR))
+        self.assertEqual(2, stock.latest_fscore)
+        self.assertEqual([LAST_YEAR - 2, LAST_YEAR - 1, LAST_YEAR], [f[0] for f in stock.fscores])
+        self.assertEqual(-1, Stock({'code': '0001'}).latest_fscore)
 
     def test_roe_max_diff(self):
         stock_dict = {
@@ -338,5 +370,907 @@ class StockYearStatTest(unittest.TestCase):
         stock = Stock(stock_dict)
         print(stock.QROEs)
 
+class RankTest(unittest.TestCase):
+    def test_rank_values(self):
+        values = [3.0, None, 1.0, -2.0, 5.0, 0]
+        self.assertEqual([2, 6, 3, 6, 1, 6], db.rank_values(values, reverse=True))
+        self.assertEqual([2, 6, 1, 6, 3, 6], db.rank_values(values, reverse=False))
+
+
+class YearSeriesTest(unittest.TestCase):
+    def test_lookup_and_slices(self):
+        series = db.YearSeries([(LAST_YEAR - 2, 1.0), (LAST_YEAR - 1, 2.0), (LAST_YEAR, 3.0), (LAST_YEAR + 1, 4.0)])
+        self.assertEqual(3.0, series.get(LAST_YEAR))
+        self.assertIsNone(series.get(LAST_YEAR - 5))
+        self.assertEqual([(LAST_YEAR - 2, 1.0), (LAST_YEAR - 1, 2.0), (LAST_YEAR, 3.0)], series.past())
+        self.assertEqual([(LAST_YEAR + 1, 4.0)], series.future())
+        self.assertEqual([(LAST_YEAR - 1, 2.0), (LAST_YEAR, 3.0)], series.between(LAST_YEAR - 1, LAST_YEAR + 1))
+
+    def test_stock_series_from_pairs(self):
+        stock = Stock({'code': '0001', 'PCRs': [[LAST_YEAR - 1, 5.0], [LAST_YEAR, 7.5]]})
+        self.assertEqual(7.5, stock.last_year_pcr)
+        self.assertEqual(5.0, stock.value_by_year('PCRs', LAST_YEAR - 1))
+        self.assertIsNone(stock.value_by_year('PCRs', LAST_YEAR + 1))
+
+
+class StockMemoTest(unittest.TestCase):
+    def test_memoized_property_is_invalidated_on_setitem(self):
+        stock = Stock({
+            'code': '0001',
+            'current_price': 1200,
+            'bps': 1000,
+            'ROEs': [11.0, 8.0, 15.0, 10.0],
+            'last_year_index': 2,
+            'dividend_rate': 4.5,
+        })
+        self.assertIs(stock.last_four_years_roe, stock.last_four_years_roe)
+        self.assertAlmostEqual(8.63, stock.expected_rate, places=1)
+        stock['current_price'] = 1000
+        self.assertAlmostEqual(10.63, stock.expected_rate, places=1)
+        del stock['dividend_rate']
+        self.assertEqual(stock.mean_roe, stock.future_roe)
+
+
+class DerivedValuesTest(unittest.TestCase):
+    def test_derived_values(self):
+        stock = Stock({
+            'code': '0001',
+            'current_price': 1200,
+            'bps': 1000,
+            'ROEs': [11.0, 8.0, 15.0, 10.0],
+            'last_year_index': 2,
+            'dividend_rate': 4.5,
+        })
+        values = db.derived_values(stock)
+        self.assertEqual(db.DERIVED_VERSION, values['derived_version'])
+        self.assertEqual(stock.expected_rate, values['expected_rate'])
+        self.assertEqual(stock.future_roe, values['future_roe'])
+
+        stock['current_price'] = 0
+        self.assertIsNone(db.derived_values(stock)['expected_rate'])
+
+    def test_save_stock_rematerializes(self):
+        doc = {'code': '0001', 'current_price': 1200, 'bps': 1000, 'ROEs': [11.0, 8.0, 15.0, 10.0], 'last_year_index': 2}
+        with mock.patch.object(db, 'db') as database:
+            database.stocks.find.return_value = [dict(doc, adjusted_future_roe=20.0)]
+            db.save_stock({'code': '0001', 'adjusted_future_roe': 20.0}, read_back=False)
+        self.assertEqual({'code': '0001'}, database.stocks.find.call_args[0][0])
+        written = database.stocks.bulk_write.call_args[0][0][0]._doc['$set']
+        self.assertEqual(Stock(dict(doc, adjusted_future_roe=20.0)).expected_rate, written['expected_rate'])
+
+    def test_materialized_flag_rides_on_data_version(self):
+        with mock.patch.object(db, 'db') as database, mock.patch.object(db, 'meta_snapshot', {}):
+            database.meta.find_one.return_value = {'version': 3, 'derived_version': db.DERIVED_VERSION}
+            self.assertEqual(3, db.data_version())
+            self.assertTrue(db.is_materialized())
+            self.assertEqual(1, database.meta.find_one.call_count)
+            database.stocks.find_one.assert_not_called()
+
+            db.bump_data_version(materialized=False)
+            self.assertEqual({'derived_version': 1}, database.meta.update_one.call_args[0][1]['$unset'])
+            database.meta.find_one.return_value = {'version': 4, 'derived_version': db.DERIVED_VERSION - 1}
+            self.assertFalse(db.is_materialized())
+
+
+class FilterPlanTest(unittest.TestCase):
+    def test_plan_filter_options(self):
+        options = [
+            db.FilterOption(key='pbr', title='PBR', morethan=False, value=1.0, is_boolean=False),
+            db.FilterOption(key='dividend_rate', title='배당률', morethan=True, value=3.0, is_boolean=False),
+            db.FilterOption(key='expected_rate', title='기대수익률', morethan=True, value=15, is_boolean=False),
+            db.FilterOption(key='is_owned', title='보유종목(참)', morethan=None, value=None, is_boolean=True),
+        ]
+        predicates, remaining = db.plan_filter_options(options, materialized=False)
+        self.assertEqual([
+            {'$or': [{'pbr': {'$lte': 1.0}}, {'pbr': None}]},
+            {'dividend_rate': {'$gte': 3.0}},
+            {'owned': True},
+        ], predicates)
+        self.assertEqual(['expected_rate'], [o.key for o in remaining])
+
+        predicates, remaining = db.plan_filter_options(options, materialized=True)
+        self.assertIn({'expected_rate': {'$gte': 15}}, predicates)
+        self.assertEqual([], remaining)
+
+
+class StockUniverseTest(unittest.TestCase):
+    stock_dicts = [
+        {
+            'code': '0001',
+            'current_price': 1200,
+            'bps': 1000,
+            'ROEs': [11.0, 8.0, 15.0, 10.0],
+            'PBRs': [0.0, 0.8, 0.7, 0.5],
+            'NPs': [10, -5, 20, 30],
+            'CFOs': [(LAST_YEAR - 1, 3), (LAST_YEAR, 5)],
+            'FCFs': [(LAST_YEAR - 2, 1), (LAST_YEAR - 1, -1), (LAST_YEAR, 2)],
+            'last_year_index': 2,
+            'dividend_rate': 4.5,
+        },
+        {
+            'code': '0002',
+            'current_price': 800,
+            'bps': 1000,
+            'ROEs': [11.0, None, 15.0],
+            'PBRs': [1.2, 0.9, 1.1],
+            'NPs': [10, 5, -20],
+            'last_year_index': 2,
+            'adjusted_future_roe': 12.0,
+        },
+        {
+            'code': '0003',
+            'current_price': 5000,
+        },
+    ]
+
+    def test_metrics_match_stock(self):
+        stocks = universe.StockUniverse(self.stock_dicts)
+        for stock_dict in self.stock_dicts:
+            stock = Stock(stock_dict)
+            metrics = stocks.stock_metrics(stock['code'])
+            self.assertAlmostEqual(stock.future_roe, metrics['future_roe'])
+            self.assertEqual(stock.calc_future_bps(10), metrics['future_bps'])
+            self.assertAlmostEqual(stock.expected_rate, metrics['expected_rate'])
+            self.assertEqual(stock.low_pbr, metrics['low_pbr'])
+            self.assertEqual(stock.latest_fscore, metrics['latest_fscore'])
+        self.assertEqual(2, stocks.stock_metrics('0001')['FCF_surplus_years'])
+
+    def test_screen_and_rank(self):
+        stocks = universe.StockUniverse(self.stock_dicts)
+        option = db.FilterOption(key='expected_rate', title='기대수익률', morethan=True, value=0, is_boolean=False)
+        self.assertEqual(['0002', '0001'], stocks.screen([option], order_by='expected_rate', reverse=True))
+        self.assertEqual([2, 1, 3], list(stocks.rank('current_price', reverse=False)))
+
+    def test_stock_query_pushes_columnar_filters(self):
+        option = db.FilterOption(key='expected_rate', title='기대수익률', morethan=True, value=0, is_boolean=False)
+        with mock.patch.object(db, 'is_materialized', return_value=False), \
+                mock.patch.object(universe, 'current', return_value=universe.StockUniverse(self.stock_dicts)):
+            query, filter_funcs, _ = db.stock_query(filter_options=[option])
+            self.assertEqual(({'$and': [{'code': {'$in': ['0001', '0002']}}]}, []), (query, filter_funcs))
+            query, _, _ = db.stock_query()
+            self.assertEqual({'$and': [{'code': {'$in': ['0001', '0002']}}]}, query)
+
+    def test_update_ranks_matches_rank_values(self):
+        docs = [dict(d, pbr=pbr, relative_earning_rate=r) for d, pbr, r in zip(self.stock_dicts, [0.5, 0, 1.5], [3, 5, None])]
+        with mock.patch.object(db, 'db') as database, mock.patch.object(db, 'bump_data_version'), \
+                mock.patch.object(db, 'ensure_indexes'):
+            database.stocks.find.return_value = docs
+            db.update_ranks()
+            operations = database.stocks.bulk_write.call_args[0][0]
+        for spec in db.rank_specs:
+            values = [attr_or_key_getter(spec.key, Stock(d), default_value=None) for d in docs]
+            self.assertEqual(db.rank_values(values, spec.reverse), [o._doc['$set'][spec.rank_key] for o in operations])
+
+
+class StockWriterTest(unittest.TestCase):
+    def test_merges_partial_saves_into_one_upsert(self):
+        with mock.patch.object(db, 'db') as mongo:
+            writer = db.StockWriter(batch_size=2)
+            writer.save({'code': '0001', 'title': 'A'})
+            writer.save({'code': '0001', 'pbr': 1.2})
+            writer.commit('0001')
+            self.assertEqual(0, mongo.stocks.bulk_write.call_count)
+            writer.save({'code': '0002', 'title': 'B'})
+            writer.commit('0002')
+            self.assertEqual(1, mongo.stocks.bulk_write.call_count)
+            operations = mongo.stocks.bulk_write.call_args[0][0]
+            self.assertEqual(2, len(operations))
+            self.assertEqual(db.stamped({'code': '0001', 'title': 'A', 'pbr': 1.2}), operations[0]._doc)
+            self.assertEqual({'updated_at': True}, operations[0]._doc['$currentDate'])
+            writer.flush()
+            self.assertEqual(1, mongo.stocks.bulk_write.call_count)
+
+    def test_write_materializes_flushed_codes(self):
+        with mock.patch.object(db, 'db'), mock.patch.object(db, 'materialize_stocks') as materialize:
+            with db.StockWriter() as writer:
+                writer.save({'code': '0001', 'pbr': 1.2})
+                writer.save({'code': '0002', 'pbr': 0.8})
+        materialize.assert_called_once_with({'code': {'$in': ['0001', '0002']}})
+
+
+class CrawlTest(unittest.TestCase):
+    def test_crawl_isolates_failures(self):
+        def job(code):
+            if code == '0002':
+                raise ValueError(code)
+            return code != '0003'
+        failures = scrapper.crawl(['0001', '0002', '0003', '0004'], job, workers=2)
+        self.assertEqual(['0002', '0003'], sorted(f.code for f in failures))
+
+
+class IncrementalRefreshTest(unittest.TestCase):
+    def test_last_filing_deadline(self):
+        self.assertEqual(datetime(2018, 3, 31), scrapper.last_filing_deadline(datetime(2018, 4, 2)))
+        self.assertEqual(datetime(2017, 11, 14), scrapper.last_filing_deadline(datetime(2018, 1, 10)))
+
+    def test_plan_sections(self):
+        now = datetime(2018, 6, 1, 9)
+        self.assertEqual(scrapper.SECTIONS, scrapper.plan_sections({}, now))
+        fetched = {section: {'at': datetime(2018, 5, 31, 18), 'hash': ''} for section in scrapper.SECTIONS}
+        self.assertEqual([], scrapper.plan_sections({'fetched': fetched}, now))
+        fetched['basic']['at'] = datetime(2018, 5, 31, 9)
+        fetched['financial_ratio']['at'] = datetime(2018, 5, 10)
+        self.assertEqual(['basic', 'financial_ratio'], scrapper.plan_sections({'fetched': fetched}, now))
+
+    def test_failed_sections_back_off(self):
+        now = datetime(2018, 6, 1, 9)
+        fetched = {section: {'at': datetime(2018, 5, 31, 18), 'hash': ''} for section in scrapper.SECTIONS}
+        fetched['basic'] = {'at': datetime(2018, 6, 1, 2), 'hash': None, 'failures': 1}
+        fetched['fnguide'] = {'at': datetime(2018, 6, 1), 'hash': None, 'failures': 2}
+        self.assertEqual(['basic'], scrapper.plan_sections({'fetched': fetched}, now))
+        self.assertEqual(['basic', 'fnguide'], scrapper.plan_sections({}, now)[:2])
+        self.assertEqual(['basic', 'fnguide'], scrapper.plan_sections({'use_fnguide': False}, now))
+
+    def test_failed_section_is_stamped(self):
+        writer = mock.Mock()
+        stock = {'code': '0001', 'fetched': {'basic': {'at': datetime(2018, 5, 1), 'hash': 'abc', 'failures': 1}}}
+        with mock.patch.object(scrapper, 'parse_basic', return_value=False):
+            self.assertFalse(scrapper.parse_snowball_pages('0001', writer, stock, scrapper.SECTIONS))
+        stamp = writer.save.call_args[0][0]['fetched.basic']
+        self.assertEqual(('abc', 2), (stamp['hash'], stamp['failures']))
+
+        writer.reset_mock()
+        with mock.patch.object(scrapper, 'parse_basic', return_value=False):
+            scrapper.parse_snowball_pages('0002', writer, {}, scrapper.SECTIONS)
+        writer.save.assert_not_called()
+
+    def test_unchanged_section_only_updates_stamp(self):
+        writer = mock.Mock()
+        stock = {'code': '0001', 'FCFs': [(2017, 10)]}
+        previous = {'hash': scrapper.content_hash(stock)}
+        scrapper.SectionWriter(writer, 'invest_guide', previous).save(stock)
+        saved = writer.save.call_args[0][0]
+        self.assertEqual(['code', 'fetched.invest_guide'], sorted(saved.keys()))
+
+
+class PipelineTest(unittest.TestCase):
+    def test_checkpoint_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = tmp + '/company.csv.json'
+            pipeline.Checkpoint(path).mark(['0001', '0002'])
+            checkpoint = pipeline.Checkpoint(path)
+            self.assertEqual({'0001', '0002'}, checkpoint.done)
+            checkpoint.clear()
+            self.assertEqual(set(), pipeline.Checkpoint(path).done)
+
+    def test_write_results_marks_flushed_codes(self):
+        parsed = pipeline.queue.Queue()
+        for code in ['0001', '0002', '0003']:
+            parsed.put((code, [('basic', {'code': code, 'title': code})]))
+        parsed.put(pipeline.DONE)
+        checkpoint = mock.Mock()
+        with mock.patch.object(db.StockWriter, 'write') as write:
+            self.assertEqual(3, pipeline.write_results(parsed, checkpoint, batch_size=2))
+        self.assertEqual([mock.call(['0001', '0002']), mock.call(['0003'])], checkpoint.mark.call_args_list)
+        self.assertEqual(['0001', '0002'], write.call_args_list[0][0][0])
+
+    def test_parse_pages_falls_back_to_naver(self):
+        extractors = {section: mock.Mock(return_value={'code': '0001'}) for section in scrapper.SECTIONS}
+        extractors['fnguide'].return_value = None
+        naver = {'code': '0001', 'use_fnguide': False}
+        extractors['naver_company'] = mock.Mock(return_value=naver)
+        pages = {section: b'<html></html>' for section in scrapper.SECTIONS}
+        fetch = mock.Mock(return_value=b'<html></html>')
+        with mock.patch.dict(pipeline.EXTRACTORS, extractors):
+            results = pipeline.parse_pages('0001', pages, fetch=fetch)
+        self.assertEqual([('basic', {'code': '0001'}), ('fnguide', naver)], results)
+        fetch.assert_called_once_with(scrapper.NAVER_COMPANY + '0001')
+        extractors['invest_guide'].assert_not_called()
+
+        extractors['naver_company'].return_value = None
+        with mock.patch.dict(pipeline.EXTRACTORS, extractors):
+            self.assertEqual([('basic', {'code': '0001'})], pipeline.parse_pages('0001', pages, fetch=fetch))
+
+    def test_fetch_pages_stops_after_invalid_basic(self):
+        fetch = mock.Mock(return_value=b'<html></html>')
+        with mock.patch.dict(pipeline.EXTRACTORS, {'basic': mock.Mock(return_value=None)}):
+            self.assertIsNone(pipeline.fetch_pages('0001', fetch=fetch))
+        fetch.assert_called_once_with(scrapper.page_url('basic', '0001'))
+
+        with mock.patch.dict(pipeline.EXTRACTORS, {'basic': mock.Mock(return_value={'code': '0001'})}):
+            self.assertEqual(scrapper.SECTIONS, list(pipeline.fetch_pages('0001', fetch=fetch)))
+
+    def test_extract_pages_in_process_pool(self):
+        pages = {section: b'<html><body></body></html>' for section in scrapper.SECTIONS}
+        with pipeline.ProcessPoolExecutor(max_workers=1) as pool:
+            self.assertIsNone(pipeline.parse_pages('0001', pages, pool=pool))
+
+
+class ExtractionTest(unittest.TestCase):
+    DAUM = '''<html><body>
+        <div id="topWrap"><div><h2>삼성전자</h2>
+            <ul><li></li><li><a>KOSPI</a></li></ul>
+            <ul><li><em>45,000</em></li><li><span class="down">500</span></li><li><span>-1.10%</span></li>
+                <li></li><li><span>1,000</span></li><li><span>2,000</span></li></ul>
+        </div></div>
+        <div id="stockContent"><ul></ul><ul><li></li>
+            <li><dl></dl><dl><dd>3,000,000</dd></dl></li>
+            <li><dl></dl><dl><dd>PER / 8.5</dd></dl></li>
+            <li><dl></dl><dl><dd>PBR / 1.2</dd></dl></li>
+        </ul></div>
+    </body></html>'''
+
+    def test_extract_basic(self):
+        stock = scrapper.extract_basic(html.fromstring(self.DAUM), '005930')
+        self.assertEqual('삼성전자', stock['title'])
+        self.assertEqual(45000, stock['current_price'])
+        self.assertEqual(-500, stock['price_diff'])
+        self.assertEqual(-1.1, stock['rate_diff'])
+        self.assertEqual('KOSPI', stock['exchange'])
+        self.assertEqual((8.5, 1.2), (stock['per'], stock['pbr']))
+        self.assertNotIn('diff', stock)
+        self.assertIsNone(scrapper.extract_basic(html.fromstring('<html><body></body></html>'), '005930'))
+
+    def test_optional_spec_without_anchor(self):
+        spec = extraction.Spec('//table', {
+            'value': extraction.Field('tr/td/text()', extraction.first()),
+            'values': extraction.Field('tr/td/text()', extraction.each(int)),
+        })
+        tree = html.fromstring('<html><body><p>-</p></body></html>')
+        self.assertEqual({'value': None, 'values': []}, spec.extract(tree))
+        tree = html.fromstring('<html><body><table><tr><td>1</td><td>2</td></tr></table></body></html>')
+        self.assertEqual({'value': '1', 'values': [1, 2]}, spec.extract(tree))
+
+    def test_optional_spec_with_missing_anchor_uses_first_text(self):
+        tree = html.fromstring(self.DAUM.replace('id="stockContent"', 'id="otherContent"'))
+        stock = scrapper.extract_basic(tree, '005930')
+        self.assertEqual((None, None, None), (stock['per'], stock['pbr'], stock['agg_value']))
+        self.assertEqual(45000, stock['current_price'])
+
+    def test_fnguide_without_title_or_company_header(self):
+        self.assertIsNone(scrapper.extract_fnguide(html.fromstring('<h1 id="giName"></h1>'), '0001'))
+        tree = html.fromstring('<html><body><h1 id="giName">삼성전자</h1></body></html>')
+        header = scrapper.FNGUIDE_SPECS[0].extract(tree)
+        self.assertEqual({'group': None, 'subgroup': None, 'closing_month': None}, header)
+
+
+class PriceStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.price_dir = mock.patch.object(pricestore, 'PRICE_DIR', self.tmp.name)
+        self.price_dir.start()
+
+    def tearDown(self):
+        self.price_dir.stop()
+        self.tmp.cleanup()
+
+    def test_append_only_new_candles(self):
+        self.assertIsNone(pricestore.last_date('0001'))
+        candles = pricestore.to_candles([date(2018, 1, 3), date(2018, 1, 2)], [110, 100])
+        self.assertEqual(2, pricestore.append('0001', candles))
+        candles = pricestore.to_candles([date(2018, 1, 3), date(2018, 1, 4)], [110, 120])
+        self.assertEqual(1, pricestore.append('0001', candles))
+        self.assertEqual(date(2018, 1, 4), pricestore.last_date('0001'))
+        self.assertEqual([100, 110, 120], pricestore.load('0001')['close'].tolist())
+        self.assertEqual([110, 120], pricestore.read_range('0001', start=date(2018, 1, 3))['close'].tolist())
+        self.assertEqual([100], pricestore.read_range('0001', end=date(2018, 1, 2))['close'].tolist())
+
+    def test_incremental_sync_requests_only_new_days(self):
+        pricestore.append('0001', pricestore.to_candles([date(2018, 1, 2)], [100]))
+        candles = [{'date': '2018-01-04T00:00:00', 'tradePrice': 120}, {'date': '2018-01-03T00:00:00', 'tradePrice': 110}]
+        with mock.patch.object(historical, 'load_kakao_json', return_value=candles) as load:
+            historical.parse_day_candles('0001', date='2018-01-04')
+        load.assert_called_once_with('0001', '2018-01-04', limit=2)
+        self.assertEqual([100, 110, 120], pricestore.load('0001')['close'].tolist())
+
+    def test_sync_prices_once_per_calendar_day(self):
+        with mock.patch.object(historical, 'parse_day_candles') as parse, mock.patch.dict(historical.synced_on, clear=True):
+            historical.sync_prices('0001', now=datetime(2018, 1, 5, 9))
+            historical.sync_prices('0001', now=datetime(2018, 1, 5, 18))
+            historical.sync_prices('0001', now=datetime(2018, 1, 6, 9))
+        self.assertEqual([mock.call('0001', '2018-01-04'), mock.call('0001', '2018-01-05')], parse.call_args_list)
+
+    def test_concurrent_appends_write_each_day_once(self):
+        candles = pricestore.to_candles([date(2018, 1, d) for d in range(2, 30)], list(range(28)))
+        threads = [threading.Thread(target=pricestore.append, args=('0001', candles)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(28, len(pricestore.load('0001')))
+
+
+class BacktestTest(unittest.TestCase):
+    def setUp(self):
+        self.stock = Stock({'code': '0001', 'current_price': 10000, 'last_year_index': 4,
+            'ROEs': [10.0, 12.0, 15.0, 14.0, 13.0], 'BPSs': [8000, 9000, 10000, 11000, 12000]})
+        days = [datetime(LAST_YEAR - 1, 1, 2) + (datetime(2018, 1, 8) - datetime(2018, 1, 1)) * i for i in range(100)]
+        prices = [10000 + ((i * 7919) % 23 - 11) * 300 for i in range(100)]
+        self.candles = pricestore.to_candles([d.date() for d in days], prices)
+
+    def historical_events(self, params):
+        records = [historical.make_record(d, p, dict(self.stock.year_stat('BPSs', exclude_future=True)).get(d.year - 1), self.stock)
+            for d, p in zip(self.candles['date'].tolist(), self.candles['close'].tolist())]
+        by_year = [(year, list(g)) for year, g in historical.itertools.groupby(records, lambda r: r.date.year)]
+        by_year = [(historical.make_year_stat(year, rs), rs) for year, rs in by_year]
+        return historical.simulate(by_year, params)
+
+    def test_matches_historical_simulate(self):
+        series = backtest.build_series(self.stock, self.candles)
+        for params in [historical.DEFAULT_PARAMS, historical.SimulationParams(16.0, 0.5, 0.05)]:
+            expected = self.historical_events(params)
+            events = backtest.simulate_series(series, params)
+            self.assertEqual([(e.date, e.buy, e.record.price) for e in expected], [(e.date, e.buy, e.record.price) for e in events])
+            for e, actual in zip(expected, events):
+                self.assertAlmostEqual(e.record.expected_rate, actual.record.expected_rate)
+            self.assertEqual(historical.event_stat(expected).buy_count, backtest.trade_stat(series, params).buy_count)
+            self.assertAlmostEqual(historical.event_stat(expected).profit, backtest.trade_stat(series, params).profit)
+
+    def test_run_aggregates_event_stats(self):
+        params = historical.SimulationParams(16.0, 0.5, 0.05)
+        series = backtest.build_series(self.stock, self.candles)
+        events, stat = backtest.run([series, series._replace(code='0002')], params)
+        self.assertEqual(['0001', '0002'], sorted(events.keys()))
+        self.assertGreater(stat.buy_count, 0)
+        self.assertEqual(2 * historical.event_stat(events['0001']).sell_count, stat.sell_count)
+
+    def test_sweep_ranks_grid_by_profit(self):
+        series = backtest.build_series(self.stock, self.candles)
+        grid = backtest.param_grid([13.5, 16.0, 20.0], [0.5, 1.2], [0.05, 0.13])
+        results = backtest.sweep([series, series._replace(code='0002')], grid, workers=2)
+        self.assertEqual(sorted(grid), sorted(r.params for r in results))
+        profits = [r.stat.profit for r in results]
+        self.assertEqual(sorted(profits, reverse=True), profits)
+        by_params = dict(results)
+        self.assertEqual(backtest.combine([backtest.trade_stat(series, grid[0])] * 2), by_params[grid[0]])
+
+
+    def test_load_series_syncs_missing_codes(self):
+        docs = [{'code': code, **{k: v for k, v in self.stock.items() if k != 'code'}} for code in ['0001', '0002', '0003']]
+
+        def sync_prices(code):
+            if code == '0003':
+                raise ValueError(code)
+            pricestore.append(code, self.candles)
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(pricestore, 'PRICE_DIR', tmp), \
+                mock.patch.object(db, 'db') as database, mock.patch.object(historical, 'sync_prices', side_effect=sync_prices), \
+                mock.patch('builtins.print') as printed:
+            database.stocks.find.return_value = docs
+            pricestore.append('0001', self.candles)
+            series = backtest.load_series(workers=2)
+            results = backtest.sweep(series, backtest.param_grid([13.5], [0.5], [0.05]), workers=1)
+        self.assertEqual(['0001', '0002'], sorted(s.code for s in series))
+        self.assertEqual(2 * backtest.trade_stat(series[0], results[0].params).buy_count, results[0].stat.buy_count)
+        printed.assert_any_call('가격 데이터가 없어 1 종목 제외')
+
+class RecordsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.patches = [mock.patch.object(pricestore, 'PRICE_DIR', self.tmp.name),
+            mock.patch.object(historical, 'sync_prices'), mock.patch.dict(historical.records_cache, clear=True)]
+        for patch in self.patches:
+            patch.start()
+        self.stock = Stock({'code': '0001', 'last_year_index': 4,
+            'ROEs': [10.0, 12.0, 15.0, 14.0, 13.0], 'BPSs': [8000, 9000, 10000, 11000, 12000]})
+        days = [date(LAST_YEAR - 1, 12, 1) + (date(2018, 1, 8) - date(2018, 1, 1)) * i for i in range(10)]
+        self.candles = pricestore.to_candles(days, [10000 + (i % 4) * 500 for i in range(10)])
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        self.tmp.cleanup()
+
+    def test_extends_only_with_new_candles(self):
+        pricestore.append('0001', self.candles[:6])
+        first = historical.records_by_year(self.stock)
+        with mock.patch.object(historical, 'records_from', wraps=historical.records_from) as records_from:
+            self.assertIs(first, historical.records_by_year(self.stock))
+            records_from.assert_not_called()
+
+            pricestore.append('0001', self.candles[6:])
+            extended = historical.records_by_year(self.stock)
+            self.assertEqual(4, len(records_from.call_args[0][1]))
+
+        historical.records_cache.clear()
+        self.assertEqual(historical.records_by_year(self.stock), extended)
+
+    def test_rescrape_rebuilds(self):
+        pricestore.append('0001', self.candles)
+        first = historical.records_by_year(self.stock)
+        self.stock['BPSs'] = [8000, 9000, 10000, 13000, 12000]
+        self.assertNotEqual(first, historical.records_by_year(self.stock))
+        self.assertEqual([('0001', historical.fundamentals_version(self.stock))], list(historical.records_cache))
+
+    def test_cache_is_bounded(self):
+        cached = historical.CachedRecords(version='v', last_date=None, by_year=[], result=[])
+        with mock.patch.object(historical, 'RECORDS_CACHE_SIZE', 2):
+            for code in ['0001', '0002', '0003']:
+                historical.cache_records(code, cached)
+                historical.cached_records('0001', 'v')
+        self.assertEqual([('0003', 'v'), ('0001', 'v')], list(historical.records_cache))
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.collection = mock.patch.object(jobs, 'jobs')
+        self.jobs = self.collection.start()
+
+    def tearDown(self):
+        self.collection.stop()
+
+    def test_enqueue_merges_queued_job(self):
+        self.jobs.find_one_and_delete.return_value = None
+        self.jobs.update_one.return_value = mock.Mock(upserted_id='new')
+        self.assertTrue(jobs.enqueue('0001', priority=2))
+        query, update = self.jobs.update_one.call_args[0]
+        self.assertEqual({'code': '0001', 'kind': jobs.SNOWBALL, 'status': jobs.QUEUED}, query)
+        self.assertEqual({'priority': 2}, update['$max'])
+
+        self.jobs.update_one.return_value = mock.Mock(upserted_id=None)
+        self.assertFalse(jobs.enqueue('0001'))
+
+    def test_snowball_and_refresh_share_one_job(self):
+        self.jobs.find_one_and_delete.return_value = {'code': '0001', 'kind': jobs.REFRESH, 'priority': 30}
+        self.jobs.update_one.return_value = mock.Mock(upserted_id='new')
+        self.assertTrue(jobs.enqueue('0001', priority=0))
+        self.assertEqual({'priority': 30}, self.jobs.update_one.call_args[0][1]['$max'])
+
+        self.jobs.update_one.reset_mock()
+        self.jobs.find_one.return_value = {'_id': 1}
+        self.assertFalse(jobs.enqueue('0001', kind=jobs.REFRESH, priority=30, sections=['basic']))
+        self.jobs.update_one.assert_not_called()
+
+    def test_user_job_is_claimed_before_tiers(self):
+        queued = [
+            {'_id': 1, 'code': '0001', 'kind': jobs.REFRESH, 'status': jobs.QUEUED, 'priority': 30, 'created_at': datetime(2018, 6, 1)},
+            {'_id': 2, 'code': '0002', 'kind': jobs.SNOWBALL, 'status': jobs.QUEUED, 'priority': jobs.USER_PRIORITY, 'created_at': datetime(2018, 6, 2)},
+        ]
+
+        def find_one_and_update(find, update, sort, return_document):
+            for key, direction in reversed(sort):
+                queued.sort(key=lambda job: job[key], reverse=direction == DESCENDING)
+            return queued[0]
+        self.jobs.find_one_and_update.side_effect = find_one_and_update
+        self.assertTrue(jobs.USER_PRIORITY > max(tier.priority for tier in scheduler.TIERS))
+        self.assertEqual('0002', jobs.claim()['code'])
+
+    def test_work_one_records_failure(self):
+        self.jobs.find_one_and_update.return_value = {'_id': 1, 'code': '0001', 'kind': jobs.SNOWBALL}
+        with mock.patch.object(scrapper, 'parse_snowball', return_value=False):
+            self.assertTrue(jobs.work_one())
+        self.assertEqual(jobs.FAILED, self.jobs.update_one.call_args[0][1]['$set']['status'])
+
+        self.jobs.find_one_and_update.return_value = None
+        self.assertFalse(jobs.work_one())
+
+    def test_queue_stats_counts_running_on_server(self):
+        self.jobs.aggregate.return_value = [{'_id': 20, 'depth': 3, 'oldest': datetime(2018, 6, 1, 11, 59)}]
+        self.jobs.count_documents.return_value = 2
+        stats = jobs.queue_stats(now=datetime(2018, 6, 1, 12))
+        self.assertEqual((3, 2, 60.0), (stats['depth'], stats['running'], stats['lag']))
+        self.jobs.count_documents.assert_called_once_with({'status': jobs.RUNNING})
+
+    def test_duplicate_enqueue_merges_into_winner(self):
+        self.jobs.find_one_and_delete.return_value = None
+        self.jobs.update_one.side_effect = [jobs.DuplicateKeyError('queued_once'), mock.Mock(upserted_id=None)]
+        self.assertFalse(jobs.enqueue('0001', priority=jobs.USER_PRIORITY))
+        query, update = self.jobs.update_one.call_args[0]
+        self.assertEqual(({'code': '0001', 'kind': jobs.SNOWBALL, 'status': jobs.QUEUED}, {'priority': jobs.USER_PRIORITY}),
+            (query, update['$max']))
+        self.assertEqual({}, self.jobs.update_one.call_args[1])
+
+    def test_app_creates_indexes_once(self):
+        with mock.patch.object(db, 'ensure_indexes') as db_indexes, mock.patch.object(app, 'indexes_ready', False):
+            app.ensure_indexes()
+            app.ensure_indexes()
+        db_indexes.assert_called_once_with()
+        self.assertEqual(3, self.jobs.create_index.call_count)
+
+    def test_finished_jobs_expire(self):
+        jobs.ensure_indexes()
+        self.jobs.create_index.assert_any_call('finished_at', expireAfterSeconds=int(jobs.FINISHED_TTL.total_seconds()))
+
+
+class SchedulerTest(unittest.TestCase):
+    def test_owned_first_within_budget(self):
+        now = datetime(2018, 6, 1, 12)
+        fresh = {section: {'at': now, 'hash': ''} for section in scrapper.SECTIONS}
+        hour_old = {**fresh, 'basic': {'at': datetime(2018, 6, 1, 10, 30), 'hash': ''}}
+        owned = {'0001': {'code': '0001', 'fetched': hour_old}}
+        universe = {code: {'code': code} for code in ['0002', '0003', '0004']}
+        universe['0005'] = {'code': '0005', 'fetched': hour_old}
+        targets = lambda find=None, **kwargs: owned if find == {'owned': True} else {} if find else {**owned, **universe}
+
+        budget = scheduler.RequestBudget(pages_per_hour=20)
+        with mock.patch.object(scrapper, 'snowball_targets', side_effect=targets), \
+                mock.patch.object(jobs, 'pending_codes', return_value={'0002'}), \
+                mock.patch.object(jobs, 'failed_codes', return_value=set()), \
+                mock.patch.object(jobs, 'enqueue') as enqueue:
+            scheduled = scheduler.schedule(budget, now)
+        self.assertEqual({'owned': 1, 'starred': 0, 'universe': 2}, scheduled)
+        calls = [(c[0][0], c[1]['priority'], c[1]['sections']) for c in enqueue.call_args_list]
+        self.assertEqual([('0001', 30, ['basic']), ('0003', 10, scrapper.SECTIONS), ('0004', 10, scrapper.SECTIONS)], calls)
+        self.assertFalse(budget.take(9, reserve=0.3))
+
+    def test_failed_stock_does_not_hog_budget(self):
+        now = datetime(2018, 6, 1, 12)
+        stocks = {code: {'code': code} for code in ['0001', '0002', '0003']}
+        targets = lambda find=None, **kwargs: {} if find else stocks
+        failed = set()
+
+        def enqueue(code, **kwargs):
+            if code == '0001':
+                failed.add(code)
+        budget = scheduler.RequestBudget(pages_per_hour=100)
+        with mock.patch.object(scrapper, 'snowball_targets', side_effect=targets), \
+                mock.patch.object(jobs, 'pending_codes', return_value=set()), \
+                mock.patch.object(jobs, 'failed_codes', side_effect=lambda: set(failed)), \
+                mock.patch.object(jobs, 'enqueue', side_effect=enqueue) as enqueued, \
+                mock.patch.object(budget, 'take', side_effect=[True, False, True, False]):
+            scheduler.schedule(budget, now)
+            scheduler.schedule(budget, now)
+        self.assertEqual(['0001', '0002'], [c[0][0] for c in enqueued.call_args_list])
+
+
+class ETFStatsTest(unittest.TestCase):
+    def test_materialize_etf_stats(self):
+        etfs = [
+            {'code': '069500', 'title': 'KODEX 200', 'tags': ['지수'], 'month1': 1, 'month3': 4, 'month6': 2, 'month12': 8},
+            {'code': '148070', 'title': '국고채', 'tags': ['채권'], 'month1': 1, 'month3': 6, 'month6': 1, 'month12': 1},
+            {'code': '279530', 'title': '고배당', 'tags': ['배당', '지수'], 'month1': 3, 'month3': 2, 'month6': 4, 'month12': 0},
+        ]
+        with mock.patch.object(db, 'db') as database:
+            database.etf.find.return_value = etfs
+            stats = db.materialize_etf_stats('domestic')
+            saved = database.etf_stats.replace_one.call_args[0][1]
+
+        self.assertEqual(['채권', '지수', '배당'], [tag['tag'] for tag in saved['tags']])
+        self.assertEqual({'tag': '지수', 'month1': 2, 'month3': 3, 'month6': 3, 'month12': 4, 'codes': ['069500', '279530']}, saved['tags'][1])
+        self.assertEqual('069500', saved['absolute_momentum_high']['code'])
+        self.assertEqual('148070', saved['relative_momentum_etf']['code'])
+        self.assertEqual(3, saved['absolute_momentum_momentum_base_avg'])
+
+        tag = db.ETFTag.from_stats(saved['tags'][1], {etf['code']: etf for etf in etfs})
+        self.assertEqual((3, ['069500', '279530']), (tag.month3, [etf['code'] for etf in tag.etfs]))
+
+    def test_etf_writer_batches_upserts(self):
+        with mock.patch.object(db, 'db') as database:
+            with db.ETFWriter(batch_size=2) as writer:
+                for code in ['069500', '148070', '279530']:
+                    writer.save({'code': code, 'type': 'domestic'})
+                self.assertEqual(1, database.etf.bulk_write.call_count)
+            self.assertEqual(2, database.etf.bulk_write.call_count)
+            operations = database.etf.bulk_write.call_args[0][0]
+            self.assertEqual(({'code': '279530'}, True), (operations[0]._filter, operations[0]._upsert))
+            database.etf.find_one.assert_not_called()
+
+            db.ensure_indexes()
+            database.etf.create_index.assert_any_call('type')
+
+
+class StocksPageTest(unittest.TestCase):
+    def test_keyset_page(self):
+        docs = [{'code': '000{}'.format(i), 'expected_rate': 20 - i} for i in range(3)]
+        with mock.patch.object(db, 'is_materialized', return_value=True), mock.patch.object(db, 'db') as database:
+            page = docs
+            database.stocks.find.side_effect = lambda query, **kwargs: page
+            database.stocks.count_documents.return_value = 3
+            stocks, cursor, total = db.stocks_page(limit=2, order_by='expected_rate', ordering='desc')
+            self.assertEqual(['0000', '0001'], [s['code'] for s in stocks])
+            self.assertEqual({'value': 19, 'code': '0001'}, db.decode_cursor(cursor))
+            self.assertEqual(3, database.stocks.find.call_args[1]['limit'])
+            self.assertEqual(3, total)
+
+            page = docs[2:]
+            stocks, cursor, total = db.stocks_page(cursor=cursor, limit=2, order_by='expected_rate', ordering='desc')
+            self.assertEqual((None, 3), (cursor, total))
+            query = database.stocks.find.call_args[0][0]
+            self.assertEqual(db.keyset_predicate('expected_rate', True, 19, '0001'), query['$and'][1])
+            self.assertEqual(query['$and'][0], database.stocks.count_documents.call_args[0][0])
+
+    def test_keyset_predicate_keeps_nulls_last(self):
+        self.assertIn({'expected_rate': None}, db.keyset_predicate('expected_rate', True, 10, '0001')['$or'])
+        self.assertEqual({'expected_rate': None, 'code': {'$gt': '0001'}}, db.keyset_predicate('expected_rate', True, None, '0001'))
+
+    def test_offset_page_for_python_sorted_keys(self):
+        stocks = [Stock({'code': str(i)}) for i in range(5)]
+        with mock.patch.object(db, 'is_materialized', return_value=False), \
+                mock.patch.object(db, 'universe_predicate', return_value={}), \
+                mock.patch.object(db, 'all_stocks', return_value=stocks):
+            page, cursor, total = db.stocks_page(limit=2, order_by='mean_ROIC')
+            self.assertEqual((['0', '1'], 5), ([s['code'] for s in page], total))
+            page, cursor, _ = db.stocks_page(cursor=cursor, limit=2, order_by='mean_ROIC')
+            page, cursor, _ = db.stocks_page(cursor=cursor, limit=2, order_by='mean_ROIC')
+            self.assertEqual((['4'], None), ([s['code'] for s in page], cursor))
+
+    def test_top_ranked_matches_full_sort(self):
+        docs = [{'code': str(i), 'expected_rate': 20 - i, 'pbr': (i * 7) % 5 + 1, 'per': i % 3 + 1} for i in range(10)]
+        ranks = [db.RankOption(key='rank_pbr', title='PBR', asc=True, is_rankoption=True),
+            db.RankOption(key='rank_per', title='PER', asc=True, is_rankoption=True)]
+        with mock.patch.object(db, 'is_materialized', return_value=False), mock.patch.object(db, 'db') as database, \
+                mock.patch.object(ranking, 'shared', ranking.RankEngine()):
+            database.meta.find_one.return_value = {}
+            database.stocks.find.side_effect = lambda *args, **kwargs: [dict(d) for d in docs]
+            full = db.all_stocks(order_by='code', rank_options=ranks)
+            top = db.all_stocks(order_by='code', rank_options=ranks, limit=3)
+            page, _, total = db.stocks_page(limit=3, order_by='code', rank_options=ranks)
+        self.assertEqual(([s['code'] for s in top], 10), ([s['code'] for s in page], total))
+        self.assertEqual([s['code'] for s in full[:3]], [s['code'] for s in top])
+        self.assertEqual([s['total_rank'] for s in full[:3]], [s['total_rank'] for s in top])
+
+    def test_top_ranked_breaks_ties_by_reversed_title(self):
+        docs = [{'code': str(i), 'title': 'ABCDE'[i], 'pbr': 0} for i in range(5)]
+        ranks = [db.RankOption(key='rank_pbr', title='PBR', asc=True, is_rankoption=True)]
+        with mock.patch.object(db, 'is_materialized', return_value=False), mock.patch.object(db, 'db') as database, \
+                mock.patch.object(ranking, 'shared', ranking.RankEngine()):
+            database.meta.find_one.return_value = {}
+            database.stocks.find.side_effect = lambda *args, **kwargs: [dict(d) for d in docs]
+            full = db.all_stocks(order_by='title', ordering='desc', rank_options=ranks)
+            top = db.all_stocks(order_by='title', ordering='desc', rank_options=ranks, limit=5)
+        self.assertEqual(['4', '3', '2', '1', '0'], [s['code'] for s in full])
+        self.assertEqual([s['code'] for s in full], [s['code'] for s in top])
+
+
+class RankEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.docs = [{'code': '000{}'.format(i), 'pbr': [0.8, 1.5, 0, 0.5, 2.0][i], 'per': [10, 4, 7, 0, 12][i]} for i in range(5)]
+
+    def engine_for(self, docs) -> ranking.RankEngine:
+        engine = ranking.RankEngine()
+        for doc in docs:
+            engine.update(Stock(doc))
+        return engine
+
+    def test_matches_full_rebuild(self):
+        engine = self.engine_for(self.docs)
+        self.assertEqual(db.rank_values([d['pbr'] for d in self.docs], False),
+            [engine.rank(d['code'], 'rank_pbr') for d in self.docs])
+
+        self.docs[1]['pbr'] = 0.1
+        engine.update(Stock(self.docs[1]))
+        self.assertEqual(db.rank_values([d['pbr'] for d in self.docs], False),
+            [engine.rank(d['code'], 'rank_pbr') for d in self.docs])
+
+        engine.remove('0000')
+        self.assertEqual([1, 4, 2, 3], [engine.rank(d['code'], 'rank_pbr') for d in self.docs[1:]])
+
+    def test_combined_rank(self):
+        engine = self.engine_for(self.docs)
+        options = [db.RankOption(key='rank_pbr', title='PBR', asc=True, is_rankoption=True),
+            db.RankOption(key='rank_per', title='PER', asc=True, is_rankoption=True)]
+        self.assertEqual(2 + 3, engine.combined('0000', options))
+
+    def test_load_matches_incremental_updates(self):
+        engine = ranking.RankEngine()
+        engine.load(self.docs)
+        updated = self.engine_for(self.docs)
+        for d in self.docs:
+            self.assertEqual(updated.ranks(d['code']), engine.ranks(d['code']))
+
+    def test_reads_wait_for_sync(self):
+        engine = self.engine_for(self.docs)
+        with engine.lock:
+            reader = threading.Thread(target=engine.ranks, args=('0000',))
+            reader.start()
+            reader.join(0.05)
+            self.assertTrue(reader.is_alive())
+        reader.join()
+        self.assertFalse(reader.is_alive())
+
+    def test_sync_follows_server_stamps(self):
+        engine = ranking.RankEngine()
+        bumped = datetime(2020, 1, 2)
+        written = datetime(2020, 1, 3)
+        self.docs[0]['updated_at'] = written
+        with mock.patch.object(db, 'db') as database, mock.patch.object(db, 'meta_snapshot', {}):
+            database.meta.find_one.return_value = {'version': 1, 'updated_at': bumped}
+            database.stocks.find.return_value = self.docs
+            self.assertEqual(5, engine.sync())
+            self.assertEqual({}, database.stocks.find.call_args[0][0])
+            self.assertEqual(written, engine.synced_at)
+
+            database.stocks.find.return_value = []
+            engine.sync()
+            self.assertEqual({'updated_at': {'$gte': written - ranking.SYNC_OVERLAP}}, database.stocks.find.call_args[0][0])
+            self.assertEqual(written, engine.synced_at)
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = app.ResponseCache(max_entries=2, max_bytes=10)
+        cache.put('a', (b'1234', 'text/html'))
+        cache.put('b', (b'1234', 'text/html'))
+        cache.get('a')
+        cache.put('c', (b'1234', 'text/html'))
+        self.assertEqual(['a', 'c'], list(cache.entries))
+        cache.put('d', (b'12345678901', 'text/html'))
+        self.assertNotIn('d', cache.entries)
+        self.assertEqual(8, cache.size)
+
+    def test_filter_write_lands_before_version_bump(self):
+        with mock.patch.object(db, 'db') as database:
+            db.save_filter({'name': '새필터1', 'options': []})
+        names = [name for name, _, _ in database.mock_calls]
+        self.assertLess(names.index('filters.insert_one'), names.index('meta.update_one'))
+
+    def test_keyed_by_query_and_data_version(self):
+        render = mock.Mock(return_value='<html></html>')
+        view = app.cached_view(render)
+        with mock.patch.object(app, 'response_cache', app.ResponseCache()), \
+                mock.patch.object(db, 'data_version', return_value=1) as version:
+            for query in ['/stocks?order_by=pbr', '/stocks?order_by=pbr', '/stocks?order_by=per']:
+                with app.app.test_request_context(query):
+                    self.assertEqual(b'<html></html>', view().get_data())
+            self.assertEqual(2, render.call_count)
+            version.return_value = 2
+            with app.app.test_request_context('/stocks?order_by=pbr'):
+                view()
+            self.assertEqual(3, render.call_count)
+
+
+class FetcherCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = mock.patch.object(fetcher, 'CACHE_DIR', self.tmp.name)
+        self.cache_dir.start()
+
+    def tearDown(self):
+        self.cache_dir.stop()
+        fetcher.configure_cache(fetcher.CACHE_OFF)
+        self.tmp.cleanup()
+
+    def test_cache_and_replay(self):
+        response = mock.Mock(status_code=200, content=b'<html></html>', headers={'ETag': '"1"'})
+        url = 'http://comp.fnguide.com/page'
+        with mock.patch.object(fetcher, 'request', return_value=response) as request:
+            fetcher.configure_cache(fetcher.CACHE_ON)
+            self.assertEqual(b'<html></html>', fetcher.get(url))
+            self.assertEqual(b'<html></html>', fetcher.get(url))
+            self.assertEqual(1, request.call_count)
+
+            fetcher.configure_cache(fetcher.CACHE_REPLAY)
+            self.assertEqual(b'<html></html>', fetcher.get(url))
+            self.assertRaises(fetcher.CacheMiss, fetcher.get, 'http://comp.fnguide.com/other')
+            self.assertEqual(1, request.call_count)
+
+    def stubbed_session(self, *responses):
+        session = mock.Mock()
+        session.get.side_effect = list(responses)
+        return mock.patch.object(fetcher, 'session_for', return_value=session), session
+
+    def test_expires_by_host_ttl(self):
+        url = 'http://finance.naver.com/page'
+        patch, session = self.stubbed_session(
+            mock.Mock(status_code=200, content=b'old', headers={}),
+            mock.Mock(status_code=200, content=b'new', headers={}))
+        fetcher.configure_cache(fetcher.CACHE_ON)
+        with patch, mock.patch.object(fetcher.time, 'time', return_value=1000.0) as now:
+            self.assertEqual(b'old', fetcher.get(url))
+            now.return_value = 1000.0 + fetcher.CACHE_TTLS['finance.naver.com'] - 1
+            self.assertEqual(b'old', fetcher.get(url))
+            self.assertEqual(1, session.get.call_count)
+            now.return_value = 1000.0 + fetcher.CACHE_TTLS['finance.naver.com'] + 1
+            self.assertEqual(b'new', fetcher.get(url))
+            self.assertEqual(2, session.get.call_count)
+
+    def test_not_modified_keeps_body_and_refreshes_entry(self):
+        url = 'http://comp.fnguide.com/page'
+        patch, session = self.stubbed_session(
+            mock.Mock(status_code=200, content=b'body', headers={'ETag': '"1"', 'Last-Modified': 'Mon'}),
+            mock.Mock(status_code=304, content=b'', headers={}))
+        fetcher.configure_cache(fetcher.CACHE_ON)
+        expired = 1000.0 + fetcher.CACHE_TTLS['comp.fnguide.com'] + 1
+        with patch, mock.patch.object(fetcher.time, 'time', return_value=1000.0) as now:
+            fetcher.get(url)
+            now.return_value = expired
+            self.assertEqual(b'body', fetcher.get(url))
+        self.assertEqual({'If-None-Match': '"1"', 'If-Modified-Since': 'Mon'}, session.get.call_args[1]['headers'])
+        entry = fetcher.load_entry(url)
+        self.assertEqual(expired, entry['fetched_at'])
+        self.assertEqual('"1"', entry['etag'])
+
+
+class FetcherRequestTest(unittest.TestCase):
+    def test_retries_take_a_limiter_token(self):
+        session = mock.Mock()
+        session.get.side_effect = [mock.Mock(status_code=503), mock.Mock(status_code=200)]
+        limiter = mock.Mock()
+        with mock.patch.object(fetcher, 'session_for', return_value=session), \
+                mock.patch.object(fetcher, 'limiter_for', return_value=limiter), \
+                mock.patch.object(fetcher, 'backoff'):
+            self.assertEqual(200, fetcher.request('http://comp.fnguide.com/page').status_code)
+        self.assertEqual(2, limiter.wait.call_count)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
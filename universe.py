@@ -0,0 +1,166 @@
+from typing import List, Dict, Tuple, Optional
+
+import numpy as np
+
+import db
+from db import FilterOption, DIVIDEND_TAX_RATE, FUTURE, THIS_YEAR, LAST_YEAR
+
+
+YEAR_STATS = ['ROEs', 'PBRs', 'EPSs', 'BPSs', 'NPs', 'CFOs', 'FCFs']
+SCALARS = ['current_price', 'bps', 'pbr', 'per', 'dividend_rate', 'adjusted_future_roe', 'beta', 'foreigner_weight',
+    'floating_rate', 'month1', 'month3', 'month6', 'month12', 'relative_earning_rate', 'agg_value']
+SCALAR_DEFAULTS = {'relative_earning_rate': -100}
+METRICS = ['mean_roe', 'future_roe', 'calculable', 'future_bps', 'expected_rate', 'low_pbr', 'FCF_surplus_years', 'latest_fscore']
+COLUMNS = set(SCALARS) | set(METRICS)
+
+snapshot = {}
+
+
+def to_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def year_values(stock: dict, stat: str) -> List[Tuple[int, float]]:
+    stats = stock.get(stat)
+    if not stats:
+        return []
+    if isinstance(stats[0], (list, tuple)):
+        return [(int(pair[0]), to_float(pair[1])) for pair in stats]
+    last_year_index = stock.get('last_year_index')
+    if last_year_index is None:
+        return []
+    if len(stats) < last_year_index:
+        first_year = LAST_YEAR - len(stats) + 1
+    else:
+        first_year = LAST_YEAR - last_year_index
+    return [(first_year + idx, to_float(value)) for idx, value in enumerate(stats)]
+
+
+def has_constant_total_issued_stock(stock: dict) -> bool:
+    TIs = stock.get('TIs', [])
+    return len(TIs) > 2 and len(set(TIs)) <= 1
+
+
+def rank_array(values: np.ndarray, reverse: bool) -> np.ndarray:
+    countable = np.flatnonzero(values > 0)
+    keys = -values[countable] if reverse else values[countable]
+    ranks = np.full(len(values), len(values), dtype=int)
+    ranks[countable[np.argsort(keys, kind='stable')]] = np.arange(1, len(countable) + 1)
+    return ranks
+
+
+class StockUniverse:
+    def __init__(self, documents: List[dict]):
+        self.codes = np.array([d.get('code') for d in documents])
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        self.scalars = {key: np.array([to_float(d.get(key, SCALAR_DEFAULTS.get(key, 0))) for d in documents]) for key in SCALARS}
+        self.total_issued_stock = np.array([has_constant_total_issued_stock(d) for d in documents], dtype=int)
+
+        by_stat = {stat: [year_values(d, stat) for d in documents] for stat in YEAR_STATS}
+        years = {year for rows in by_stat.values() for row in rows for year, _ in row}
+        first_year = min(years | {LAST_YEAR})
+        self.years = np.arange(first_year, max(years | {LAST_YEAR}) + 1)
+        self.stats = {stat: self.year_matrix(rows, first_year) for stat, rows in by_stat.items()}
+        self.metrics = self.compute_metrics()
+
+    @classmethod
+    def load(cls, find=None) -> 'StockUniverse':
+        projection = ['code', 'title', 'last_year_index', 'TIs'] + YEAR_STATS + SCALARS
+        return cls(list(db.db.stocks.find(find or {}, projection=projection)))
+
+    def year_matrix(self, rows: List[List[Tuple[int, float]]], first_year: int) -> np.ndarray:
+        matrix = np.full((len(rows), len(self.years)), np.nan)
+        for i, row in enumerate(rows):
+            for year, value in reversed(row):
+                matrix[i, year - first_year] = value
+        return matrix
+
+    def column(self, key: str) -> np.ndarray:
+        if key in self.metrics:
+            return self.metrics[key]
+        return self.scalars[key]
+
+    def year_column(self, stat: str, year: int) -> np.ndarray:
+        return self.stats[stat][:, year - self.years[0]]
+
+    def compute_metrics(self) -> Dict[str, np.ndarray]:
+        past = self.years <= LAST_YEAR
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ROEs = self.stats['ROEs']
+            countable = ((self.years >= THIS_YEAR - 4) & (self.years < THIS_YEAR)) & ~np.isnan(ROEs) & (ROEs != 0)
+            count = countable.sum(axis=1)
+            mean_roe = np.where(count > 0, np.where(countable, ROEs, 0).sum(axis=1) / np.maximum(count, 1), 0)
+            future_roe = mean_roe - self.scalars['dividend_rate'] * (DIVIDEND_TAX_RATE / 100)
+
+            bps = self.scalars['bps']
+            adjusted_future_roe = np.nan_to_num(self.scalars['adjusted_future_roe'])
+            roe = np.where(adjusted_future_roe != 0, adjusted_future_roe, future_roe)
+            calculable = (bps > 0) & (roe > 0)
+            future_bps = np.where(calculable, np.trunc(bps * (1 + roe / 100) ** FUTURE), 0)
+            price = np.trunc(self.scalars['current_price'])
+            expected_rate = np.where(price > 0, ((future_bps / price) ** (1.0 / FUTURE) - 1) * 100, np.nan)
+
+            PBRs = np.where(past & (self.stats['PBRs'] > 0), self.stats['PBRs'], np.inf)
+            low_pbr = PBRs.min(axis=1)
+            low_pbr = np.where(np.isinf(low_pbr), 0, low_pbr)
+
+            FCF_surplus_years = (past & (self.stats['FCFs'] > 0)).sum(axis=1)
+
+            last_year_NP = self.year_column('NPs', LAST_YEAR)
+            latest_fscore = np.where(np.isnan(last_year_NP), -1,
+                self.total_issued_stock + (last_year_NP > 0) + (self.year_column('CFOs', LAST_YEAR) > 0))
+
+        return {
+            'mean_roe': mean_roe,
+            'future_roe': future_roe,
+            'calculable': calculable,
+            'future_bps': future_bps,
+            'expected_rate': expected_rate,
+            'low_pbr': low_pbr,
+            'FCF_surplus_years': FCF_surplus_years,
+            'latest_fscore': latest_fscore,
+        }
+
+    def mask(self, filter_options: List[FilterOption]) -> np.ndarray:
+        mask = np.ones(len(self.codes), dtype=bool)
+        with np.errstate(invalid='ignore'):
+            for option in filter_options:
+                values = self.column(option.key)
+                if option.is_boolean:
+                    mask &= values.astype(bool)
+                else:
+                    mask &= (values >= option.value) if option.morethan else (values <= option.value)
+        return mask
+
+    def screen(self, filter_options: List[FilterOption], order_by: str='expected_rate', reverse: bool=True) -> List[str]:
+        selected = np.flatnonzero(self.mask(filter_options))
+        keys = self.column(order_by)[selected]
+        order = np.argsort(-keys if reverse else keys, kind='stable')
+        return list(self.codes[selected[order]])
+
+    def sign_mask(self, key: str, positive: bool) -> np.ndarray:
+        with np.errstate(invalid='ignore'):
+            values = self.column(key)
+            return values > 0 if positive else values < 0
+
+    def codes_where(self, mask: np.ndarray) -> List[str]:
+        return self.codes[mask].tolist()
+
+    def rank(self, key: str, reverse: bool) -> np.ndarray:
+        return rank_array(np.nan_to_num(self.column(key)), reverse)
+
+    def stock_metrics(self, code: str) -> Optional[Dict[str, float]]:
+        i = self.index.get(code)
+        if i is None:
+            return None
+        return {key: values[i].item() for key, values in self.metrics.items()}
+
+
+def current() -> StockUniverse:
+    version = db.recent_meta().get('version', 0)
+    if snapshot.get('version') != version or 'universe' not in snapshot:
+        snapshot.update(version=version, universe=StockUniverse.load())
+    return snapshot['universe']